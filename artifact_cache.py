@@ -0,0 +1,213 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import shapely
+from geopandas import GeoSeries
+from networkx import Graph
+from pyproj import CRS
+
+from geojitter import TileGrid
+from spatial_graph import SpatialGraph
+from tile_cache import evict_to_size
+
+
+def _update_hash(digest, value) -> None:
+    """
+    Feeds a value into a hash by content, tagging each part with its type so that values of different types never collide.
+    """
+    if isinstance(value, SpatialGraph):
+        digest.update(b"SpatialGraph")
+        for array in (value.nodes, value.long, value.lat, value.edge_u, value.edge_v):
+            _update_hash(digest, array)
+        for attrs in (value.node_attrs, value.edge_attrs):
+            for name in sorted(attrs):
+                _update_hash(digest, name)
+                _update_hash(digest, attrs[name])
+    elif isinstance(value, Graph):
+        _update_hash(digest, SpatialGraph.from_networkx(value))
+    elif isinstance(value, np.ndarray):
+        digest.update(f"ndarray{value.dtype.str}{value.shape}".encode())
+        digest.update(repr(value.tolist()).encode() if value.dtype == object else np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, shapely.Geometry):
+        digest.update(b"Geometry")
+        digest.update(shapely.to_wkb(value))
+    elif isinstance(value, GeoSeries):
+        digest.update(b"GeoSeries")
+        _update_hash(digest, value.index.to_numpy())
+        _update_hash(digest, np.asarray(shapely.to_wkb(value.values), dtype=object))
+        _update_hash(digest, value.crs)
+    elif isinstance(value, TileGrid):
+        digest.update(b"TileGrid")
+        _update_hash(digest, value.long_edges)
+        _update_hash(digest, value.lat_edges)
+    elif isinstance(value, CRS):
+        digest.update(b"CRS")
+        digest.update(value.to_wkt().encode())
+    elif isinstance(value, (tuple, list)):
+        digest.update(f"{type(value).__name__}{len(value)}".encode())
+        for item in value:
+            _update_hash(digest, item)
+    elif isinstance(value, dict):
+        digest.update(f"dict{len(value)}".encode())
+        for key in sorted(value, key=repr):
+            _update_hash(digest, key)
+            _update_hash(digest, value[key])
+    elif value is None or isinstance(value, (str, int, float, bool, np.generic)):
+        digest.update(f"{type(value).__name__}:{value!r}".encode())
+    else:
+        raise TypeError(f"Cannot fingerprint a {type(value).__name__}")
+
+
+def fingerprint(value) -> str:
+    """
+    A hash of the content of a value, for use in cache keys. Graphs (networkx or SpatialGraph), shapely geometries, GeoSeries, TileGrids, CRSs, NumPy arrays, plain scalars, and tuples, lists and dicts of them are supported. A networkx graph is hashed through its SpatialGraph form, so hashing a large one once and passing the hash around is cheaper than hashing it for every key.
+    Outputs:
+    - digest (str): A hexadecimal BLAKE2 digest
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    _update_hash(digest, value)
+    return digest.hexdigest()
+
+
+def _pack(value, prefix: str, arrays: dict) -> dict:
+    """
+    Flattens an artifact into named arrays, returning the manifest needed to rebuild it.
+    """
+    if isinstance(value, (SpatialGraph, Graph)):
+        graph = value if isinstance(value, SpatialGraph) else SpatialGraph.from_networkx(value)
+        for name in ("nodes", "long", "lat", "edge_u", "edge_v"):
+            arrays[f"{prefix}{name}"] = getattr(graph, name)
+        for kind, attrs in (("node", graph.node_attrs), ("edge", graph.edge_attrs)):
+            for i, column in enumerate(attrs.values()):
+                arrays[f"{prefix}{kind}{i}"] = column
+        return {
+            "type": "networkx" if isinstance(value, Graph) else "SpatialGraph",
+            "prefix": prefix,
+            "node_attrs": list(graph.node_attrs),
+            "edge_attrs": list(graph.edge_attrs)
+        }
+    if isinstance(value, TileGrid):
+        arrays[f"{prefix}long_edges"] = value.long_edges
+        arrays[f"{prefix}lat_edges"] = value.lat_edges
+        return {"type": "TileGrid", "prefix": prefix}
+    if isinstance(value, GeoSeries):
+        arrays[f"{prefix}wkb"] = np.asarray(shapely.to_wkb(value.values), dtype=object)
+        arrays[f"{prefix}index"] = value.index.to_numpy()
+        return {"type": "GeoSeries", "prefix": prefix, "crs": None if value.crs is None else value.crs.to_wkt()}
+    if isinstance(value, np.ndarray):
+        arrays[prefix] = value
+        return {"type": "ndarray", "prefix": prefix}
+    if isinstance(value, (tuple, list)):
+        return {
+            "type": type(value).__name__,
+            "items": [_pack(item, f"{prefix}{i}.", arrays) for i, item in enumerate(value)]
+        }
+    raise TypeError(f"Cannot store a {type(value).__name__} in the artifact cache")
+
+
+def _unpack(manifest: dict, arrays):
+    kind = manifest["type"]
+    if kind in ("tuple", "list"):
+        items = [_unpack(item, arrays) for item in manifest["items"]]
+        return tuple(items) if kind == "tuple" else items
+
+    prefix = manifest.get("prefix")
+    if kind in ("SpatialGraph", "networkx"):
+        graph = SpatialGraph(
+            arrays[f"{prefix}nodes"], arrays[f"{prefix}long"], arrays[f"{prefix}lat"],
+            arrays[f"{prefix}edge_u"], arrays[f"{prefix}edge_v"],
+            {name: arrays[f"{prefix}node{i}"] for i, name in enumerate(manifest["node_attrs"])},
+            {name: arrays[f"{prefix}edge{i}"] for i, name in enumerate(manifest["edge_attrs"])},
+            arrays[f"{prefix}long"].dtype
+        )
+        return graph.to_networkx() if kind == "networkx" else graph
+    if kind == "TileGrid":
+        return TileGrid(arrays[f"{prefix}long_edges"], arrays[f"{prefix}lat_edges"])
+    if kind == "GeoSeries":
+        return GeoSeries(shapely.from_wkb(arrays[f"{prefix}wkb"]), index=arrays[f"{prefix}index"], crs=manifest["crs"])
+    if kind == "ndarray":
+        return arrays[prefix]
+    raise ValueError(f"Unknown artifact type {kind}")
+
+
+class ArtifactCache:
+    """
+    A content-addressed disk cache of derived artifacts, such as the subnetwork of a state and its tiling, so that repeated sweeps start from precomputed results instead of rebuilding them. An artifact is stored under a hash of everything it was computed from (see fingerprint), so changing the source graph, a region or a parameter gives a new entry rather than a stale one. Artifacts are stored as uncompressed NumPy archives (.npz), and once the cache exceeds max_bytes the least recently used ones are deleted.
+    Inputs:
+    - directory (str | pathlib.Path): Where the artifacts are stored. Created if it does not exist
+    - max_bytes (int): Default 2 GiB. Once the stored artifacts exceed this size, the least recently used ones are deleted
+    """
+    def __init__(self, directory: str | Path, max_bytes: int = 2 * 2**30):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, name: str, inputs) -> Path:
+        """
+        The file an artifact computed from some inputs is stored in. See fingerprint for the supported inputs.
+        """
+        return self.directory / f"{name}-{fingerprint((name, inputs))}.npz"
+
+    def get(self, name: str, inputs):
+        """
+        Reads an artifact, or returns None if it is not cached.
+        """
+        path = self.path(name, inputs)
+        try:
+            # Object columns (string labels, WKB) are pickled by NumPy. The files are only ever written by this class
+            with np.load(path, allow_pickle=True) as stored:
+                manifest = json.loads(str(stored["__manifest__"]))
+                artifact = _unpack(manifest, stored)
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return artifact
+
+    def put(self, name: str, inputs, artifact) -> Path:
+        """
+        Stores an artifact: a networkx graph, SpatialGraph, TileGrid, GeoSeries or NumPy array, or a tuple or list of them. networkx graphs come back as plain Graphs, with the properties of their nodes and edges.
+        """
+        arrays = {}
+        manifest = _pack(artifact, "", arrays)
+        path = self.path(name, inputs)
+
+        # Written under a temporary name and then renamed, so a crash never leaves a partial artifact behind
+        partial = path.with_suffix(".partial")
+        with open(partial, "wb") as f:
+            np.savez(f, __manifest__=np.array(json.dumps(manifest)), **arrays)
+        os.replace(partial, path)
+
+        self.evict()
+        return path
+
+    def get_or_compute(self, name: str, inputs, compute: Callable):
+        """
+        Reads an artifact if it is cached, and otherwise computes it with compute() and stores it.
+        Inputs:
+        - name (str): The kind of artifact, such as "state-tiles". It prefixes the file name
+        - inputs: Everything the artifact is computed from. See fingerprint
+        - compute (Callable): A function of no arguments computing the artifact
+        Outputs:
+        - artifact: The cached or computed artifact
+        """
+        artifact = self.get(name, inputs)
+        if artifact is not None:
+            self.hits += 1
+            return artifact
+
+        self.misses += 1
+        artifact = compute()
+        self.put(name, inputs, artifact)
+        return artifact
+
+    def evict(self) -> int:
+        """
+        Deletes the least recently used artifacts until the cache fits in max_bytes. Returns the number of bytes freed.
+        """
+        return evict_to_size(self.directory, self.max_bytes, "*.npz")
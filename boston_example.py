@@ -2,41 +2,41 @@ import time
 
 t = time.time()
 
-import pickle
 from typing import Hashable
 
 from networkx import Graph
-from geopandas import GeoDataFrame, read_file
-from shapely import Point, Polygon
+from geopandas import GeoDataFrame
+from shapely import Point
 import matplotlib.pyplot as plt
-from contextily import add_basemap, providers
+from contextily import providers
 
 import geojitter as gj
+from loaders import ConcurrentLoader, load_pickle, read_regions
+from tile_cache import TileCache
 
 nt = time.time()
 print("Imports", nt - t)
 
 t = time.time()
 
-with open("./data_vault/test_network1.pkl", "rb") as f:
-    original_network: Graph = pickle.load(f)
+inputs = ConcurrentLoader()
+inputs.add("network", load_pickle, "./data_vault/test_network1.pkl")
+inputs.add("regions", read_regions, "./data_vault/Boston_Neighborhood_Boundaries_Approximated_by_2020_Census_Tracts.shp")
 
-regions: GeoDataFrame = read_file("./data_vault/Boston_Neighborhood_Boundaries_Approximated_by_2020_Census_Tracts.shp")
-quick_ref = dict(zip(regions['neighborho'], regions['geometry']))
+regions: GeoDataFrame = inputs["regions"]
+neighborhoods = regions.set_index('neighborho')
+
+tiles = TileCache("./tile_cache")
 
 fig, ax = plt.subplots(figsize=(10, 10))
 
-add_basemap(ax, source=providers.OpenStreetMap.Mapnik, crs=regions.crs)
+tiles.add_basemap(ax, provider=providers.OpenStreetMap.Mapnik, crs=regions.crs)
+original_network: Graph = inputs["network"]
 
 nt = time.time()
 print("Reading:", nt - t)
 
 
-def region_accessor(node: Hashable) -> Polygon:
-    neighborhood_name = original_network.nodes[node]["neighborhood"]
-    return quick_ref[neighborhood_name]
-
-
 def point_converter(node: Hashable, data: dict) -> Point:
     return Point(0, 0)  # Since we are using random points in the region, the output of this function is discarded
 
@@ -45,22 +45,22 @@ def time_thinking():
     t = time.time()
 
     new_network = gj.obfuscated_network(
-        regions=regions,
+        regions=neighborhoods,
         network=original_network,
-        region_accessor=region_accessor,
+        region_accessor="neighborhood",
         point_converter=point_converter,
         strategy=gj.rand_point_in_region(max_iter=50)
     )
     new_network2 = gj.obfuscated_network(
-        regions=regions,
+        regions=neighborhoods,
         network=original_network,
-        region_accessor=region_accessor,
+        region_accessor="neighborhood",
         point_converter=point_converter,
         strategy=gj.rand_point_in_region(max_iter=50)
     )
     x = len(new_network)
-    gj.display(regions, new_network)
-    gj.display(regions, new_network2)
+    gj.display(regions, new_network, tile_cache=tiles)
+    gj.display(regions, new_network2, tile_cache=tiles)
 
     nt = time.time()
     return nt - t
@@ -2,16 +2,16 @@ import time
 
 t = time.time()
 
-import pickle
 from typing import Hashable
 
 from networkx import Graph, draw
-from geopandas import GeoDataFrame, read_file, GeoSeries, list_layers
-from shapely import Point, Polygon
+from geopandas import GeoDataFrame, GeoSeries, list_layers
+from shapely import Point
 import matplotlib.pyplot as plt
 from contextily import add_basemap, providers
 
 import geojitter as gj
+from loaders import ConcurrentLoader, load_pickle, read_regions
 
 nt = time.time()
 print("Imports", nt - t)
@@ -20,19 +20,18 @@ t = time.time()
 
 fig, ax = plt.subplots()
 
-with open("./experiments/data/networks/spatial_graph_brightkite", "rb") as f:
-    original_network: Graph = pickle.load(f)
-state = read_file("./data_vault/cb_2018_us_state_20m/cb_2018_us_state_20m.shp")
-state.crs = "EPSG:4326"
-state = state.loc[32, 'geometry']
+inputs = ConcurrentLoader()
+inputs.add("network", load_pickle, "./experiments/data/networks/spatial_graph_brightkite")
+inputs.add("states", read_regions, "./data_vault/cb_2018_us_state_20m/cb_2018_us_state_20m.shp", crs="EPSG:4326")
+
+state = inputs["states"].loc[32, 'geometry']
 ax.plot(*state.exterior.xy)
 
+original_network: Graph = inputs["network"]
 new_network = gj.filter_network_by_region(original_network, state)
 
 regions: GeoSeries = gj.gen_region_grid_rc(new_network, 10, 10)
 
-quick_ref = dict(enumerate(list(regions)))
-
 
 def point_converter(node: Hashable, data: dict) -> Point:
     return (data["long"], data["lat"])
@@ -42,21 +41,13 @@ nt = time.time()
 print("Reading:", nt - t)
 
 
-def region_accessor(node: Hashable) -> Polygon:
-    if "region" not in new_network.nodes(data=True)[node]:
-        return quick_ref[0]
-    else:
-        region_name = new_network.nodes(data=True)[node]["region"]
-        return quick_ref[region_name]
-
-
 def time_thinking():
     t = time.time()
 
     jittered_network = gj.obfuscated_network(
         regions=regions,
         network=new_network,
-        region_accessor=region_accessor,
+        region_accessor="region",
         point_converter=point_converter,
         strategy=gj.rand_point_in_region(max_iter=100)
     )
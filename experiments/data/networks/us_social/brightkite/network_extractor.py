@@ -1,57 +1,35 @@
 import networkx as nx
-import csv
-import math
 import pickle
+from pathlib import Path
+import numpy as np
 import matplotlib.pyplot as plt
 
+# loaders is imported from the repository root, so run this from there with
+# python -m experiments.data.networks.us_social.brightkite.network_extractor
+import loaders
 
-def gen_graph(edges, locations_filename):
 
-    G = nx.Graph()
+def gen_graph(edges, locations_filename):
 
-    with open(edges,"r") as edge_file:
-        for line in edge_file.readlines():
-            i,j = line.split()
-            G.add_edge(int(i),int(j))
+    u, v = loaders.read_edge_list(edges)
 
     print("Read graph data")
-    total = len(G.nodes)
-    print(f"Processing {total} nodes.")
-
-    locations = {}
-
-    with open(locations_filename,"r") as location_file:
-        for line in location_file.readlines():
-            fields = line.split()
+    nodes = np.unique(np.concatenate([u, v]))
+    print(f"Processing {len(nodes)} nodes.")
 
-            if len(fields) < 4:
-                continue
+    locations = loaders.read_checkin_locations(locations_filename)
 
-            node = int(fields[0])
-            lat = float(fields[2])
-            long = float(fields[3])
+    # Trim nodes without location data. Located nodes whose friends are all unlocated are kept, without edges
+    located = np.isin(u, locations.index) & np.isin(v, locations.index)
+    u, v = u[located], v[located]
+    locations = locations.loc[locations.index.intersection(nodes)]
 
-            if lat == 0 or long == 0:
-                continue
-
-            if node in locations:
-                a_lat, a_long, n = locations[node]
-                n = n + 1
-                u_long = a_long + (long - a_long)/n
-                u_lat = a_lat + (lat - a_lat)/n
-                locations[node] = (u_lat, u_long, n)
-            else:
-                locations[node] = (lat, long, 1)
-
-    for node in locations:
-        G.nodes[node]['lat'] = locations[node][0]
-        G.nodes[node]['long'] = locations[node][1]
-
-    # Trim nodes without location data
-    nodes = list(G.nodes.keys())
-    for node in nodes:
-        if node not in locations:
-            G.remove_node(node)
+    G = nx.Graph()
+    G.add_nodes_from(
+        (node, {"lat": lat, "long": long})
+        for node, lat, long in zip(locations.index.tolist(), locations["lat"].tolist(), locations["long"].tolist())
+    )
+    G.add_edges_from(zip(u.tolist(), v.tolist()))
 
     print(f"Graph built with {G.number_of_nodes()} nodes and {G.number_of_edges()} edges.")
 
@@ -59,7 +37,8 @@ def gen_graph(edges, locations_filename):
     nx.draw(G, positions)
     plt.show()
 
-    with open("spatial_graph", 'wb') as out:
+    # Written next to the input, wherever this is run from
+    with open(Path(locations_filename).parent / "spatial_graph", 'wb') as out:
         pickle.dump(G, out)
 
     return G
@@ -74,8 +53,8 @@ if __name__ == "__main__":
         0       2010-10-06T00:19:01Z    39.685683       -104.939221     dcc06bf19e775f436c2225be50e14922
     '''
 
-    edges = "Brightkite_edges.txt"
-    locations = "Brightkite_totalCheckins.txt"
+    edges = Path(__file__).parent / "Brightkite_edges.txt"
+    locations = Path(__file__).parent / "Brightkite_totalCheckins.txt"
     g = gen_graph(edges, locations)
 
     # with open("outfile", 'rb') as infile:
@@ -0,0 +1,277 @@
+import json
+from itertools import chain
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyogrio
+from networkx import Graph
+from pyproj import CRS
+
+from spatial_graph import SpatialGraph
+
+WKB_POINT = 1
+WKB_LINESTRING = 2
+FORMATS = {".parquet": "GeoParquet", ".geoparquet": "GeoParquet", ".fgb": "FlatGeobuf"}
+
+
+def _format(path: Path, file_format: str | None) -> str:
+    if file_format is not None:
+        if file_format not in FORMATS.values():
+            raise ValueError(f"Unknown format {file_format}. Expected one of {sorted(set(FORMATS.values()))}")
+        return file_format
+    if path.suffix.lower() not in FORMATS:
+        raise ValueError(f"Cannot tell the format of {path} from its extension. Use one of {sorted(FORMATS)} or pass file_format")
+    return FORMATS[path.suffix.lower()]
+
+
+def _strings(values: np.ndarray) -> pa.Array:
+    return pa.array([None if value is None else str(value) for value in values.tolist()], type=pa.string())
+
+
+def _arrow_column(values: np.ndarray, column_type: pa.DataType | None = None) -> pa.Array:
+    """
+    Converts a property column, or a chunk of one, to Arrow. Object columns mixing types that Arrow cannot unify are written as strings, with missing values (None) kept as nulls. If column_type is given (see _column_type), the chunk is converted to it, so every chunk of a column has the same type.
+    """
+    if values.dtype != object:
+        array = pa.array(values)
+    elif column_type is not None and pa.types.is_string(column_type):
+        return _strings(values)
+    else:
+        try:
+            array = pa.array(values.tolist(), from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            array = _strings(values)
+    return array if column_type is None or array.type == column_type else array.cast(column_type)
+
+
+def _promote(a: pa.DataType, b: pa.DataType) -> pa.DataType:
+    # Nulls take the other type and integers widen to floats, as Arrow promotes them. Types Arrow cannot unify become strings
+    try:
+        return pa.unify_schemas([pa.schema([("column", a)]), pa.schema([("column", b)])], promote_options="permissive").field("column").type
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.string()
+
+
+def _column_type(values: np.ndarray, chunk_size: int) -> pa.DataType:
+    """
+    The Arrow type of a whole property column. The type of an object column is promoted across its chunks, since a chunk on its own may hold only missing values, or only some of the types of the column, while the file needs one type per column.
+    """
+    if values.dtype != object:
+        return pa.array(values[:0]).type
+    column_type = pa.null()
+    for chunk in _chunks(len(values), chunk_size):
+        column_type = _promote(column_type, _arrow_column(values[chunk]).type)
+    return column_type
+
+
+def _chunks(count: int, chunk_size: int) -> Iterator[slice]:
+    if chunk_size < 1:
+        raise ValueError(f"chunk_size must be positive, got {chunk_size}")
+    # An empty table still yields one empty chunk, so the file is written with its columns
+    for start in range(0, max(count, 1), chunk_size):
+        yield slice(start, min(start + chunk_size, count))
+
+
+def _wkb(coords: np.ndarray, geometry_type: int) -> pa.Array:
+    """
+    Encodes points or lines of the same number of vertices as little-endian WKB, straight from their coordinates, which is several times faster than building shapely geometries and encoding them one by one.
+    Inputs:
+    - coords (numpy.ndarray): An (N, V, 2) array of the V vertices of each of the N geometries
+    - geometry_type (int): WKB_POINT (V must be 1) or WKB_LINESTRING
+    Outputs:
+    - wkb (pyarrow.Array): A binary array of the N encoded geometries
+    """
+    count, vertices = coords.shape[:2]
+    fields = [("order", "u1"), ("type", "<u4")]
+    if geometry_type == WKB_LINESTRING:
+        fields.append(("vertices", "<u4"))
+    fields.append(("coords", "<f8", (vertices, 2)))
+    records = np.empty(count, dtype=np.dtype(fields))
+    records["order"] = 1
+    records["type"] = geometry_type
+    if geometry_type == WKB_LINESTRING:
+        records["vertices"] = vertices
+    records["coords"] = coords
+
+    size = records.dtype.itemsize
+    offsets = np.arange(0, (count + 1) * size, size, dtype=np.int32 if (count + 1) * size < 2**31 else np.int64)
+    binary = pa.binary() if offsets.dtype == np.int32 else pa.large_binary()
+    return pa.Array.from_buffers(binary, count, [None, pa.py_buffer(offsets), pa.py_buffer(records.view(np.uint8))])
+
+
+def _node_batches(network: SpatialGraph, attributes: list[str], chunk_size: int) -> Iterator[pa.RecordBatch]:
+    id_type = _column_type(network.nodes, chunk_size)
+    types = {name: _column_type(network.node_attrs[name], chunk_size) for name in attributes}
+    for chunk in _chunks(len(network), chunk_size):
+        columns = {"id": _arrow_column(network.nodes[chunk], id_type)}
+        columns.update((name, _arrow_column(network.node_attrs[name][chunk], types[name])) for name in attributes)
+        columns["geometry"] = _wkb(np.column_stack([network.long[chunk], network.lat[chunk]])[:, None], WKB_POINT)
+        yield pa.RecordBatch.from_pydict(columns)
+
+
+def _edge_batches(network: SpatialGraph, attributes: list[str], chunk_size: int, geometry: bool) -> Iterator[pa.RecordBatch]:
+    # The ends of the edges are ids of nodes, so they take the type of the whole id column
+    id_type = _column_type(network.nodes, chunk_size)
+    types = {name: _column_type(network.edge_attrs[name], chunk_size) for name in attributes}
+    for chunk in _chunks(network.number_of_edges(), chunk_size):
+        u, v = network.edge_u[chunk], network.edge_v[chunk]
+        columns = {"u": _arrow_column(network.nodes[u], id_type), "v": _arrow_column(network.nodes[v], id_type)}
+        columns.update((name, _arrow_column(network.edge_attrs[name][chunk], types[name])) for name in attributes)
+        if geometry:
+            ends = np.column_stack([network.long[u], network.lat[u], network.long[v], network.lat[v]]).reshape(-1, 2, 2)
+            columns["geometry"] = _wkb(ends, WKB_LINESTRING)
+        yield pa.RecordBatch.from_pydict(columns)
+
+
+def _geo_metadata(crs: CRS, geometry_type: str, bbox: list[float] | None) -> bytes:
+    # The "geo" file metadata of GeoParquet 1.1, describing the single WKB geometry column
+    column = {"encoding": "WKB", "geometry_types": [geometry_type], "crs": crs.to_json_dict()}
+    if bbox is not None:
+        column["bbox"] = bbox
+    return json.dumps({"version": "1.1.0", "primary_column": "geometry", "columns": {"geometry": column}}).encode()
+
+
+def _write_batches(
+        batches: Iterator[pa.RecordBatch],
+        path: Path,
+        file_format: str,
+        crs: CRS,
+        geometry_type: str | None,
+        bbox: list[float] | None
+) -> int:
+    """
+    Writes record batches one at a time, so only one chunk is held in memory at once. Each batch becomes one row group of a GeoParquet file, or is streamed to GDAL for FlatGeobuf.
+    Outputs:
+    - written (int): The number of rows written
+    """
+    first = next(batches)
+    schema = first.schema
+    written = 0
+
+    def counted() -> Iterator[pa.RecordBatch]:
+        nonlocal written
+        for batch in chain([first], batches):
+            written += batch.num_rows
+            # Property columns have one type throughout, but a chunk's geometry may need 32 or 64-bit offsets depending on its size
+            yield batch if batch.schema.equals(first.schema) else batch.cast(first.schema)
+
+    if file_format == "GeoParquet":
+        if geometry_type is not None:
+            schema = schema.with_metadata({b"geo": _geo_metadata(crs, geometry_type, bbox)})
+        with pq.ParquetWriter(path, schema) as writer:
+            for batch in counted():
+                writer.write_batch(batch, row_group_size=max(batch.num_rows, 1))
+        return written
+
+    if geometry_type is None:
+        raise ValueError("FlatGeobuf needs a geometry. Write edges with geometry=\"linestring\", or as GeoParquet")
+    # FlatGeobuf files cannot be appended to, so the chunks are streamed to GDAL as a single Arrow stream
+    pyogrio.write_arrow(
+        pa.RecordBatchReader.from_batches(schema, counted()), path, driver="FlatGeobuf",
+        geometry_name="geometry", geometry_type=geometry_type, crs=crs.to_wkt()
+    )
+    return written
+
+
+def _as_spatial_graph(network: Graph | SpatialGraph) -> SpatialGraph:
+    return network if isinstance(network, SpatialGraph) else SpatialGraph.from_networkx(network)
+
+
+def _bbox(long: np.ndarray, lat: np.ndarray) -> list[float] | None:
+    if len(long) == 0:
+        return None
+    return [float(long.min()), float(lat.min()), float(long.max()), float(lat.max())]
+
+
+def write_nodes(
+        network: Graph | SpatialGraph,
+        path: str | Path,
+        crs="EPSG:4326",
+        attributes: list[str] | None = None,
+        chunk_size: int = 500_000,
+        file_format: str | None = None
+) -> int:
+    """
+    Writes the nodes of a (typically jittered) network as points, straight from its coordinate arrays, to a GeoParquet or FlatGeobuf file that GIS tools can read without unpickling. Rows are written chunk_size at a time, so memory stays bounded no matter the size of the network. Each row holds the node "id", its properties and its point "geometry".
+    Inputs:
+    - network (networkx.Graph | SpatialGraph): The network to write. A networkx graph is converted to a SpatialGraph first
+    - path (str | pathlib.Path): The file to write. Overwritten if it exists
+    - crs: Default "EPSG:4326". The coordinate reference system of the coordinates, such as the one returned by equal_area_crs for projected networks
+    - attributes (list[str]): Default None. The node properties to write. If not provided, every property is written
+    - chunk_size (int): Default 500,000. The number of rows per chunk, which is also the row group size of GeoParquet files
+    - file_format (str): Default None. "GeoParquet" or "FlatGeobuf". If not provided, it is chosen from the extension of path (.parquet, .geoparquet or .fgb)
+    Outputs:
+    - written (int): The number of nodes written
+    """
+    path = Path(path)
+    file_format = _format(path, file_format)
+    network = _as_spatial_graph(network)
+    attributes = list(network.node_attrs) if attributes is None else attributes
+    return _write_batches(
+        _node_batches(network, attributes, chunk_size), path, file_format, CRS.from_user_input(crs), "Point",
+        _bbox(network.long, network.lat)
+    )
+
+
+def write_edges(
+        network: Graph | SpatialGraph,
+        path: str | Path,
+        crs="EPSG:4326",
+        attributes: list[str] | None = None,
+        geometry: str = "linestring",
+        chunk_size: int = 500_000,
+        file_format: str | None = None
+) -> int:
+    """
+    Writes the edges of a network to a GeoParquet or FlatGeobuf file, chunk_size rows at a time. Each row holds the ids of the two ends of the edge ("u" and "v"), its properties and, unless only ids are asked for, a straight "geometry" line between its ends.
+    Inputs:
+    - network (networkx.Graph | SpatialGraph): The network to write. A networkx graph is converted to a SpatialGraph first
+    - path (str | pathlib.Path): The file to write. Overwritten if it exists
+    - crs: Default "EPSG:4326". See write_nodes
+    - attributes (list[str]): Default None. The edge properties to write. If not provided, every property is written
+    - geometry (str): Default "linestring". Either "linestring", or "ids" to write only the pairs of node ids, as a plain Parquet table. FlatGeobuf files always need the lines
+    - chunk_size (int): Default 500,000. See write_nodes
+    - file_format (str): Default None. See write_nodes
+    Outputs:
+    - written (int): The number of edges written
+    """
+    if geometry not in ("linestring", "ids"):
+        raise ValueError(f"geometry must be \"linestring\" or \"ids\", got {geometry}")
+    path = Path(path)
+    file_format = _format(path, file_format)
+    network = _as_spatial_graph(network)
+    attributes = list(network.edge_attrs) if attributes is None else attributes
+    lines = geometry == "linestring"
+    return _write_batches(
+        _edge_batches(network, attributes, chunk_size, lines), path, file_format, CRS.from_user_input(crs),
+        "LineString" if lines else None, _bbox(network.long, network.lat) if lines else None
+    )
+
+
+def write_network(
+        network: Graph | SpatialGraph,
+        directory: str | Path,
+        name: str = "network",
+        crs="EPSG:4326",
+        file_format: str = "GeoParquet",
+        geometry: str = "linestring",
+        chunk_size: int = 500_000
+) -> tuple[Path, Path]:
+    """
+    Writes both the nodes and the edges of a network, as <directory>/<name>_nodes and <directory>/<name>_edges. See write_nodes and write_edges.
+    Outputs:
+    - paths (tuple[pathlib.Path, pathlib.Path]): The nodes file and the edges file
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    suffix = ".parquet" if file_format == "GeoParquet" else ".fgb"
+    network = _as_spatial_graph(network)
+
+    nodes_path = directory / f"{name}_nodes{suffix}"
+    edges_path = directory / f"{name}_edges{suffix}"
+    write_nodes(network, nodes_path, crs, chunk_size=chunk_size, file_format=file_format)
+    write_edges(network, edges_path, crs, geometry=geometry, chunk_size=chunk_size, file_format=file_format)
+    return nodes_path, edges_path
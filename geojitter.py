@@ -1,38 +1,64 @@
+from __future__ import annotations
+
+import hashlib
+import os
 import random
-from math import pi, cos, sin, sqrt
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from functools import lru_cache
+from math import pi, cos, sin, sqrt, ceil
 from typing import Callable
-from itertools import pairwise
 
 from networkx import Graph, draw
 from geopandas import GeoDataFrame, GeoSeries
+import pandas as pd
 from shapely import Polygon, MultiPolygon, Point
+import shapely
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 import contextily as ctx
 import scipy.stats as stat
+from scipy.spatial import cKDTree
+from scipy import sparse
 import numpy as np
 import triangle as tri
+from pyproj import CRS, Transformer
+
+from tile_cache import TileCache
+from spatial_graph import SpatialGraph
 
 
 def obfuscated_network(
-        regions: GeoDataFrame,
-        network: Graph,
-        region_accessor: Callable | None,
+        regions: GeoDataFrame | TileGrid | RegionHierarchy,
+        network: Graph | SpatialGraph,
+        region_accessor: Callable | str | int | np.ndarray | None,
         point_converter: Callable,
         strategy: Callable,
-        fail_graceful: bool = True
-) -> Graph:
+        fail_graceful: bool = True,
+        nearest_region: bool = False
+) -> Graph | SpatialGraph:
     """
     Creates a new network based on given information with the points obfuscated.
     Inputs:
-    - regions (geopandas.GeoDataFrame): The collection of regions of interest to the network.
-    - network (networkx.Graph): The graph containing all the metadata of the points and how they are connected to one another.
-    - region_accessor (Callable): This is a function which, when provided a node on the provided network, return the name of the region that point is contained in. In order for this function to work properly, the returned region names must match the GeoDataFrame provided in the "regions" argument.
+    - regions (geopandas.GeoDataFrame | TileGrid): The collection of regions of interest to the network. A TileGrid (see gen_region_grid_rc) may only be used with a str or numpy.ndarray region_accessor. With a RegionHierarchy, region_accessor is instead the name or number of the level to jitter within, and nodes are located by descending the hierarchy from their "long" and "lat" properties.
+    - network (networkx.Graph | SpatialGraph): The graph containing all the metadata of the points and how they are connected to one another. If a SpatialGraph is given, the points are read straight from its coordinate arrays and point_converter is not used.
+    - region_accessor (Callable | str | numpy.ndarray | None): This is a function which, when provided a node on the provided network, return the name of the region that point is contained in. In order for this function to work properly, the returned region names must match the GeoDataFrame provided in the "regions" argument. Alternatively, this can be the name of a node property holding each node's label in the index of "regions", or an array holding each node's position in "regions" (in the network's node order), or None to locate every node by containment of its converted point. In those three cases the regions are looked up for all nodes at once, nodes without a region are located by containment of their converted point, and the strategy is run region by region.
     - point_converter (Callable): This is a function which, when provided a node in the provided network, returns a shapely.Point for use in the obfuscation process.
-    - strategy (Callable): This is a function which, when provided a shapely.Point and shapely.Polygon (or shapely.MultiPolygon) returns an obfuscated shapely.Point. Alternatively, if the function fails, it should return None.
+    - strategy (Callable): This is a function which, when provided a shapely.Point and shapely.Polygon (or shapely.MultiPolygon) returns an obfuscated shapely.Point. Alternatively, if the function fails, it should return None. If the strategy has a "batch" attribute and the regions are looked up all at once, the batch function is called instead (see rand_point_in_region). Keyed strategies (see the "seed" option of rand_point_in_region) always go through the batch function, and are given the node_keys of the nodes. A strategy whose "needs_region" attribute is false, like rand_point_by_radius, is given no regions, and its nodes are never located, so "regions" may be None. Otherwise nodes without a region are failures.
     - fail_graceful (bool): Default True. If this option is enabled, a failure from the strategy function will remove that node from the network, and the program will continue. These failures will be reported in the log file. If fail_graceful is false, any error raised by the strategy function will halt the program.
+    - nearest_region (bool): Default False. If true, nodes located by containment of their point which no region contains (e.g. just off a coastline that the region polygons simplify away) are put in the nearest region instead of failing. Only used when the regions are looked up all at once
     Outputs:
-    - new_graph (networkx.Graph): The new graph, with all the original data preserved, but with each node being assigned new latitude and longitude coordinates.
+    - new_graph (networkx.Graph | SpatialGraph): The new graph, of the same type as "network", with all the original data preserved, but with each node being assigned new latitude and longitude coordinates.
     """
+    if isinstance(regions, RegionHierarchy):
+        _, longs, lats = _node_coords(network)
+        level = regions.level_number(region_accessor)
+        region_accessor = regions.locate(longs, lats, level)[:, level]
+        regions = regions[level]
+
+    if isinstance(network, SpatialGraph) or not callable(region_accessor) or getattr(strategy, "keyed", False):
+        return _obfuscated_network_by_index(regions, network, region_accessor, point_converter, strategy, fail_graceful, nearest_region)
+
     nodes = {}
     for point, data in network.nodes(data=True):
         nodes[point] = data.copy()
@@ -61,7 +87,458 @@ def obfuscated_network(
     return new_graph
 
 
-def gen_region_grid_rc(network: Graph, rows: int, cols: int, buffer: float = 0.1, modify_network=True) -> GeoSeries:
+def _as_xy(point) -> tuple[float, float]:
+    if isinstance(point, Point):
+        return point.x, point.y
+    return point[0], point[1]
+
+
+def _group_by_region(region_index: np.ndarray):
+    """
+    Yields each region number found in region_index along with the positions holding it. Positions with region number -1 are skipped.
+    """
+    if len(region_index) == 0:
+        return
+    order = np.argsort(region_index, kind="stable")
+    sorted_index = region_index[order]
+    starts = np.flatnonzero(np.r_[True, sorted_index[1:] != sorted_index[:-1]])
+    for start, end in zip(starts, np.r_[starts[1:], len(order)]):
+        if sorted_index[start] >= 0:
+            yield int(sorted_index[start]), order[start:end]
+
+
+def _region_index(
+        regions: GeoDataFrame | GeoSeries | TileGrid,
+        network: Graph | SpatialGraph,
+        region_accessor: str | np.ndarray | None,
+        points: np.ndarray,
+        nearest: bool = False
+) -> np.ndarray:
+    """
+    Finds the position in "regions" of every node, either from a node property holding region labels or from a precomputed array, or with None, from the nodes' points alone. Nodes without a usable region are located by containment of their point, and are given -1 if no region contains them, or the nearest region if "nearest" is set.
+    """
+    if region_accessor is None:
+        index = np.full(len(network), -1, dtype=np.int64)
+    elif isinstance(region_accessor, str) and isinstance(network, SpatialGraph):
+        labels = network.node_attrs.get(region_accessor, np.full(len(network), None))
+        index = np.asarray(regions.index.get_indexer(labels), dtype=np.int64)
+    elif isinstance(region_accessor, str):
+        labels = [data.get(region_accessor) for _, data in network.nodes(data=True)]
+        index = np.asarray(regions.index.get_indexer(labels), dtype=np.int64)
+    else:
+        # Copied, since the positions of nodes without a region are filled in below
+        index = np.array(region_accessor, dtype=np.int64, copy=True)
+        if len(index) != len(network):
+            raise ValueError(f"Expected {len(network)} region positions, got {len(index)}")
+
+    missing = np.flatnonzero(index < 0)
+    if len(missing) > 0 and isinstance(regions, TileGrid):
+        index[missing] = regions.locate(points[missing, 0], points[missing, 1])
+    elif len(missing) > 0:
+        index[missing] = _locate_by_containment(regions, points[missing, 0], points[missing, 1])
+
+    outside = np.flatnonzero(index < 0)
+    if nearest and len(outside) > 0:
+        index[outside] = _locate_nearest(regions, points[outside, 0], points[outside, 1])
+
+    return index
+
+
+def _first_containing(found: np.ndarray, candidates: np.ndarray, count: int) -> np.ndarray:
+    """
+    Given pairs of (point, region containing it), picks the lowest region for each of "count" points, or -1 for points in no pair.
+    """
+    index = np.full(count, -1, dtype=np.int64)
+    order = np.lexsort((candidates, found))
+    found, first = np.unique(found[order], return_index=True)
+    index[found] = candidates[order][first]
+    return index
+
+
+def _locate_by_containment(regions: GeoDataFrame | GeoSeries, longs: np.ndarray, lats: np.ndarray) -> np.ndarray:
+    """
+    Finds the position in "regions" of the region containing each point, or -1 if there is none. Points on a shared border go to the first region.
+    """
+    # The spatial index only compares bounding boxes here, and each region's cached raster mask settles the candidates
+    found, candidates = regions.sindex.query(shapely.points(longs, lats))
+    contained = RasterMaskSet(regions.geometry.values).contains_xy(candidates, longs[found], lats[found])
+    return _first_containing(found[contained], candidates[contained], len(longs))
+
+
+def _locate_nearest(regions: GeoDataFrame | GeoSeries | TileGrid, longs: np.ndarray, lats: np.ndarray) -> np.ndarray:
+    """
+    Finds the position in "regions" of the region nearest to each point, or -1 if the point has no coordinates.
+    """
+    if isinstance(regions, TileGrid):
+        # Points off the grid go to the tile of the nearest column and row
+        col = np.clip(np.searchsorted(regions.long_edges, longs, side="right") - 1, 0, regions.cols - 1)
+        row = np.clip(np.searchsorted(regions.lat_edges, lats, side="right") - 1, 0, regions.rows - 1)
+        return np.where(np.isnan(longs) | np.isnan(lats), -1, col * regions.rows + row)
+
+    index = np.full(len(longs), -1, dtype=np.int64)
+    found, nearest = regions.sindex.nearest(shapely.points(longs, lats), return_all=False)
+    index[found] = nearest
+    return index
+
+
+def _obfuscated_network_by_index(
+        regions: GeoDataFrame | GeoSeries | TileGrid,
+        network: Graph | SpatialGraph,
+        region_accessor: Callable | str | np.ndarray | None,
+        point_converter: Callable,
+        strategy: Callable,
+        fail_graceful: bool,
+        nearest_region: bool = False
+) -> Graph | SpatialGraph:
+    if isinstance(network, SpatialGraph):
+        nodes = network.nodes
+        points = np.stack([network.long, network.lat], axis=1).astype(float)
+        old_points = [tuple(point) for point in points.tolist()]
+    else:
+        nodes = list(network.nodes)
+        old_points = [point_converter(node, data) for node, data in network.nodes(data=True)]
+        points = np.array([_as_xy(point) for point in old_points], dtype=float).reshape(-1, 2)
+
+    keyed = getattr(strategy, "keyed", False)
+    if callable(region_accessor) and keyed and getattr(strategy, "needs_region", True):
+        # Nodes given equal regions are grouped, so each region is still handled in one batch. Each distinct object is only
+        # compared by value once, since accessors usually hand out the same few objects
+        given = [region_accessor(node) for node in nodes]
+        region_index = np.empty(len(given), dtype=np.int64)
+        by_id, by_value = {}, {}
+        for i, region in enumerate(given):
+            k = by_id.get(id(region))
+            if k is None:
+                k = by_id[id(region)] = by_value.setdefault(region, i)
+            region_index[i] = k
+        geometries = np.empty(len(given), dtype=object)
+        geometries[:] = given
+        new_points = np.asarray(strategy.batch(points, geometries, region_index, keys=node_keys(nodes)), dtype=float)
+    elif callable(region_accessor) and keyed:
+        # Strategies which ignore the region are given none, so the accessor is not called
+        geometries = np.array([None], dtype=object)
+        region_index = np.zeros(len(nodes), dtype=np.int64)
+        new_points = np.asarray(strategy.batch(points, geometries, region_index, keys=node_keys(nodes)), dtype=float)
+    elif callable(region_accessor):
+        new_points = np.full((len(nodes), 2), np.nan)
+        for i, node in enumerate(nodes):
+            new_point = strategy(old_points[i], region_accessor(node))
+            if new_point is not None:
+                new_points[i] = _as_xy(new_point)
+    else:
+        needs_region = getattr(strategy, "needs_region", True)
+        if needs_region:
+            geometries = regions if isinstance(regions, TileGrid) else np.asarray(regions.geometry.values, dtype=object)
+            region_index = _region_index(regions, network, region_accessor, points, nearest_region)
+        else:
+            # Strategies which ignore the region, like rand_point_by_radius, are given none, so nodes are never located
+            geometries = np.array([None], dtype=object)
+            region_index = np.zeros(len(nodes), dtype=np.int64)
+
+        if keyed:
+            new_points = np.asarray(strategy.batch(points, geometries, region_index, keys=node_keys(nodes)), dtype=float)
+            new_points[region_index < 0] = np.nan
+        elif hasattr(strategy, "batch"):
+            new_points = np.asarray(strategy.batch(points, geometries, region_index), dtype=float)
+            new_points[region_index < 0] = np.nan
+        else:
+            new_points = np.full((len(nodes), 2), np.nan)
+            for k, members in _group_by_region(region_index):
+                region = geometries[k]
+                for i in members:
+                    new_point = strategy(old_points[i], region)
+                    if new_point is not None:
+                        new_points[i] = _as_xy(new_point)
+
+    if isinstance(network, SpatialGraph):
+        failed = np.isnan(new_points).any(axis=1)
+        for i in np.flatnonzero(failed):
+            if not fail_graceful:
+                raise Exception(f"Unable to obfuscate point {nodes[i]}")
+            print(f"Unable to obfuscate point {nodes[i]}. Continuing...")
+        new_points[failed] = 0
+        return network.with_coords(new_points[:, 0], new_points[:, 1])
+
+    new_graph = Graph()
+    for i, (node, data) in enumerate(network.nodes(data=True)):
+        data = data.copy()
+        if np.isnan(new_points[i]).any():
+            if fail_graceful:
+                print(f"Unable to obfuscate point {node}. Continuing...")
+                data["long"] = 0
+                data["lat"] = 0
+            else:
+                raise Exception(f"Unable to obfuscate point {node}")
+        else:
+            data["long"] = float(new_points[i, 0])
+            data["lat"] = float(new_points[i, 1])
+        new_graph.add_node(node, **data)
+
+    new_graph.add_edges_from(network.edges(data=True))
+    return new_graph
+
+
+def long_lat_converter(node, data: dict) -> tuple[float, float]:
+    """
+    A point_converter reading the "long" and "lat" properties of a node. Being a module-level function, it can be sent to worker processes.
+    """
+    return (data["long"], data["lat"])
+
+
+def _jitter_shard(
+        regions: GeoDataFrame,
+        shard: Graph | SpatialGraph,
+        region_accessor: str,
+        point_converter: Callable,
+        strategy_factory: Callable,
+        fail_graceful: bool,
+        entropy: np.random.SeedSequence
+) -> tuple[np.ndarray, np.ndarray]:
+    # Forked workers start from copies of the parent's random state, so every shard is reseeded with its own entropy,
+    # or unkeyed strategies would give the same numbers in every shard
+    state = entropy.generate_state(4)
+    random.seed(int.from_bytes(state.tobytes(), "little"))
+    np.random.seed(state)
+    jittered = obfuscated_network(regions, shard, region_accessor, point_converter, strategy_factory(), fail_graceful)
+    _, longs, lats = _node_coords(jittered)
+    return longs, lats
+
+
+def sharded_obfuscated_network(
+        regions: GeoDataFrame,
+        network: Graph | SpatialGraph,
+        shard_attribute: str,
+        region_accessor: str,
+        strategy_factory: Callable,
+        point_converter: Callable = long_lat_converter,
+        region_shard_column: str | None = None,
+        fail_graceful: bool = True,
+        max_workers: int | None = None,
+        seed: int | None = None
+) -> Graph | SpatialGraph:
+    """
+    Obfuscates a network too large to handle in one process, by splitting it into shards that are jittered independently in worker processes. Each worker only receives the nodes and edges of its shard and the regions belonging to it, so its memory scales with the shard rather than the whole network. The results are stitched back into one graph with every original edge, including those crossing between shards.
+    Inputs:
+    - regions (geopandas.GeoDataFrame): The collection of regions of interest to the network. Must have a column telling which shard each region belongs to
+    - network (networkx.Graph | SpatialGraph): The graph containing all the metadata of the points and how they are connected to one another.
+    - shard_attribute (str): The node property to split the network by, such as a state or county FIPS code
+    - region_accessor (str): The node property holding each node's label in the index of "regions". See obfuscated_network
+    - strategy_factory (Callable): A function taking no arguments which returns a strategy, such as functools.partial(rand_point_in_region, max_iter=50). It is called once in every worker, and it must be picklable, so lambdas and nested functions cannot be used
+    - point_converter (Callable): Default long_lat_converter. See obfuscated_network. Must be picklable
+    - region_shard_column (str): Default None. The column of "regions" holding the shard of each region. If not provided, the column named after shard_attribute is used
+    - fail_graceful (bool): Default True. See obfuscated_network. Nodes without the shard property are handled as failures
+    - max_workers (int): Default None. The number of worker processes. If not provided, one per CPU is used
+    - seed (int): Default None. The seed the global random state of each shard's worker is derived from, which unkeyed strategies draw from. Every shard gets an independent state either way, and if this is not provided, it comes from fresh entropy. Keyed strategies are not affected
+    Outputs:
+    - new_graph (networkx.Graph | SpatialGraph): The new graph, of the same type as "network", with all the original data preserved, but with each node being assigned new latitude and longitude coordinates.
+    """
+    if region_shard_column is None:
+        region_shard_column = shard_attribute
+
+    nodes, _, _ = _node_coords(network)
+    if isinstance(network, SpatialGraph):
+        keys = network.node_attrs.get(shard_attribute, np.full(len(network), None)).tolist()
+    else:
+        keys = [data.get(shard_attribute) for _, data in network.nodes(data=True)]
+        position = {node: i for i, node in enumerate(nodes)}
+
+    shards = {}
+    for i, key in enumerate(keys):
+        shards.setdefault(key, []).append(i)
+
+    new_longs = np.zeros(len(nodes))
+    new_lats = np.zeros(len(nodes))
+    unsharded = shards.pop(None, [])
+    for i in unsharded:
+        if not fail_graceful:
+            raise Exception(f"Unable to obfuscate point {nodes[i]}: it has no {shard_attribute} property")
+        print(f"Unable to obfuscate point {nodes[i]}. Continuing...")
+
+    submitted = {}
+
+    def collect(future):
+        positions = submitted.pop(future)
+        new_longs[positions], new_lats[positions] = future.result()
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    shard_entropy = np.random.SeedSequence(seed).spawn(len(shards))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # Shards are submitted a few at a time, so the parent never holds every pickled shard at once
+        max_pending = 2 * max_workers
+        pending = set()
+        for (key, positions), entropy in zip(shards.items(), shard_entropy):
+            shard_regions = regions[regions[region_shard_column] == key]
+            if isinstance(network, SpatialGraph):
+                shard = network.subgraph(positions)
+            else:
+                # networkx may reorder the nodes of a subgraph, so the positions are read back from the shard
+                shard = network.subgraph([nodes[i] for i in positions]).copy()
+                positions = [position[node] for node in shard.nodes]
+
+            future = executor.submit(
+                _jitter_shard, shard_regions, shard, region_accessor, point_converter, strategy_factory, fail_graceful, entropy
+            )
+            submitted[future] = positions
+            pending.add(future)
+
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future)
+
+        for future in as_completed(pending):
+            collect(future)
+
+    if isinstance(network, SpatialGraph):
+        return network.with_coords(new_longs, new_lats)
+
+    new_graph = Graph()
+    for i, (node, data) in enumerate(network.nodes(data=True)):
+        data = data.copy()
+        data["long"], data["lat"] = float(new_longs[i]), float(new_lats[i])
+        new_graph.add_node(node, **data)
+
+    new_graph.add_edges_from(network.edges(data=True))
+    return new_graph
+
+
+@lru_cache(maxsize=64)
+def cached_transformer(from_crs, to_crs) -> Transformer:
+    """
+    Returns a transformer between two coordinate reference systems, creating it only the first time a pair is asked for. Building a pyproj Transformer is far slower than using one, so every projection in this module goes through here. Coordinates are always in (x, y), i.e. (long, lat), order.
+    Inputs:
+    - from_crs, to_crs: Anything pyproj.CRS.from_user_input accepts and which can be hashed, such as "EPSG:4326" or a pyproj.CRS
+    Outputs:
+    - transformer (pyproj.Transformer): The transformer from from_crs to to_crs
+    """
+    return Transformer.from_crs(CRS.from_user_input(from_crs), CRS.from_user_input(to_crs), always_xy=True)
+
+
+def equal_area_crs(bounds: tuple[float, float, float, float]) -> CRS:
+    """
+    A Lambert azimuthal equal-area projection in meters, centered on a longitude/latitude box. Areas are exact everywhere, and distances and directions are close to true across a state-sized area, so radii, tile sizes and edge lengths mean the same thing at every latitude.
+    Inputs:
+    - bounds (tuple[float, float, float, float]): The (min_long, min_lat, max_long, max_lat) of the area of interest, such as the bounds of a shapely geometry
+    Outputs:
+    - crs (pyproj.CRS): The projection
+    """
+    min_long, min_lat, max_long, max_lat = bounds
+    return CRS.from_proj4(
+        f"+proj=laea +lat_0={(min_lat + max_lat) / 2} +lon_0={(min_long + max_long) / 2} +x_0=0 +y_0=0 +ellps=WGS84 +units=m +no_defs"
+    )
+
+
+def project_network(network: Graph | SpatialGraph, to_crs, from_crs="EPSG:4326") -> Graph | SpatialGraph:
+    """
+    Transforms the coordinates of every node of a network to another coordinate reference system, in one batched call to a cached transformer. The "long" and "lat" properties then hold the x and y of the new system (e.g. meters east and north), so every function of this module can run on projected coordinates unchanged. Project back by swapping the two systems once the results are needed in degrees again.
+    Inputs:
+    - network (networkx.Graph | SpatialGraph): The network to project
+    - to_crs: The coordinate reference system to project to. See cached_transformer
+    - from_crs: Default "EPSG:4326". The coordinate reference system the network is in
+    Outputs:
+    - new_graph (networkx.Graph | SpatialGraph): A graph of the same type, with all the original data preserved but with projected coordinates
+    """
+    nodes, longs, lats = _node_coords(network)
+    xs, ys = cached_transformer(from_crs, to_crs).transform(longs, lats)
+
+    if isinstance(network, SpatialGraph):
+        return network.with_coords(xs, ys)
+
+    new_graph = Graph()
+    for i, (node, data) in enumerate(network.nodes(data=True)):
+        data = data.copy()
+        data["long"], data["lat"] = float(xs[i]), float(ys[i])
+        new_graph.add_node(node, **data)
+
+    new_graph.add_edges_from(network.edges(data=True))
+    return new_graph
+
+
+class TileGrid:
+    """
+    A grid of axis-aligned rectangular tiles, described by the edges of its columns and rows rather than by polygons. Tiles are numbered column by column, as in gen_region_grid_rc, and tile k spans [long_edges[k // rows], long_edges[k // rows + 1]) by [lat_edges[k % rows], lat_edges[k % rows + 1]). A TileGrid can be passed as the regions of obfuscated_network and length_preserving_network: indexing it gives the tile as a shapely Polygon, and rand_point_in_region jitters all the nodes of a grid at once, with no geometry involved.
+    Inputs:
+    - long_edges (numpy.ndarray): The increasing longitudes of the column edges
+    - lat_edges (numpy.ndarray): The increasing latitudes of the row edges
+    """
+    def __init__(self, long_edges: np.ndarray, lat_edges: np.ndarray):
+        self.long_edges = np.asarray(long_edges, dtype=float)
+        self.lat_edges = np.asarray(lat_edges, dtype=float)
+        self.cols = max(len(self.long_edges) - 1, 0)
+        self.rows = max(len(self.lat_edges) - 1, 0)
+
+    def __len__(self) -> int:
+        return self.rows * self.cols
+
+    def __getitem__(self, k: int) -> Polygon:
+        (minx,), (miny,), (maxx,), (maxy,) = self.bounds(np.array([k]))
+        return Polygon(shell=[(minx, miny), (minx, maxy), (maxx, maxy), (maxx, miny), (minx, miny)])
+
+    @property
+    def index(self) -> pd.RangeIndex:
+        """
+        Tiles are labelled by their number, like the index of the GeoSeries from regions().
+        """
+        return pd.RangeIndex(len(self))
+
+    def bounds(self, region_index: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        The (min_long, min_lat, max_long, max_lat) of each of the given tiles, as four arrays.
+        """
+        region_index = np.asarray(region_index, dtype=np.int64)
+        col = region_index // max(self.rows, 1)
+        row = region_index % max(self.rows, 1)
+        return self.long_edges[col], self.lat_edges[row], self.long_edges[col + 1], self.lat_edges[row + 1]
+
+    def locate(self, longs: np.ndarray, lats: np.ndarray) -> np.ndarray:
+        """
+        The number of the tile holding each point, or -1 for points outside the grid. Each tile holds the points with min_long <= long < max_long and min_lat <= lat < max_lat.
+        """
+        col = np.searchsorted(self.long_edges, longs, side="right") - 1
+        row = np.searchsorted(self.lat_edges, lats, side="right") - 1
+        inside = (col >= 0) & (col < self.cols) & (row >= 0) & (row < self.rows)
+        return np.where(inside, col * self.rows + row, -1)
+
+    def contains_xy(self, region_index: np.ndarray, longs: np.ndarray, lats: np.ndarray) -> np.ndarray:
+        """
+        Tests whether each point is inside the tile at its position in region_index, edges included. Points with region -1 are never inside. Matches RasterMaskSet.contains_xy.
+        """
+        region_index = np.asarray(region_index, dtype=np.int64)
+        has_region = region_index >= 0
+        minx, miny, maxx, maxy = self.bounds(np.where(has_region, region_index, 0))
+        return has_region & (minx <= longs) & (longs <= maxx) & (miny <= lats) & (lats <= maxy)
+
+    def regions(self) -> GeoSeries:
+        """
+        The tiles as a GeoSeries of Polygons, in the order of their numbers.
+        """
+        minx, miny, maxx, maxy = self.bounds(np.arange(len(self)))
+        shells = np.stack([
+            np.stack([minx, miny], axis=1), np.stack([minx, maxy], axis=1), np.stack([maxx, maxy], axis=1),
+            np.stack([maxx, miny], axis=1), np.stack([minx, miny], axis=1)
+        ], axis=1)
+        return GeoSeries(data=shapely.polygons(shells) if len(self) > 0 else [])
+
+
+def _is_box(region) -> bool:
+    """
+    Whether a geometry is an axis-aligned rectangle, such as a tile from gen_region_grid_rc.
+    """
+    if region.geom_type != "Polygon" or len(region.interiors) > 0:
+        return False
+    coords = shapely.get_coordinates(region.exterior)
+    if len(coords) != 5:
+        return False
+
+    minx, miny, maxx, maxy = region.bounds
+    corners = np.isin(coords[:, 0], (minx, maxx)) & np.isin(coords[:, 1], (miny, maxy))
+    box_area = (maxx - minx) * (maxy - miny)
+    return bool(corners.all()) and box_area > 0 and abs(region.area - box_area) <= 1e-9 * box_area
+
+
+def gen_region_grid_rc(network: Graph | SpatialGraph, rows: int, cols: int, buffer: float = 0.1, modify_network=True, as_tile_grid=False) -> GeoSeries | TileGrid:
     """
     Using points from a network, creates a bounding box surrounding all the points and divides the box into grid squares
     Inputs:
@@ -70,44 +547,34 @@ def gen_region_grid_rc(network: Graph, rows: int, cols: int, buffer: float = 0.1
     - cols: The number of columns in the final collection of regions
     - buffer (optional): Any extra space to be added around the points, as a percentage above one. Defaults to 0.1, or 10% buffer. No buffer is represented as 0
     - modify_network (optional): If true, modifies the original network so each node on the graph knows which region it is in, using the "region" field. Defaults to true
+    - as_tile_grid (optional): If true, the grid is returned as a TileGrid instead of a GeoSeries, which lets rand_point_in_region jitter every node with one vectorized transform. Defaults to false
     Outputs:
-    A GeoSeries containing each region's Polygon
+    A GeoSeries containing each region's Polygon, or the TileGrid
     """
-    nodes = {node: (data["long"], data["lat"]) for node, data in network.nodes(data=True)}
-    min_long = min([x[0] for x in nodes.values()])
-    max_long = max([x[0] for x in nodes.values()])
-    min_lat = min([x[1] for x in nodes.values()])
-    max_lat = max([x[1] for x in nodes.values()])
+    nodes, longs, lats = _node_coords(network)
+    min_long = longs.min()
+    max_long = longs.max()
+    min_lat = lats.min()
+    max_lat = lats.max()
 
     lat_buff = buffer*(max_lat - min_lat)
     long_buff = buffer*(max_long - min_long)
     # print("Latitudes", min_lat - lat_buff, max_lat + lat_buff)
     # print("Longitudes", min_long - long_buff, max_long + long_buff)
 
-    lat_pairs = list(pairwise(np.linspace(min_lat - lat_buff, max_lat + lat_buff, rows + 1)))
-    long_pairs = list(pairwise(np.linspace(min_long - long_buff, max_long + long_buff, cols + 1)))
-
-    out_regions = []
-    for nlong, xlong in long_pairs:
-        for nlat, xlat in lat_pairs:
-            out_regions.append(
-                Polygon(shell=[
-                    (nlong, nlat), (nlong, xlat), (xlong, xlat), (xlong, nlat), (nlong, nlat)
-                ])
-            )
+    lat_edges = np.linspace(min_lat - lat_buff, max_lat + lat_buff, rows + 1)
+    long_edges = np.linspace(min_long - long_buff, max_long + long_buff, cols + 1)
+    grid = TileGrid(long_edges, lat_edges)
 
-            if modify_network:
-                points_in_here = [
-                    node for node, data in nodes.items()
-                    if nlong <= data[0] < xlong and nlat <= data[1] < xlat
-                ]
-                for point in points_in_here:
-                    network.nodes[point]["region"] = len(out_regions) - 1
+    if modify_network:
+        region = grid.locate(longs, lats)
+        where = np.flatnonzero(region >= 0)
+        _set_node_property(network, nodes, "region", region[where], where)
 
-    return GeoSeries(data=out_regions)
+    return grid if as_tile_grid else grid.regions()
 
 
-def gen_region_grid_wh(network: Graph, width: float, height: float, buffer: float = 0.1, modify_network=True) -> GeoSeries:
+def gen_region_grid_wh(network: Graph | SpatialGraph, width: float, height: float, buffer: float = 0.1, modify_network=True, as_tile_grid=False) -> GeoSeries | TileGrid:
     """
     Using points from a network, creates a bounding box surrounding all the points and divides the box into grid squares
     Inputs:
@@ -116,77 +583,866 @@ def gen_region_grid_wh(network: Graph, width: float, height: float, buffer: floa
     - height: The height of each tile
     - buffer (optional): Any extra space to be added around the points, as a percentage above one. Defaults to 0.1, or 10% buffer. No buffer is represented as 0
     - modify_network (optional): If true, modifies the original network so each node on the graph knows which region it is in, using the "region" field. Defaults to true
+    - as_tile_grid (optional): If true, the grid is returned as a TileGrid instead of a GeoSeries, which lets rand_point_in_region jitter every node with one vectorized transform. Defaults to false
     Outputs:
-    A GeoSeries containing each region's Polygon
+    A GeoSeries containing each region's Polygon, or the TileGrid
     """
-    nodes = {node: (data["long"], data["lat"]) for node, data in network.nodes(data=True)}
-    min_long = min([x[0] for x in nodes.values()])
-    max_long = max([x[0] for x in nodes.values()])
-    min_lat = min([x[1] for x in nodes.values()])
-    max_lat = max([x[1] for x in nodes.values()])
+    nodes, longs, lats = _node_coords(network)
+    min_long = longs.min()
+    max_long = longs.max()
+    min_lat = lats.min()
+    max_lat = lats.max()
 
     lat_buff = buffer*(max_lat - min_lat)
     long_buff = buffer*(max_long - min_long)
     print("Latitudes", min_lat - lat_buff, max_lat + lat_buff)
     print("Longitudes", min_long - long_buff, max_long + long_buff)
 
-    lat_pairs = list(pairwise(np.arange(min_lat - lat_buff, max_lat + lat_buff, height)))
-    long_pairs = list(pairwise(np.arange(min_long, max_long, width)))
+    lat_edges = np.arange(min_lat - lat_buff, max_lat + lat_buff, height)
+    long_edges = np.arange(min_long, max_long, width)
+    grid = TileGrid(long_edges, lat_edges)
 
-    out_regions = []
-    for nlong, xlong in long_pairs:
-        for nlat, xlat in lat_pairs:
-            out_regions.append(
-                Polygon(shell=[
-                    (nlong, nlat), (nlong, xlat), (xlong, xlat), (xlong, nlat), (nlong, nlat)
-                ])
-            )
+    if modify_network:
+        region = grid.locate(longs, lats)
+        where = np.flatnonzero(region >= 0)
+        _set_node_property(network, nodes, "region", region[where], where)
 
-            if modify_network:
-                points_in_here = [
-                    node for node, data in nodes.items()
-                    if nlong <= data[0] < xlong and nlat <= data[1] < xlat
-                ]
-                for point in points_in_here:
-                    network.nodes[point]["region"] = len(out_regions) - 1
+    return grid if as_tile_grid else grid.regions()
 
-    return GeoSeries(data=out_regions)
 
+def _node_coords(network: Graph | SpatialGraph) -> tuple[list | np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Collects the nodes of a network and their "long" and "lat" properties into arrays, in the network's node order. A SpatialGraph already stores them that way, so its own arrays are returned.
+    """
+    if isinstance(network, SpatialGraph):
+        return network.nodes, network.long, network.lat
+
+    nodes = list(network.nodes)
+    longs = np.fromiter((data["long"] for _, data in network.nodes(data=True)), dtype=float, count=len(nodes))
+    lats = np.fromiter((data["lat"] for _, data in network.nodes(data=True)), dtype=float, count=len(nodes))
+    return nodes, longs, lats
+
+
+def _edge_positions(network: Graph | SpatialGraph, nodes: list | np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Finds the position in "nodes" of both ends of every edge of a network, in the network's edge order.
+    """
+    if isinstance(network, SpatialGraph):
+        return network.edge_u, network.edge_v
+
+    position = {node: i for i, node in enumerate(nodes)}
+    u = np.fromiter((position[a] for a, _ in network.edges), dtype=np.int64, count=network.number_of_edges())
+    v = np.fromiter((position[b] for _, b in network.edges), dtype=np.int64, count=network.number_of_edges())
+    return u, v
+
+
+def _set_node_property(network: Graph | SpatialGraph, nodes: list | np.ndarray, name: str, values: np.ndarray, where: np.ndarray | None = None) -> None:
+    """
+    Sets a property of the nodes at the given positions (all nodes if "where" is None), in the network's node order. On a SpatialGraph the property is a column, and nodes left out get -1 (or None, for non-integer values) if the column is new.
+    """
+    values = np.asarray(values)
+    if where is None:
+        where = np.arange(len(nodes))
+
+    if isinstance(network, SpatialGraph):
+        column = network.node_attrs.get(name)
+        if column is None:
+            column = np.full(len(nodes), -1, dtype=np.int64) if values.dtype.kind in "iu" else np.full(len(nodes), None, dtype=object)
+        elif np.can_cast(values.dtype, column.dtype, casting="same_kind"):
+            # Columns may be shared with graphs made by with_coords, so they are never changed in place
+            column = column.copy()
+        else:
+            column = column.astype(object)
+        column[where] = values
+        network.node_attrs[name] = column
+        return
+
+    for i, value in zip(where.tolist(), values.tolist()):
+        network.nodes[nodes[i]][name] = value
+
+
+class QuadTree:
+    """
+    A region quadtree over a collection of points. Starting from a bounding box, every cell holding more than max_points points is split into four equal quadrants, until each cell holds few enough points or would become smaller than min_size. The tree is stored as flat arrays, so it is built one level at a time over the whole coordinate array (O(N log N) for N points) and many points can be located at once with a vectorized descent.
+    Inputs:
+    - longs (numpy.ndarray): The longitude of each point
+    - lats (numpy.ndarray): The latitude of each point
+    - max_points (int): The largest number of points a leaf cell may hold, unless it has reached min_size
+    - min_size (float): Default 0. Cells are never split into quadrants narrower than this, in the units of the coordinates
+    - bounds (tuple[float, float, float, float]): Default None. The (min_long, min_lat, max_long, max_lat) box covered by the tree. If not provided, the bounding box of the points is used
+    - max_depth (int): Default 32. A hard limit on the number of splits, which guards against stacks of identical points when min_size is 0
+    Attributes:
+    - bounds (numpy.ndarray): Shape (cells, 4), the (min_long, min_lat, max_long, max_lat) of every cell in the tree
+    - children (numpy.ndarray): Shape (cells, 4), the index of the SW, SE, NW and NE children of every cell, or -1 for leaves
+    - leaf_region (numpy.ndarray): Shape (cells,), the region number of every leaf, or -1 for split cells
+    - point_region (numpy.ndarray): Shape (points,), the region number of every point the tree was built from
+    """
+    def __init__(
+            self,
+            longs: np.ndarray,
+            lats: np.ndarray,
+            max_points: int,
+            min_size: float = 0.0,
+            bounds: tuple[float, float, float, float] | None = None,
+            max_depth: int = 32
+    ):
+        if max_points < 1:
+            raise ValueError("A quadtree cell must be allowed to hold at least 1 point")
+
+        longs = np.asarray(longs, dtype=float)
+        lats = np.asarray(lats, dtype=float)
+        if bounds is None:
+            bounds = (longs.min(), lats.min(), longs.max(), lats.max())
+
+        cell_bounds = [np.array([bounds], dtype=float)]
+        cell_children = [np.full((1, 4), -1, dtype=np.int64)]
+        n_cells = 1
+
+        point_cell = np.zeros(len(longs), dtype=np.int64)
+        active = np.arange(len(longs))
+        for _ in range(max_depth):
+            if len(active) == 0:
+                break
+
+            all_bounds = np.concatenate(cell_bounds)
+            cells, counts = np.unique(point_cell[active], return_counts=True)
+            sizes = np.maximum(all_bounds[cells, 2] - all_bounds[cells, 0], all_bounds[cells, 3] - all_bounds[cells, 1])
+            to_split = cells[(counts > max_points) & (sizes / 2 >= min_size) & (sizes > 0)]
+            if len(to_split) == 0:
+                break
+
+            # Each split cell gets four consecutive children, in SW, SE, NW, NE order
+            first_child = n_cells + 4 * np.arange(len(to_split))
+            minx, miny, maxx, maxy = all_bounds[to_split].T
+            midx = (minx + maxx) / 2
+            midy = (miny + maxy) / 2
+            cell_bounds.append(np.stack([
+                np.stack([minx, miny, midx, midy], axis=1),
+                np.stack([midx, miny, maxx, midy], axis=1),
+                np.stack([minx, midy, midx, maxy], axis=1),
+                np.stack([midx, midy, maxx, maxy], axis=1),
+            ], axis=1).reshape(-1, 4))
+            cell_children.append(np.full((4 * len(to_split), 4), -1, dtype=np.int64))
+            n_cells += 4 * len(to_split)
+
+            all_children = np.concatenate(cell_children)
+            all_children[to_split] = first_child[:, None] + np.arange(4)
+            cell_children = [all_children]
+
+            first_child_of = np.full(n_cells, -1, dtype=np.int64)
+            first_child_of[to_split] = first_child
+            active = active[first_child_of[point_cell[active]] >= 0]
+            cells_here = point_cell[active]
+            split_index = np.searchsorted(to_split, cells_here)
+            quadrant = (longs[active] >= midx[split_index]) + 2 * (lats[active] >= midy[split_index])
+            point_cell[active] = first_child_of[cells_here] + quadrant
+
+        self.bounds = np.concatenate(cell_bounds)
+        self.children = np.concatenate(cell_children)
+
+        is_leaf = self.children[:, 0] < 0
+        self.leaf_region = np.full(len(self.bounds), -1, dtype=np.int64)
+        self.leaf_region[is_leaf] = np.arange(is_leaf.sum())
+        self.point_region = self.leaf_region[point_cell]
+
+    def __len__(self) -> int:
+        return int((self.leaf_region >= 0).sum())
+
+    def locate(self, longs: np.ndarray, lats: np.ndarray) -> np.ndarray:
+        """
+        Finds the region number of each provided point by descending the tree. Points outside the tree's bounding box are given the region number -1.
+        """
+        longs = np.asarray(longs, dtype=float)
+        lats = np.asarray(lats, dtype=float)
+        minx, miny, maxx, maxy = self.bounds[0]
+        inside = (minx <= longs) & (longs <= maxx) & (miny <= lats) & (lats <= maxy)
+
+        cell = np.zeros(len(longs), dtype=np.int64)
+        descending = np.flatnonzero(inside & (self.children[cell, 0] >= 0))
+        while len(descending) > 0:
+            here = cell[descending]
+            midx = (self.bounds[here, 0] + self.bounds[here, 2]) / 2
+            midy = (self.bounds[here, 1] + self.bounds[here, 3]) / 2
+            quadrant = (longs[descending] >= midx) + 2 * (lats[descending] >= midy)
+            cell[descending] = self.children[here, quadrant]
+            descending = descending[self.children[cell[descending], 0] >= 0]
+
+        return np.where(inside, self.leaf_region[cell], -1)
+
+    def regions(self) -> GeoSeries:
+        """
+        Returns a GeoSeries containing the Polygon of each leaf cell, indexed by region number.
+        """
+        leaves = self.bounds[self.leaf_region >= 0]
+        return GeoSeries(data=shapely.box(leaves[:, 0], leaves[:, 1], leaves[:, 2], leaves[:, 3]))
+
+
+def gen_region_quadtree(
+        network: Graph | SpatialGraph,
+        max_points: int,
+        min_size: float = 0.0,
+        buffer: float = 0.1,
+        modify_network=True
+) -> GeoSeries:
+    """
+    Using points from a network, creates a bounding box surrounding all the points and recursively divides it into quadrants, so that dense areas are covered by many small regions and sparse areas by a few large ones. See QuadTree for the splitting rule.
+    Inputs:
+    - network: The graph containing the points. Each node in the graph must have "lat" and "long" properties for geolocation
+    - max_points: The largest number of nodes a region may hold, unless it has reached min_size
+    - min_size (optional): Regions are never split into quadrants narrower than this, in the units of the coordinates. Defaults to 0
+    - buffer (optional): Any extra space to be added around the points, as a percentage above one. Defaults to 0.1, or 10% buffer. No buffer is represented as 0
+    - modify_network (optional): If true, modifies the original network so each node on the graph knows which region it is in, using the "region" field. Defaults to true
+    Outputs:
+    A GeoSeries containing each region's Polygon
+    """
+    nodes, longs, lats = _node_coords(network)
+    min_long, max_long = longs.min(), longs.max()
+    min_lat, max_lat = lats.min(), lats.max()
+
+    lat_buff = buffer*(max_lat - min_lat)
+    long_buff = buffer*(max_long - min_long)
+
+    tree = QuadTree(
+        longs, lats, max_points, min_size,
+        bounds=(min_long - long_buff, min_lat - lat_buff, max_long + long_buff, max_lat + lat_buff)
+    )
+
+    if modify_network:
+        _set_node_property(network, nodes, "region", tree.point_region)
+
+    return tree.regions()
+
+
+def hex_axial(
+        longs: np.ndarray,
+        lats: np.ndarray,
+        size: float,
+        origin: tuple[float, float] = (0.0, 0.0)
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Finds the pointy-top hexagon containing each point, using axial coordinates and cube rounding. No geometry is involved, so this is a handful of array operations regardless of how many cells the tiling has.
+    Inputs:
+    - longs (numpy.ndarray): The longitude of each point
+    - lats (numpy.ndarray): The latitude of each point
+    - size (float): The distance from the center of a hexagon to any of its corners
+    - origin (tuple[float, float]): Default (0, 0). The center of hexagon (0, 0)
+    Outputs:
+    - q, r (tuple[numpy.ndarray, numpy.ndarray]): The axial coordinates of the hexagon containing each point
+    """
+    x = (np.asarray(longs, dtype=float) - origin[0]) / size
+    y = (np.asarray(lats, dtype=float) - origin[1]) / size
+    q = sqrt(3) / 3 * x - y / 3
+    r = 2 / 3 * y
+    s = -q - r
+
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq = np.where(fix_q, -rr - rs, rq)
+    rr = np.where(fix_r, -rq - rs, rr)
+    return rq.astype(np.int64), rr.astype(np.int64)
+
+
+def _hex_polygons(q: np.ndarray, r: np.ndarray, size: float, origin: tuple[float, float]) -> np.ndarray:
+    centers_x = origin[0] + size * sqrt(3) * (q + r / 2)
+    centers_y = origin[1] + size * 1.5 * r
+    angles = np.radians(30 + 60 * np.arange(7))
+    shells = np.stack([
+        centers_x[:, None] + size * np.cos(angles),
+        centers_y[:, None] + size * np.sin(angles)
+    ], axis=2)
+    return shapely.polygons(shells)
+
+
+def gen_region_hex(
+        network: Graph | SpatialGraph,
+        size: float | None = None,
+        count: int | None = None,
+        buffer: float = 0.1,
+        modify_network=True
+) -> GeoSeries:
+    """
+    Using points from a network, creates a bounding box surrounding all the points and covers it with a tiling of pointy-top hexagons. Only hexagons containing at least one node are returned, so very fine tilings stay cheap.
+    Inputs:
+    - network: The graph containing the points. Each node in the graph must have "lat" and "long" properties for geolocation
+    - size (optional): The distance from the center of each hexagon to any of its corners
+    - count (optional): Instead of a size, the approximate number of hexagons needed to tile the whole bounding box. Exactly one of size and count must be provided
+    - buffer (optional): Any extra space to be added around the points, as a percentage above one. Defaults to 0.1, or 10% buffer. No buffer is represented as 0
+    - modify_network (optional): If true, modifies the original network so each node on the graph knows which region it is in, using the "region" field. Defaults to true
+    Outputs:
+    A GeoSeries containing each occupied region's Polygon
+    """
+    if (size is None) == (count is None):
+        raise ValueError("Exactly one of size and count must be provided")
+
+    nodes, longs, lats = _node_coords(network)
+    min_long, max_long = longs.min(), longs.max()
+    min_lat, max_lat = lats.min(), lats.max()
+
+    lat_buff = buffer*(max_lat - min_lat)
+    long_buff = buffer*(max_long - min_long)
+    origin = (min_long - long_buff, min_lat - lat_buff)
+
+    if size is None:
+        box_area = (max_long - min_long + 2*long_buff) * (max_lat - min_lat + 2*lat_buff)
+        size = sqrt(box_area / (count * 3 * sqrt(3) / 2))
+
+    q, r = hex_axial(longs, lats, size, origin)
+
+    # Number the occupied cells in order of their axial coordinates
+    r_span = r.max() - r.min() + 1
+    cell_keys = (q - q.min()) * r_span + (r - r.min())
+    _, first_seen, point_region = np.unique(cell_keys, return_index=True, return_inverse=True)
+
+    if modify_network:
+        _set_node_property(network, nodes, "region", point_region)
+
+    return GeoSeries(data=_hex_polygons(q[first_seen], r[first_seen], size, origin))
+
+
+def nearest_neighbor_edges(
+        longs: np.ndarray,
+        lats: np.ndarray,
+        nearest: int = 2,
+        extra: int = 2,
+        tolerance: float = 0.1
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Connects every point to its closest neighbors, using a KD-tree queried for all points at once. Each point is connected to its "nearest" closest neighbors, and to up to "extra" more neighbors which are no farther than (1 + tolerance) times the distance to the farthest of those. With the defaults, this is the "2 nearest plus up to 2 within 10%" rule used to build the rail network.
+    Inputs:
+    - longs (numpy.ndarray): The longitude of each point
+    - lats (numpy.ndarray): The latitude of each point
+    - nearest (int): Default 2. The number of closest neighbors every point is connected to
+    - extra (int): Default 2. The largest number of additional neighbors a point may be connected to
+    - tolerance (float): Default 0.1. How much farther than the farthest of the closest neighbors an additional neighbor may be, as a percentage above one
+    Outputs:
+    - u, v (tuple[numpy.ndarray, numpy.ndarray]): The positions of the two points of each edge, with u < v. Every edge appears once
+    - dist (numpy.ndarray): The length of each edge
+    """
+    if nearest < 1:
+        raise ValueError("Each point must be connected to at least 1 neighbor")
+
+    points = np.stack([np.asarray(longs, dtype=float), np.asarray(lats, dtype=float)], axis=1)
+    n = len(points)
+    k = min(nearest + extra + 1, n)
+    if k < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+
+    dist, idx = cKDTree(points).query(points, k=k)
+
+    # Drop each point from its own neighbors. With duplicate points, a point may not be listed first, or at all
+    is_self = idx == np.arange(n)[:, None]
+    is_self[~is_self.any(axis=1), -1] = True
+    dist = dist[~is_self].reshape(n, k - 1)
+    idx = idx[~is_self].reshape(n, k - 1)
+
+    keep = np.zeros(dist.shape, dtype=bool)
+    keep[:, :nearest] = True
+    if k - 1 > nearest:
+        threshold = (1 + tolerance) * dist[:, min(nearest, k - 1) - 1]
+        keep[:, nearest:] = dist[:, nearest:] <= threshold[:, None]
+
+    rows = np.broadcast_to(np.arange(n)[:, None], idx.shape)[keep]
+    u = np.minimum(rows, idx[keep])
+    v = np.maximum(rows, idx[keep])
+    dist = dist[keep]
+
+    _, first = np.unique(u * n + v, return_index=True)
+    return u[first], v[first], dist[first]
+
+
+def nearest_neighbor_graph(
+        longs: np.ndarray,
+        lats: np.ndarray,
+        node_ids: list | None = None,
+        nearest: int = 2,
+        extra: int = 2,
+        tolerance: float = 0.1,
+        as_spatial_graph: bool = False
+) -> Graph | SpatialGraph:
+    """
+    Builds a network from a collection of points with nearest_neighbor_edges.
+    Inputs:
+    - longs (numpy.ndarray): The longitude of each point
+    - lats (numpy.ndarray): The latitude of each point
+    - node_ids (list): Default None. The name of each point's node. If not provided, nodes are numbered from 0
+    - nearest, extra, tolerance: See nearest_neighbor_edges
+    - as_spatial_graph (bool): Default False. If true, a SpatialGraph is built straight from the arrays, without creating a Python object per node or edge
+    Outputs:
+    - network (networkx.Graph | SpatialGraph): A graph with a node for every point, with "long" and "lat" properties, and an edge with a "dist" property between neighbors
+    """
+    u, v, dist = nearest_neighbor_edges(longs, lats, nearest, extra, tolerance)
+
+    if as_spatial_graph:
+        nodes = np.arange(len(longs)) if node_ids is None else node_ids
+        return SpatialGraph(nodes, longs, lats, u, v, edge_attrs={"dist": dist})
+
+    if node_ids is None:
+        node_ids = range(len(longs))
+    node_ids = list(node_ids)
+
+    network = Graph()
+    network.add_nodes_from((node, {"lat": float(lat), "long": float(long)}) for node, long, lat in zip(node_ids, longs, lats))
+    network.add_edges_from((node_ids[a], node_ids[b], {"dist": float(d)}) for a, b, d in zip(u, v, dist))
+    return network
+
+
+class RasterMask:
+    """
+    An acceleration structure for point-in-polygon tests. The bounding box of a geometry is covered by a coarse grid of square cells, and each cell is classified once as fully inside the geometry, fully outside it, or crossed by its boundary. A point in an inside or outside cell is resolved by a single array lookup, and only points in boundary cells need an exact (prepared) GEOS test, so for typical shapes the vast majority of points never reach GEOS. Results are identical to shapely.contains_xy. Use raster_mask to get a cached mask rather than building one for every call.
+    Inputs:
+    - geometry (shapely.Polygon | shapely.MultiPolygon): The geometry to test points against
+    - resolution (int): Default 64. The number of cells along the longer side of the bounding box. Finer grids leave fewer points to GEOS but take longer to build
+    Attributes:
+    - cells (numpy.ndarray): Shape (rows, cols), the class of every cell: RasterMask.OUTSIDE, RasterMask.BOUNDARY or RasterMask.INSIDE. Row 0 is the southernmost
+    - parts (list[RasterMask]): A mask for each polygon of a MultiPolygon, built the first time it is needed. For a Polygon, this is a list holding the mask itself
+    """
+    OUTSIDE = 0
+    BOUNDARY = 1
+    INSIDE = 2
+
+    def __init__(self, geometry: Polygon | MultiPolygon, resolution: int = 64):
+        if resolution < 1:
+            raise ValueError("A raster mask must have at least 1 cell")
+
+        self.geometry = geometry
+        self.resolution = resolution
+        self._parts = None
+        shapely.prepare(geometry)
+
+        if geometry.is_empty:
+            self.origin = (0.0, 0.0)
+            self.cell_size = 1.0
+            self.cells = np.full((1, 1), self.OUTSIDE, dtype=np.int8)
+            return
+
+        minx, miny, maxx, maxy = geometry.bounds
+        self.origin = (minx, miny)
+        self.cell_size = max(maxx - minx, maxy - miny) / resolution
+        if self.cell_size == 0:
+            # A degenerate geometry has no interior, but is left to GEOS all the same
+            self.cell_size = 1.0
+            self.cells = np.full((1, 1), self.BOUNDARY, dtype=np.int8)
+            return
+
+        cols = max(1, ceil((maxx - minx) / self.cell_size))
+        rows = max(1, ceil((maxy - miny) / self.cell_size))
+        x0, y0 = np.meshgrid(minx + self.cell_size * np.arange(cols), miny + self.cell_size * np.arange(rows))
+
+        # Cells are padded slightly, so rounding when locating a point can never move it into a cell the boundary misses
+        pad = self.cell_size * 1e-6
+        boundary = geometry.boundary
+        shapely.prepare(boundary)
+        crossed = shapely.intersects(boundary, shapely.box(x0 - pad, y0 - pad, x0 + self.cell_size + pad, y0 + self.cell_size + pad))
+        center_inside = shapely.contains_xy(geometry, x0 + self.cell_size / 2, y0 + self.cell_size / 2)
+
+        self.cells = np.where(crossed, self.BOUNDARY, np.where(center_inside, self.INSIDE, self.OUTSIDE)).astype(np.int8)
+
+    @property
+    def parts(self) -> list["RasterMask"]:
+        if self._parts is None:
+            if self.geometry.geom_type == "MultiPolygon":
+                self._parts = [RasterMask(part, self.resolution) for part in self.geometry.geoms]
+            else:
+                self._parts = [self]
+        return self._parts
+
+    def classify(self, longs: np.ndarray, lats: np.ndarray) -> np.ndarray:
+        """
+        The class of the cell holding each point, with points outside the grid being RasterMask.OUTSIDE.
+        """
+        longs = np.asarray(longs, dtype=float)
+        lats = np.asarray(lats, dtype=float)
+        rows, cols = self.cells.shape
+
+        col = (longs - self.origin[0]) / self.cell_size
+        row = (lats - self.origin[1]) / self.cell_size
+        on_grid = (col >= 0) & (col <= cols) & (row >= 0) & (row <= rows)
+
+        col = np.minimum(np.where(on_grid, col, 0).astype(np.int64), cols - 1)
+        row = np.minimum(np.where(on_grid, row, 0).astype(np.int64), rows - 1)
+        return np.where(on_grid, self.cells[row, col], self.OUTSIDE)
+
+    def contains_xy(self, longs: np.ndarray, lats: np.ndarray) -> np.ndarray:
+        """
+        Tests whether each point is inside the geometry, like shapely.contains_xy.
+        """
+        longs = np.asarray(longs, dtype=float)
+        lats = np.asarray(lats, dtype=float)
+        classes = self.classify(longs, lats)
+
+        inside = classes == self.INSIDE
+        check = np.flatnonzero(classes == self.BOUNDARY)
+        if len(check) > 0:
+            inside[check] = shapely.contains_xy(self.geometry, longs[check], lats[check])
+        return inside
+
+
+_raster_masks = OrderedDict()
+
+
+def raster_mask(geometry: Polygon | MultiPolygon, resolution: int = 64, max_cached: int = 4096) -> RasterMask:
+    """
+    Returns the RasterMask of a geometry, building it only the first time it is asked for. Masks are cached by the identity of the geometry object, so the geometries of a GeoSeries or GeoDataFrame get their masks reused across calls and trials. Once more than max_cached masks are held, the least recently used ones are dropped.
+    Inputs:
+    - geometry (shapely.Polygon | shapely.MultiPolygon): The geometry to test points against
+    - resolution (int): Default 64. See RasterMask
+    - max_cached (int): Default 4096. The largest number of masks kept
+    Outputs:
+    - mask (RasterMask): The mask of the geometry
+    """
+    key = (id(geometry), resolution)
+    mask = _raster_masks.get(key)
+    # The mask holds on to its geometry, so the id cannot have been reused by another object while it is cached
+    if mask is not None and mask.geometry is geometry:
+        _raster_masks.move_to_end(key)
+        return mask
+
+    mask = RasterMask(geometry, resolution)
+    _raster_masks[key] = mask
+    while len(_raster_masks) > max_cached:
+        _raster_masks.popitem(last=False)
+    return mask
 
-def filter_network_by_region(network: Graph, raw_region: Polygon | MultiPolygon) -> Graph:
-    if raw_region.geom_type == "MultiPolygon":
-        regions = [polygon for polygon in raw_region.geoms]
-    else:
-        regions = [raw_region]
+
+class RasterMaskSet:
+    """
+    The raster masks of a whole collection of regions, stacked into flat arrays so that points can be tested against a different region each in a single vectorized pass, with no loop over the regions. Points in boundary cells are settled by one vectorized GEOS call over all their regions.
+    Inputs:
+    - geometries (numpy.ndarray): The regions, such as regions.geometry.values
+    - resolution (int): Default 64. See RasterMask
+    """
+    def __init__(self, geometries: np.ndarray, resolution: int = 64):
+        self.geometries = np.asarray(geometries, dtype=object)
+        masks = [raster_mask(geometry, resolution) for geometry in self.geometries]
+
+        self.origin_x = np.array([mask.origin[0] for mask in masks], dtype=float)
+        self.origin_y = np.array([mask.origin[1] for mask in masks], dtype=float)
+        self.cell_size = np.array([mask.cell_size for mask in masks], dtype=float)
+        self.rows = np.array([mask.cells.shape[0] for mask in masks], dtype=np.int64)
+        self.cols = np.array([mask.cells.shape[1] for mask in masks], dtype=np.int64)
+        self.offset = np.r_[0, np.cumsum(self.rows * self.cols)[:-1]].astype(np.int64)
+        self.cells = np.concatenate([mask.cells.ravel() for mask in masks]) if masks else np.empty(0, dtype=np.int8)
+
+    def contains_xy(self, region_index: np.ndarray, longs: np.ndarray, lats: np.ndarray) -> np.ndarray:
+        """
+        Tests whether each point is inside the region at its position in region_index. Points with region -1 are never inside.
+        """
+        region_index = np.asarray(region_index, dtype=np.int64)
+        longs = np.asarray(longs, dtype=float)
+        lats = np.asarray(lats, dtype=float)
+        inside = np.zeros(len(region_index), dtype=bool)
+        has_region = np.flatnonzero(region_index >= 0)
+        k = region_index[has_region]
+
+        col = (longs[has_region] - self.origin_x[k]) / self.cell_size[k]
+        row = (lats[has_region] - self.origin_y[k]) / self.cell_size[k]
+        on_grid = (col >= 0) & (col <= self.cols[k]) & (row >= 0) & (row <= self.rows[k])
+        col = np.minimum(np.where(on_grid, col, 0).astype(np.int64), self.cols[k] - 1)
+        row = np.minimum(np.where(on_grid, row, 0).astype(np.int64), self.rows[k] - 1)
+        classes = np.where(on_grid, self.cells[self.offset[k] + row * self.cols[k] + col], RasterMask.OUTSIDE)
+
+        inside[has_region] = classes == RasterMask.INSIDE
+        check = has_region[classes == RasterMask.BOUNDARY]
+        if len(check) > 0:
+            inside[check] = shapely.contains_xy(self.geometries[region_index[check]], longs[check], lats[check])
+        return inside
+
+
+class AliasTable:
+    """
+    A table for drawing indices in proportion to a fixed set of weights in constant time per draw, no matter how many weights there are (Walker's alias method, built with Vose's algorithm). Each index is given a column of equal probability, holding the index itself with probability "probability" and its "alias" otherwise, so a draw takes a single uniform number: its integer part picks a column, and its fractional part picks between the column's two indices. Building the table takes linear time, so it is meant to be built once (e.g. per region) and drawn from many times.
+    Inputs:
+    - weights (array-like): The non-negative weight of each index. Indices of weight 0 are never drawn
+    Attributes:
+    - outcomes (numpy.ndarray): The indices of positive weight, which are the only ones ever drawn
+    - probability (numpy.ndarray): For each column, the probability of drawing its own outcome
+    - alias (numpy.ndarray): For each column, the position in outcomes of the other outcome it holds
+    """
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=float).ravel()
+        if len(weights) == 0 or not np.all(np.isfinite(weights)) or np.any(weights < 0):
+            raise ValueError("The weights of an alias table must be finite and non-negative, with at least one of them")
+        self.outcomes = np.flatnonzero(weights > 0)
+        if len(self.outcomes) == 0:
+            raise ValueError("The weights of an alias table cannot all be 0")
+
+        n = len(self.outcomes)
+        scaled = (weights[self.outcomes] * (n / weights[self.outcomes].sum())).tolist()
+        probability = [1.0] * n
+        alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            s, l = small.pop(), large[-1]
+            probability[s] = scaled[s]
+            alias[s] = l
+            scaled[l] -= 1 - scaled[s]
+            if scaled[l] < 1:
+                small.append(large.pop())
+        # Whatever is left is 1 up to rounding, and keeps its own column
+
+        self.probability = np.array(probability)
+        self.alias = np.array(alias, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.outcomes)
+
+    def sample(self, u: np.ndarray) -> np.ndarray:
+        """
+        Turns uniform numbers in [0, 1), such as those from keyed_uniform, into drawn indices, one per number.
+        """
+        scaled = np.asarray(u, dtype=float) * len(self.outcomes)
+        column = np.minimum(scaled.astype(np.int64), len(self.outcomes) - 1)
+        keep = (scaled - column) < self.probability[column]
+        return self.outcomes[np.where(keep, column, self.alias[column])]
+
+
+class RegionHierarchy:
+    """
+    Nested levels of regions, such as states, counties and census tracts, where every region of a level is indexed under the region of the level above that contains it. Points are located by descending the levels: once a point's region is known at one level, only the children of that region are tested at the next, through a small spatial index over just those children, so each point needs only a few containment tests per level no matter how many regions the finest level holds. Jitter can then target any level (see obfuscated_network).
+    Inputs:
+    - levels (list[geopandas.GeoDataFrame | geopandas.GeoSeries]): The regions of each level, from the coarsest to the finest
+    - names (list[str]): Default None. The name of each level, such as ["state", "county", "tract"]. If not provided, the levels are named "level0", "level1"...
+    - parents (list[str | numpy.ndarray | None]): Default None. For each level after the first, how its regions are matched to their parents: the name of a column holding the label of each region's parent in the index of the level above, or an array holding the position of each region's parent. Levels given None (or all of them, if parents is not provided) are matched by locating a point inside each region, from shapely.point_on_surface, in the level above
+    - resolution (int): Default None. If provided, containment is tested with raster masks of this resolution (see RasterMask) instead of prepared geometries. Masks take a few milliseconds per region to build, so they only pay off for levels of few, detailed regions holding many points
+    Attributes:
+    - parent (list[numpy.ndarray]): For each level, the position of every region's parent in the level above, or -1 for regions with no parent. All -1 for the first level
+    """
+    def __init__(
+            self,
+            levels: list[GeoDataFrame | GeoSeries],
+            names: list[str] | None = None,
+            parents: list[str | np.ndarray | None] | None = None,
+            resolution: int | None = None
+    ):
+        if len(levels) == 0:
+            raise ValueError("A region hierarchy needs at least one level")
+        names = names if names is not None else [f"level{i}" for i in range(len(levels))]
+        if len(names) != len(levels):
+            raise ValueError(f"Got {len(levels)} levels but {len(names)} names")
+        parents = parents if parents is not None else [None] * (len(levels) - 1)
+        if len(parents) != len(levels) - 1:
+            raise ValueError(f"Expected parents for {len(levels) - 1} levels, got {len(parents)}")
+
+        self.levels = list(levels)
+        self.names = list(names)
+        self.resolution = resolution
+        self._geometries = [np.asarray(regions.geometry.values, dtype=object) for regions in self.levels]
+        self._masks = {}
+        self._trees = {}
+
+        self.parent = [np.full(len(levels[0]), -1, dtype=np.int64)]
+        for level, given in enumerate(parents, start=1):
+            regions = self.levels[level]
+            if given is None:
+                inner = shapely.point_on_surface(self._geometries[level])
+                parent = self._locate_in_level(level - 1, shapely.get_x(inner), shapely.get_y(inner))
+            elif isinstance(given, str):
+                parent = np.asarray(self.levels[level - 1].index.get_indexer(regions[given]), dtype=np.int64)
+            else:
+                parent = np.asarray(given, dtype=np.int64)
+                if len(parent) != len(regions):
+                    raise ValueError(f"Expected {len(regions)} parent positions for level {self.names[level]}, got {len(parent)}")
+            self.parent.append(parent)
+
+        # The children of every region, as CSR arrays over the next level: children[level][child_ptr[level][k]:child_ptr[level][k + 1]]
+        self.child_ptr = []
+        self.children = []
+        for level in range(len(levels) - 1):
+            parent = self.parent[level + 1]
+            has_parent = np.flatnonzero(parent >= 0)
+            self.children.append(has_parent[np.argsort(parent[has_parent], kind="stable")])
+            ptr = np.zeros(len(levels[level]) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(parent[has_parent], minlength=len(levels[level])), out=ptr[1:])
+            self.child_ptr.append(ptr)
+
+    def __len__(self) -> int:
+        return len(self.levels)
+
+    def __getitem__(self, level: int | str) -> GeoDataFrame | GeoSeries:
+        return self.levels[self.level_number(level)]
+
+    def level_number(self, level: int | str) -> int:
+        """
+        The number of a level given by name or number, counting from 0 for the coarsest. Negative numbers count from the finest, as in lists.
+        """
+        if isinstance(level, str):
+            if level not in self.names:
+                raise KeyError(f"No level named {level}. Levels are {self.names}")
+            return self.names.index(level)
+        if not -len(self.levels) <= level < len(self.levels):
+            raise IndexError(f"Level {level} is out of range for a hierarchy of {len(self.levels)} levels")
+        return level % len(self.levels)
+
+    def children_of(self, level: int | str, k: int) -> np.ndarray:
+        """
+        The positions, in the next level, of the children of the region at position k of a level.
+        """
+        level = self.level_number(level)
+        if level == len(self.levels) - 1:
+            return np.empty(0, dtype=np.int64)
+        return self.children[level][self.child_ptr[level][k]:self.child_ptr[level][k + 1]]
+
+    def _contains(self, level: int, candidates: np.ndarray, longs: np.ndarray, lats: np.ndarray) -> np.ndarray:
+        if self.resolution is not None:
+            if level not in self._masks:
+                self._masks[level] = RasterMaskSet(self._geometries[level], self.resolution)
+            return self._masks[level].contains_xy(candidates, longs, lats)
+
+        if level not in self._masks:
+            shapely.prepare(self._geometries[level])
+            self._masks[level] = None
+        return shapely.contains_xy(self._geometries[level][candidates], longs, lats)
+
+    def _locate_in_level(self, level: int, longs: np.ndarray, lats: np.ndarray, points: np.ndarray | None = None) -> np.ndarray:
+        found, candidates = self.levels[level].sindex.query(points if points is not None else shapely.points(longs, lats))
+        contained = self._contains(level, candidates, longs[found], lats[found])
+        return _first_containing(found[contained], candidates[contained], len(longs))
+
+    def _children_tree(self, level: int, k: int) -> tuple[shapely.STRtree, np.ndarray]:
+        if (level, k) not in self._trees:
+            children = self.children_of(level, k)
+            self._trees[level, k] = shapely.STRtree(self._geometries[level + 1][children]), children
+        return self._trees[level, k]
+
+    def locate(self, longs: np.ndarray, lats: np.ndarray, level: int | str = -1) -> np.ndarray:
+        """
+        Finds the region containing each point at every level, down to the given one. The first level is searched as a whole, and each following level only among the children of the region found above. Points on a shared border go to the first region.
+        Inputs:
+        - longs, lats (numpy.ndarray): The coordinates of the points
+        - level (int | str): Default -1. The finest level to descend to
+        Outputs:
+        - index (numpy.ndarray): Shape (points, levels), the position of each point's region at each level, or -1 where no region contains it
+        """
+        longs = np.asarray(longs, dtype=float)
+        lats = np.asarray(lats, dtype=float)
+        depth = self.level_number(level) + 1
+        index = np.full((len(longs), depth), -1, dtype=np.int64)
+        points = shapely.points(longs, lats)
+        index[:, 0] = self._locate_in_level(0, longs, lats, points)
+
+        for level in range(1, depth):
+            found_all, candidates_all = [], []
+            for k, members in _group_by_region(index[:, level - 1]):
+                tree, children = self._children_tree(level - 1, k)
+                if len(children) == 0:
+                    continue
+                found, candidates = tree.query(points[members])
+                found_all.append(members[found])
+                candidates_all.append(children[candidates])
+
+            if found_all:
+                found, candidates = np.concatenate(found_all), np.concatenate(candidates_all)
+                contained = self._contains(level, candidates, longs[found], lats[found])
+                index[:, level] = _first_containing(found[contained], candidates[contained], len(longs))
+        return index
+
+    def assign(self, network: Graph | SpatialGraph, level: int | str = -1, modify_network: bool = True) -> np.ndarray:
+        """
+        Locates every node of a network at every level, down to the given one, from its "long" and "lat" properties.
+        Inputs:
+        - network (networkx.Graph | SpatialGraph): The network to locate
+        - level (int | str): Default -1. The finest level to descend to
+        - modify_network (bool): Default True. If true, each node is given one property per level, named after the level, holding the label (in the index of that level) of its region there. Nodes outside every region of a level are left without that property
+        Outputs:
+        - index (numpy.ndarray): See RegionHierarchy.locate
+        """
+        nodes, longs, lats = _node_coords(network)
+        index = self.locate(longs, lats, level)
+        if modify_network:
+            for depth in range(index.shape[1]):
+                found = np.flatnonzero(index[:, depth] >= 0)
+                labels = self.levels[depth].index.to_numpy()[index[found, depth]]
+                _set_node_property(network, nodes, self.names[depth], labels, where=found)
+        return index
+
+
+def filter_network_by_region(network: Graph | SpatialGraph, raw_region: Polygon | MultiPolygon) -> Graph | SpatialGraph:
+    nodes, longs, lats = _node_coords(network)
+    inside = np.zeros(len(nodes), dtype=bool)
+    for mask in raster_mask(raw_region).parts:
+        inside |= mask.contains_xy(longs, lats)
+
+    if isinstance(network, SpatialGraph):
+        new_network = network.subgraph(inside)
+        return new_network.subgraph(new_network.degree() > 0)
 
     new_network = Graph()
-    for region in regions:
-        for node, data in network.nodes(data=True):
-            if region.contains(Point(data["long"], data["lat"])):
-                new_network.add_node(node)
-                for key, value in data.items():
-                    new_network.nodes[node][key] = value
-
-        for u, v, data in network.edges(data=True):
-            if u in new_network.nodes and v in new_network.nodes:
-                new_network.add_edge(u, v)
-                for key, value in data.items():
-                    new_network.edges[u, v][key] = value
-
-    orphans = list()
-    for node in new_network.nodes:
-        if len(list(new_network.neighbors(node))) == 0:
-            orphans.append(node)
+    new_network.add_nodes_from((nodes[i], network.nodes[nodes[i]]) for i in np.flatnonzero(inside))
+    new_network.add_edges_from(
+        (u, v, data) for u, v, data in network.edges(data=True)
+        if u in new_network and v in new_network
+    )
 
+    orphans = [node for node in new_network.nodes if len(new_network[node]) == 0]
     new_network.remove_nodes_from(orphans)
 
     return new_network
 
 
+_UINT64 = 2**64 - 1
+
+
+def _splitmix64(x: np.ndarray) -> np.ndarray:
+    with np.errstate(over="ignore"):
+        z = np.asarray(x, dtype=np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+def node_keys(nodes: list | np.ndarray) -> np.ndarray:
+    """
+    Turns node ids into 64-bit keys for keyed_uniform. Integer ids are used as they are, and other ids are hashed from their string form with BLAKE2, so the keys are the same in every process and every run (unlike Python's hash).
+    Inputs:
+    - nodes (list | numpy.ndarray): The node ids
+    Outputs:
+    - keys (numpy.ndarray): One uint64 key per node
+    """
+    if isinstance(nodes, np.ndarray) and nodes.dtype.kind == "u":
+        return nodes.astype(np.uint64)
+    if isinstance(nodes, np.ndarray) and nodes.dtype.kind == "i":
+        return nodes.astype(np.int64).view(np.uint64)
+
+    return np.fromiter(
+        (
+            int(node) & _UINT64 if isinstance(node, (int, np.integer)) and not isinstance(node, bool)
+            else int.from_bytes(hashlib.blake2b(str(node).encode(), digest_size=8).digest(), "little")
+            for node in nodes
+        ),
+        dtype=np.uint64, count=len(nodes)
+    )
+
+
+def keyed_uniform(seed: int, keys: np.ndarray, realization: int, counter: int) -> np.ndarray:
+    """
+    A counter-based random number generator: returns, for every key, a uniform number in (0, 1) which depends only on (seed, key, realization, counter). Nothing is carried from one call to the next, so the numbers of any node can be drawn in any process and in any order with identical results. Each stage is a SplitMix64 finalizer, which is statistically sound for this use and fully vectorized.
+    Inputs:
+    - seed (int): The seed of the whole run
+    - keys (numpy.ndarray): The key of each stream, usually from node_keys
+    - realization (int): The number of the realization (e.g. the trial), so the same run can produce independent jitters of the same network
+    - counter (int): The position of the number in each stream
+    Outputs:
+    - u (numpy.ndarray): One number per key
+    """
+    state = _splitmix64(np.asarray(keys, dtype=np.uint64) ^ _splitmix64(np.uint64(seed & _UINT64)))
+    state = _splitmix64(state ^ _splitmix64(np.uint64(realization & _UINT64)))
+    state = _splitmix64(state ^ np.uint64(counter & _UINT64))
+    return ((state >> np.uint64(11)).astype(np.float64) + 0.5) * 2.0**-53
+
+
 # Will eventually be put in strategies.py
 def rand_point_in_region(
         distribution=stat.uniform,
-        max_iter: int = 50
+        max_iter: int = 50,
+        seed: int | None = None,
+        realization: int = 0,
+        part_weights: str | Callable = "area",
+        density: Callable | None = None,
+        max_cached_tables: int = 4096
 ) -> Callable:
     """
     Constructs a function which accepts a point and a region, which returns a random point in the region. The provided point is discarded. This is meant to bind into the obfuscate_network function as an available strategy, which is why it needs to be able to accept a point.
@@ -194,9 +1450,85 @@ def rand_point_in_region(
     Inputs:
     - distribution (scipy.stats.rv_generic): A probability distribution, which will be used in the returned function to generate a point
     - max_iter (int): Default 50. The number of times the returned function will attempt to find a point in the region provided to it. If it cannot find a point in time, it will return None.
+    - seed (int): Default None. If provided, the batch function runs in keyed mode: every random number a node uses is drawn with keyed_uniform from (seed, node id, realization), instead of from the global random state. A node then gets the same new point no matter which other nodes are jittered with it, in which order, or in which process, so networks can be split across workers or jittered incrementally without shipping any random state around. The per-point function is unaffected
+    - realization (int): Default 0. In keyed mode, the number of the realization, so that e.g. every trial gets an independent jitter
+    - part_weights (str | Callable): Default "area". How the polygon of a MultiPolygon a point goes in is chosen: "area" weighs each polygon by its area, so the points are spread evenly over the whole region, "equal" gives every polygon the same chance (which crowds points onto small islands), and a function taking the MultiPolygon and returning one non-negative weight per polygon (e.g. their populations) weighs them by whatever it returns
+    - density (Callable): Default None. If provided, points are placed in proportion to a density, such as population or a land mask, rather than uniformly. It is a function taking arrays of longitudes and latitudes and returning the non-negative density at each point, and is evaluated once per region, at the center of each cell of the region's RasterMask, so it is treated as constant within a cell. A point then goes in a cell drawn in proportion to its density, at a uniform position in it, and is redrawn if that position falls outside the region. The distribution and part_weights are not used for such points, and the points of regions where the density is 0 everywhere are placed as if no density was given
+    - max_cached_tables (int): Default 4096. The largest number of regions whose alias tables (see below) are kept
     Outputs:
     - point_gen (Callable[shapely.Point, shapely.Polygon | shapely.MultiPolygon -> shapely.Point]): A function which expects a point and a region, which (when called) outputs a random point in the region.
+    Polygons of a MultiPolygon and cells of a density are drawn from an AliasTable, which is built the first time a region is seen and cached by the identity of the region object (like raster_mask), so every draw takes constant time however many polygons or cells a region has, and weighted placement costs no more than uniform placement.
+    Axis-aligned rectangles, such as grid tiles, are detected and sampled in closed form, without any containment test. Every point of the rectangle, edges included, can be drawn.
+    The returned function also has a "batch" attribute, which accepts an (N, 2) array of points, an array of regions (or a TileGrid) and the position of each point's region in that array, and returns an (N, 2) array of new points. Points sharing a region are generated together, with the containment tests done for all of them at once. With a TileGrid, all points are generated at once. In keyed mode, it also accepts the node_keys of the points as "keys", and the returned function has a true "keyed" attribute. Its "needs_region" attribute is true, so obfuscated_network fails nodes without a region.
     """
+    # In keyed mode, the counters of each node's stream are used as follows
+    part_counter = 0
+    candidate_counter = 1
+    triangle_counter = 1 + 2 * max_iter
+    density_counter = triangle_counter + 3
+
+    if part_weights not in ("area", "equal") and not callable(part_weights):
+        raise ValueError(f"part_weights must be \"area\", \"equal\" or a function, got {part_weights}")
+    tables = OrderedDict()
+
+    def _cached_table(region, kind: str, build: Callable) -> AliasTable | None:
+        key = (id(region), kind)
+        cached = tables.get(key)
+        # As in raster_mask, holding on to the region means its id cannot have been reused while it is cached
+        if cached is not None and cached[0] is region:
+            tables.move_to_end(key)
+            return cached[1]
+
+        table = build()
+        tables[key] = (region, table)
+        while len(tables) > max_cached_tables:
+            tables.popitem(last=False)
+        return table
+
+    def _build_part_table(region: MultiPolygon) -> AliasTable:
+        parts = shapely.get_parts(region)
+        if part_weights == "area":
+            weights = shapely.area(parts)
+        elif part_weights == "equal":
+            weights = np.ones(len(parts))
+        else:
+            weights = np.asarray(part_weights(region), dtype=float)
+            if weights.shape != (len(parts),):
+                raise ValueError(f"part_weights returned {weights.shape} weights for a MultiPolygon of {len(parts)} polygons")
+        if not np.any(weights > 0):
+            print("Every polygon of a MultiPolygon has weight 0. Choosing between them equally")
+            weights = np.ones(len(parts))
+        return AliasTable(weights)
+
+    def _build_cell_table(mask: RasterMask) -> AliasTable | None:
+        rows, cols = mask.cells.shape
+        longs, lats = np.meshgrid(
+            mask.origin[0] + mask.cell_size * (np.arange(cols) + 0.5),
+            mask.origin[1] + mask.cell_size * (np.arange(rows) + 0.5)
+        )
+        weights = np.asarray(density(longs.ravel(), lats.ravel()), dtype=float)
+        weights = np.where(mask.cells.ravel() != RasterMask.OUTSIDE, weights, 0.0)
+        if not np.any(weights > 0):
+            print("The density is 0 everywhere in a region. Placing its points uniformly")
+            return None
+        return AliasTable(weights)
+
+    # Rejection sampling in a rectangle keeps the draws falling in it, so rectangles are sampled in closed form from the
+    # distribution truncated to [0, 1]. If the distribution has no mass there, they are left to the general algorithm
+    low, high = distribution.cdf(0), distribution.cdf(1)
+    box_fast_path = high > low
+
+    def _points_in_boxes(minx, miny, maxx, maxy, keys: np.ndarray | None = None) -> np.ndarray:
+        n = len(minx)
+        if keys is None:
+            ux, uy = np.random.random(n), np.random.random(n)
+        else:
+            ux = keyed_uniform(seed, keys, realization, candidate_counter)
+            uy = keyed_uniform(seed, keys, realization, candidate_counter + 1)
+        x = minx + (maxx - minx) * distribution.ppf(low + (high - low) * ux)
+        y = miny + (maxy - miny) * distribution.ppf(low + (high - low) * uy)
+        return np.stack([x, y], axis=1)
+
     def _rand_point_in_triangle(triangle):
         a, b, c = triangle
         r1 = random.random()
@@ -210,17 +1542,39 @@ def rand_point_in_region(
     def _triangle_area(a, b, c):
         return 0.5 * np.abs(np.cross(b - a, c - a))
 
+    def _triangulation(focused_region):
+        coords = np.array(focused_region.exterior.coords)
+        segments = [(i, (i+1) % len(coords)) for i in range(len(coords))]
+
+        triangulated = tri.triangulate({"vertices": coords, "segments": segments}, 'q')
+
+        try:
+            tris = [triangulated['vertices'][triangle] for triangle in triangulated['triangles']]
+        except Exception as e:
+            print(triangulated)
+            exit(1)
+        areas = [_triangle_area(*triangle) for triangle in tris]
+        area_sum = sum(areas)
+        weights = [a / area_sum for a in areas]
+        return tris, weights
+
     def point_gen(point: Point, region: Polygon | MultiPolygon) -> Point:
+        if density is not None:
+            found, pending = _points_by_density(region, 1)
+            if len(pending) == 0:
+                return Point(found[0])
+
         if region.geom_type == "MultiPolygon":
-            # TODO: It's possible there are better ways to choose the region than this. Will likely modify the behavior of the distribution
-            # The first place this comes to mind would be where different sub-polygons have different areas. This would treat them all equally, giving outsized representation to smaller regions
-            focused_region = random.choice(region.geoms)
+            table = _cached_table(region, "parts", lambda: _build_part_table(region))
+            focused_region = region.geoms[int(table.sample(np.array([random.random()]))[0])]
         elif region.geom_type == "Polygon":
             focused_region = region
         else:
             raise TypeError(f"Cannot find a random point in object of type {type(region)}")
 
         minx, miny, maxx, maxy = focused_region.bounds
+        if box_fast_path and _is_box(focused_region):
+            return Point(_points_in_boxes(np.array([minx]), np.array([miny]), np.array([maxx]), np.array([maxy]))[0])
 
         for _ in range(max_iter):
             cpx = distribution.rvs(loc=minx, scale=maxx - minx)
@@ -233,29 +1587,137 @@ def rand_point_in_region(
         # If the loop proceeds past this point, we use the slower solution that is guaranteed to converge
 
         print("Iterations exceeded. Proceeding to triangulation algorithm")
-        coords = np.array(focused_region.exterior.coords)
-        segments = [(i, (i+1) % len(coords)) for i in range(len(coords))]
-
-        triangulated = tri.triangulate({"vertices": coords, "segments": segments}, 'q')
-
-        try:
-            tris = [triangulated['vertices'][triangle] for triangle in triangulated['triangles']]
-        except Exception as e:
-            print(triangulated)
-            exit(1)
-        areas = [_triangle_area(*triangle) for triangle in tris]
-        area_sum = sum(areas)
-        weights = [a / area_sum for a in areas]
+        tris, weights = _triangulation(focused_region)
 
         chosen_tri = random.choices(tris, weights=weights, k=1)[0]
         return _rand_point_in_triangle(chosen_tri)
 
+    def _keyed_points_in_triangles(tris: list, weights: list, keys: np.ndarray) -> np.ndarray:
+        cumulative = np.cumsum(weights)
+        u = keyed_uniform(seed, keys, realization, triangle_counter)
+        chosen = np.minimum(np.searchsorted(cumulative, u * cumulative[-1]), len(cumulative) - 1)
+        a, b, c = np.array(tris)[chosen].transpose(1, 0, 2)
+
+        sqrt_r1 = np.sqrt(keyed_uniform(seed, keys, realization, triangle_counter + 1))[:, None]
+        r2 = keyed_uniform(seed, keys, realization, triangle_counter + 2)[:, None]
+        return (1 - sqrt_r1)*a + sqrt_r1*(1 - r2)*b + sqrt_r1*r2*c
+
+    def _points_in_polygon(mask: RasterMask, n: int, keys: np.ndarray | None = None) -> np.ndarray:
+        focused_region = mask.geometry
+        minx, miny, maxx, maxy = focused_region.bounds
+
+        found = np.empty((n, 2))
+        pending = np.arange(n)
+        for attempt in range(max_iter):
+            if keys is None:
+                cpx = distribution.rvs(loc=minx, scale=maxx - minx, size=len(pending))
+                cpy = distribution.rvs(loc=miny, scale=maxy - miny, size=len(pending))
+            else:
+                counter = candidate_counter + 2 * attempt
+                cpx = distribution.ppf(keyed_uniform(seed, keys[pending], realization, counter), loc=minx, scale=maxx - minx)
+                cpy = distribution.ppf(keyed_uniform(seed, keys[pending], realization, counter + 1), loc=miny, scale=maxy - miny)
+            inside = mask.contains_xy(cpx, cpy)
+
+            found[pending[inside], 0] = cpx[inside]
+            found[pending[inside], 1] = cpy[inside]
+            pending = pending[~inside]
+            if len(pending) == 0:
+                return found
+
+        print(f"Iterations exceeded for {len(pending)} points. Proceeding to triangulation algorithm")
+        tris, weights = _triangulation(focused_region)
+        if keys is not None:
+            found[pending] = _keyed_points_in_triangles(tris, weights, keys[pending])
+            return found
+
+        for i, chosen_tri in zip(pending, random.choices(tris, weights=weights, k=len(pending))):
+            found[i] = _as_xy(_rand_point_in_triangle(chosen_tri))
+        return found
+
+    def _points_by_density(region: Polygon | MultiPolygon, n: int, keys: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+        mask = raster_mask(region)
+        table = _cached_table(region, "density", lambda: _build_cell_table(mask))
+        found = np.full((n, 2), np.nan)
+        pending = np.arange(n)
+        if table is None:
+            return found, pending
+
+        cols = mask.cells.shape[1]
+        for attempt in range(max_iter):
+            if keys is None:
+                u, ux, uy = np.random.random((3, len(pending)))
+            else:
+                counter = density_counter + 3 * attempt
+                u, ux, uy = (keyed_uniform(seed, keys[pending], realization, counter + i) for i in range(3))
+            row, col = np.divmod(table.sample(u), cols)
+            cpx = mask.origin[0] + mask.cell_size * (col + ux)
+            cpy = mask.origin[1] + mask.cell_size * (row + uy)
+            inside = mask.contains_xy(cpx, cpy)
+
+            found[pending[inside], 0] = cpx[inside]
+            found[pending[inside], 1] = cpy[inside]
+            pending = pending[~inside]
+            if len(pending) == 0:
+                break
+        else:
+            print(f"Iterations exceeded for {len(pending)} points. Placing them uniformly")
+        return found, pending
+
+    def batch(points: np.ndarray, regions: np.ndarray, region_index: np.ndarray, keys: np.ndarray | None = None) -> np.ndarray:
+        if seed is not None and keys is None:
+            raise ValueError("A keyed strategy needs the keys of the points")
+        if seed is None:
+            keys = None
+
+        new_points = np.full((len(points), 2), np.nan)
+        if box_fast_path and density is None and isinstance(regions, TileGrid):
+            has_region = np.flatnonzero(region_index >= 0)
+            new_points[has_region] = _points_in_boxes(*regions.bounds(region_index[has_region]), None if keys is None else keys[has_region])
+            return new_points
+
+        for k, members in _group_by_region(region_index):
+            region = regions[k]
+            if density is not None:
+                new_points[members], pending = _points_by_density(region, len(members), None if keys is None else keys[members])
+                members = members[pending]
+                if len(members) == 0:
+                    continue
+
+            if box_fast_path and _is_box(region):
+                minx, miny, maxx, maxy = (np.full(len(members), bound) for bound in region.bounds)
+                new_points[members] = _points_in_boxes(minx, miny, maxx, maxy, None if keys is None else keys[members])
+                continue
+
+            if region.geom_type == "MultiPolygon":
+                parts = raster_mask(region).parts
+                table = _cached_table(region, "parts", lambda: _build_part_table(region))
+                if keys is None:
+                    chosen_parts = table.sample(np.random.random(len(members)))
+                else:
+                    chosen_parts = table.sample(keyed_uniform(seed, keys[members], realization, part_counter))
+            elif region.geom_type == "Polygon":
+                parts = [raster_mask(region)]
+                chosen_parts = np.zeros(len(members), dtype=np.int64)
+            else:
+                raise TypeError(f"Cannot find a random point in object of type {type(region)}")
+
+            for part, part_members in _group_by_region(chosen_parts):
+                part_keys = None if keys is None else keys[members[part_members]]
+                new_points[members[part_members]] = _points_in_polygon(parts[part], len(part_members), part_keys)
+
+        return new_points
+
+    point_gen.batch = batch
+    point_gen.keyed = seed is not None
+    point_gen.needs_region = True
     return point_gen
 
 
 def rand_point_by_radius(
     radius: float,
-    distribution=stat.uniform
+    distribution=stat.uniform,
+    seed: int | None = None,
+    realization: int = 0
 ) -> Callable:
     """
     Based on a starting point, returns a random point within the provided radius of the starting point.
@@ -263,8 +1725,11 @@ def rand_point_by_radius(
     - starting_point (shapely.Point): The anchor point around which the random point will be generated
     - radius (float): The maximum allowable distance from the start point that a point could be generated
     - distribution (scipy.stats.rv_generic): The distribution function (defaults to a uniform distribution) used to generate the new point.
+    - seed (int): Default None. If provided, the batch function runs in keyed mode. See rand_point_in_region
+    - realization (int): Default 0. See rand_point_in_region
     Outputs:
     - shapely.Point with the new coordinate, within the specified radius from the starting point
+    The returned function has a false "needs_region" attribute, so obfuscated_network jitters every node, whatever its region.
     """
     def point_gen(point, region):
         r = radius * sqrt(distribution.rvs(loc=0, scale=1))
@@ -272,92 +1737,424 @@ def rand_point_by_radius(
 
         return Point(point[0] + r*cos(theta), point[1] + r*sin(theta))
 
+    def batch(points: np.ndarray, regions: np.ndarray, region_index: np.ndarray, keys: np.ndarray | None = None) -> np.ndarray:
+        if seed is None:
+            r = radius * np.sqrt(distribution.rvs(loc=0, scale=1, size=len(points)))
+            theta = distribution.rvs(loc=0, scale=2 * pi, size=len(points))
+        elif keys is None:
+            raise ValueError("A keyed strategy needs the keys of the points")
+        else:
+            r = radius * np.sqrt(distribution.ppf(keyed_uniform(seed, keys, realization, 0), loc=0, scale=1))
+            theta = distribution.ppf(keyed_uniform(seed, keys, realization, 1), loc=0, scale=2 * pi)
+
+        return points + np.stack([r*np.cos(theta), r*np.sin(theta)], axis=1)
+
+    point_gen.batch = batch
+    point_gen.keyed = seed is not None
+    point_gen.needs_region = False
     return point_gen
 
 
 def k_nearest_neighbors(
     k: int,
-    network: Graph
+    network: Graph | SpatialGraph
 ) -> Callable:
     if k < 1:
         raise ValueError("Can't do k-nearest neighbors with less than 1 point")
 
-    def point_gen(point: tuple[float, float], region):
-        coord = Point(point[0], point[1])
-
-        distances = list()
-        needs_sort = False
+    _, longs, lats = _node_coords(network)
+    if len(longs) < k:
+        raise ValueError(f"Can't do {k}-nearest neighbors with only {len(longs)} points")
 
-        for a, data in network.nodes(data=True):
-            if len(distances) < k:
-                distances.append(coord.distance(Point(data["long"], data["lat"])))
-                needs_sort = True
-            else:
-                if needs_sort:
-                    distances.sort()
+    def point_gen(point: tuple[float, float], region):
+        x, y = _as_xy(point)
+        distances = np.hypot(longs - x, lats - y)
 
-                new_distance = coord.distance(Point(data["long"], data["lat"]))
-                if new_distance < distances[k - 1]:
-                    replace_index = 0
-                    while new_distance > distances[replace_index]:
-                        replace_index += 1
+        # The distance to the k-th closest node is the radius for the k-nearest neighbors
+        radius = float(np.partition(distances, k - 1)[k - 1])
+        return rand_point_by_radius(radius)(point, None)
 
-                    distances[replace_index] = new_distance
+    point_gen.needs_region = False
+    return point_gen
 
-        # By this point, we have a radius for the k-nearest neighbors
-        return rand_point_by_radius(distances[k - 1])(point, None)
 
-    return point_gen
+def _push_from_origin(points: np.ndarray, origin: np.ndarray, min_displacement: float) -> np.ndarray:
+    """
+    Moves every point closer than min_displacement to its origin out to exactly that distance, along the line from its origin.
+    """
+    if min_displacement <= 0:
+        return points
+    offset = points - origin
+    distance = np.hypot(offset[:, 0], offset[:, 1])
+    close = distance < min_displacement
+
+    # A point sitting on its origin has no direction, so it is pushed east
+    direction = np.where(distance[close, None] > 0, offset[close] / np.maximum(distance[close, None], np.finfo(float).tiny), [1.0, 0.0])
+    points = points.copy()
+    points[close] = origin[close] + min_displacement * direction
+    return points
+
+
+def length_preserving_network(
+        regions: GeoDataFrame | GeoSeries | TileGrid,
+        network: Graph | SpatialGraph,
+        region_accessor: str | np.ndarray,
+        strategy: Callable | None = None,
+        min_displacement: float = 0.0,
+        iterations: int = 100,
+        step: float = 1.0,
+        backtracks: int = 4,
+        tolerance: float = 1e-4,
+        point_converter: Callable = long_lat_converter,
+        fail_graceful: bool = True,
+        max_redraws: int = 50
+) -> Graph | SpatialGraph:
+    """
+    Obfuscates a network like obfuscated_network, then refines the new points so that every edge's length moves back toward its original length, which region and radius jitter distort. Each iteration is a gradient step on the squared length errors of all the edges at once, computed with a sparse edge-node incidence matrix so that it costs O(edges). A node only moves if its new position stays inside its region and at least min_displacement from its original position, so the refinement never weakens the obfuscation. Nodes without a region never move.
+    Inputs:
+    - regions (geopandas.GeoDataFrame | geopandas.GeoSeries | TileGrid): The collection of regions of interest to the network.
+    - network (networkx.Graph | SpatialGraph): The graph containing all the metadata of the points and how they are connected to one another.
+    - region_accessor (str | numpy.ndarray): The node property holding each node's label in the index of "regions", or each node's position in "regions". See obfuscated_network
+    - strategy (Callable): Default None. The strategy giving the starting points. If not provided, rand_point_in_region() is used. It should keep nodes in their regions, since the refinement does
+    - min_displacement (float): Default 0. The smallest distance, in the units of the coordinates, any node may end up from its original position. Nodes closer than this after the initial jitter are pushed straight out from their origin, or else in one of a few fixed directions, if that keeps them in their region, and are otherwise redrawn uniformly in their region until they are far enough. Nodes still too close at the end (e.g. in regions smaller than min_displacement) are failures, reported as by obfuscated_network
+    - iterations (int): Default 100. The largest number of refinement steps
+    - step (float): Default 1. The fraction of its gradient, averaged over its edges, each node moves by per iteration. Much larger values may oscillate. A node whose step would leave its region tries half the step, up to backtracks times
+    - backtracks (int): Default 4. See step
+    - tolerance (float): Default 1e-4. The refinement stops once an iteration improves the mean edge length error by less than this fraction
+    - point_converter (Callable): Default long_lat_converter. See obfuscated_network
+    - fail_graceful (bool): Default True. See obfuscated_network. Nodes left closer than min_displacement are reported, and kept where they are
+    - max_redraws (int): Default 50. The largest number of times a node too close to its origin is redrawn in its region
+    Outputs:
+    - new_graph (networkx.Graph | SpatialGraph): The new graph, of the same type as "network", with all the original data preserved, but with each node being assigned new latitude and longitude coordinates.
+    """
+    if strategy is None:
+        strategy = rand_point_in_region()
+    jittered = obfuscated_network(regions, network, region_accessor, point_converter, strategy, fail_graceful)
+
+    nodes, longs, lats = _node_coords(network)
+    u, v = _edge_positions(network, nodes)
+    origin = np.stack([longs, lats], axis=1).astype(float)
+    _, new_longs, new_lats = _node_coords(jittered)
+    points = np.stack([new_longs, new_lats], axis=1).astype(float)
+
+    masks = regions if isinstance(regions, TileGrid) else RasterMaskSet(regions.geometry.values)
+    region_index = _region_index(regions, network, region_accessor, origin)
+
+    # Row e of the incidence matrix is +1 at the first end of edge e and -1 at the other, so incidence @ points is every edge's vector
+    edge_count = len(u)
+    incidence = sparse.csr_matrix(
+        (np.r_[np.ones(edge_count), -np.ones(edge_count)], (np.r_[np.arange(edge_count), np.arange(edge_count)], np.r_[u, v])),
+        shape=(edge_count, len(nodes))
+    )
+    target = np.linalg.norm(incidence @ origin, axis=1)
+    degree = np.asarray(abs(incidence).sum(axis=0)).ravel()
+    movable = region_index >= 0
+    node_step = np.where(movable, step / np.maximum(degree, 1), 0.0)
+
+    def too_close() -> np.ndarray:
+        # Pushed nodes sit at exactly min_displacement, up to rounding
+        return np.flatnonzero(movable & (np.hypot(*(points - origin).T) < min_displacement * (1 - 1e-9)))
+
+    # Nodes the initial jitter left too close to their origin are pushed straight out, or else in the first of a few directions
+    # which keeps them in their region. Whatever is left is redrawn in its region until it lands far enough away
+    if min_displacement > 0:
+        close = too_close()
+        candidates = _push_from_origin(points[close], origin[close], min_displacement)
+        allowed = masks.contains_xy(region_index[close], candidates[:, 0], candidates[:, 1])
+        points[close[allowed]] = candidates[allowed]
+
+        for angle in np.linspace(0, 2 * pi, 8, endpoint=False):
+            close = too_close()
+            if len(close) == 0:
+                break
+            candidates = origin[close] + min_displacement * np.array([cos(angle), sin(angle)])
+            allowed = masks.contains_xy(region_index[close], candidates[:, 0], candidates[:, 1])
+            points[close[allowed]] = candidates[allowed]
+
+        geometries = regions if isinstance(regions, TileGrid) else np.asarray(regions.geometry.values, dtype=object)
+        redraw = rand_point_in_region()
+        for _ in range(max_redraws):
+            close = too_close()
+            if len(close) == 0:
+                break
+            candidates = redraw.batch(points[close], geometries, region_index[close])
+            allowed = np.hypot(*(candidates - origin[close]).T) >= min_displacement
+            points[close[allowed]] = candidates[allowed]
+
+    previous_error = np.inf
+    for _ in range(iterations):
+        vectors = incidence @ points
+        lengths = np.linalg.norm(vectors, axis=1)
+        error = np.abs(lengths - target).mean() if edge_count > 0 else 0.0
+        if previous_error - error < tolerance * previous_error:
+            break
+        previous_error = error
+
+        ratio = (lengths - target) / np.maximum(lengths, np.finfo(float).tiny)
+        moves = -node_step[:, None] * (incidence.T @ (ratio[:, None] * vectors))
+
+        pending = np.flatnonzero(movable & np.any(moves != 0, axis=1))
+        for _ in range(backtracks + 1):
+            candidates = _push_from_origin(points[pending] + moves[pending], origin[pending], min_displacement)
+            allowed = masks.contains_xy(region_index[pending], candidates[:, 0], candidates[:, 1])
+            points[pending[allowed]] = candidates[allowed]
+
+            pending = pending[~allowed]
+            moves[pending] /= 2
+            if len(pending) == 0:
+                break
+
+    # The refinement only ever moves nodes outward of min_displacement, so the nodes still too close are those no redraw could place
+    for i in too_close() if min_displacement > 0 else []:
+        if not fail_graceful:
+            raise Exception(f"Unable to move point {nodes[i]} at least {min_displacement} from its original position")
+        print(f"Unable to move point {nodes[i]} at least {min_displacement} from its original position. Continuing...")
+
+    if isinstance(jittered, SpatialGraph):
+        return jittered.with_coords(points[:, 0], points[:, 1])
+
+    _set_node_property(jittered, nodes, "long", points[:, 0])
+    _set_node_property(jittered, nodes, "lat", points[:, 1])
+    return jittered
+
+
+def _anonymity_counts(tree: cKDTree, points: np.ndarray, positions: np.ndarray, k: int, radius: float) -> np.ndarray:
+    """
+    Counts the original points within radius of each jittered point, leaving out each point's own original (at the same position in the tree), up to k. Asking for the k+1 nearest originals rather than all of those within radius keeps each query short even in dense areas.
+    """
+    distances, neighbors = tree.query(points, k=k + 1, distance_upper_bound=radius, workers=-1)
+    return (np.isfinite(distances) & (neighbors != positions[:, None])).sum(axis=1)
+
+
+def k_anonymous_network(
+        network: Graph | SpatialGraph,
+        jittered: Graph | SpatialGraph,
+        k: int,
+        radius: float,
+        strategy: Callable[[int], Callable] | None = None,
+        regions: GeoDataFrame | GeoSeries | TileGrid | RegionHierarchy | None = None,
+        region_accessor: str | int | np.ndarray | None = None,
+        max_rounds: int = 8,
+        fail_graceful: bool = True
+) -> Graph | SpatialGraph:
+    """
+    Makes sure every jittered point has at least k other original points within radius of it, so that no jittered point can be traced back to fewer than k+1 candidate originals. The original points are put in a KD-tree once, and each round counts the neighbors of all the points still in question with one batched query. Only the points below k are jittered again, from their original position, with a wider strategy each round, until every point satisfies k or max_rounds is reached.
+    Inputs:
+    - network (networkx.Graph | SpatialGraph): The original network
+    - jittered (networkx.Graph | SpatialGraph): The jittered network, such as the output of obfuscated_network, with the same nodes in the same order
+    - k (int): The smallest number of other original points each jittered point must have within radius
+    - radius (float): The radius, in the units of the coordinates, within which original points are counted
+    - strategy (Callable): Default None. A function which, given the round number (starting at 1), returns the strategy re-jittering the points that fail in that round. It should widen as the rounds go on, and is called with the keys of the points if it is keyed (see rand_point_in_region). If not provided, rand_point_by_radius(radius * 2**round) is used
+    - regions (geopandas.GeoDataFrame | geopandas.GeoSeries | TileGrid | RegionHierarchy): Default None. The regions the strategy samples in, if it needs any. With a RegionHierarchy, each round moves one level up from the level given by region_accessor, so failing points are jittered within ever coarser regions
+    - region_accessor (str | int | numpy.ndarray): Default None. The node property or positions locating each node in "regions" (see obfuscated_network), or the starting level of a RegionHierarchy
+    - max_rounds (int): Default 8. The largest number of re-jitter rounds
+    - fail_graceful (bool): Default True. If true, points still below k after max_rounds are reported and keep their last position. Otherwise, an exception is raised
+    Outputs:
+    - new_graph (networkx.Graph | SpatialGraph): A graph of the same type as "jittered", with the points below k moved
+    """
+    nodes, longs, lats = _node_coords(network)
+    jittered_nodes, new_longs, new_lats = _node_coords(jittered)
+    same_nodes = np.array_equal(nodes, jittered_nodes) if isinstance(nodes, np.ndarray) else list(nodes) == list(jittered_nodes)
+    if not same_nodes:
+        raise ValueError("The jittered network must have the same nodes, in the same order, as the original network")
+    if not 0 < k < len(nodes):
+        raise ValueError(f"k must be between 1 and {len(nodes) - 1} for a network of {len(nodes)} nodes, got {k}")
+
+    origin = np.stack([longs, lats], axis=1).astype(float)
+    points = np.stack([new_longs, new_lats], axis=1).astype(float)
+    if strategy is None:
+        strategy = lambda round_number: rand_point_by_radius(radius * 2**round_number)
+
+    if isinstance(regions, RegionHierarchy):
+        start_level = regions.level_number(region_accessor)
+        hierarchy_index = regions.locate(longs, lats, start_level)
+    elif regions is not None:
+        geometries = regions if isinstance(regions, TileGrid) else np.asarray(regions.geometry.values, dtype=object)
+        region_index = _region_index(regions, network, region_accessor, origin)
+    else:
+        geometries = np.array([None], dtype=object)
+        region_index = np.zeros(len(nodes), dtype=np.int64)
+
+    tree = cKDTree(origin)
+    failing = np.flatnonzero(_anonymity_counts(tree, points, np.arange(len(nodes)), k, radius) < k)
+    keys = None
+
+    for round_number in range(1, max_rounds + 1):
+        if len(failing) == 0:
+            break
+        print(f"k-anonymity round {round_number}: jittering {len(failing)} points again")
+
+        if isinstance(regions, RegionHierarchy):
+            level = max(start_level - round_number, 0)
+            geometries = np.asarray(regions[level].geometry.values, dtype=object)
+            region_index = hierarchy_index[:, level]
+
+        round_strategy = strategy(round_number)
+        if getattr(round_strategy, "keyed", False):
+            keys = node_keys(nodes) if keys is None else keys
+            candidates = round_strategy.batch(origin[failing], geometries, region_index[failing], keys=keys[failing])
+        elif hasattr(round_strategy, "batch"):
+            candidates = round_strategy.batch(origin[failing], geometries, region_index[failing])
+        else:
+            candidates = np.full((len(failing), 2), np.nan)
+            for j, i in enumerate(failing):
+                new_point = round_strategy(tuple(origin[i]), geometries[region_index[i]] if region_index[i] >= 0 else None)
+                if new_point is not None:
+                    candidates[j] = _as_xy(new_point)
+
+        candidates = np.asarray(candidates, dtype=float)
+        # Points the strategy could not place, or placed outside any region, keep their previous position and stay in question
+        placed = ~np.isnan(candidates).any(axis=1) & (region_index[failing] >= 0)
+        points[failing[placed]] = candidates[placed]
+        passed = np.zeros(len(failing), dtype=bool)
+        passed[placed] = _anonymity_counts(tree, candidates[placed], failing[placed], k, radius) >= k
+        failing = failing[~passed]
+
+    if len(failing) > 0:
+        if not fail_graceful:
+            raise Exception(f"{len(failing)} points have fewer than {k} original points within {radius} after {max_rounds} rounds")
+        print(f"{len(failing)} points still have fewer than {k} original points within {radius}. Continuing...")
+
+    if isinstance(jittered, SpatialGraph):
+        return jittered.with_coords(points[:, 0], points[:, 1])
+
+    new_graph = jittered.copy()
+    _set_node_property(new_graph, nodes, "long", points[:, 0])
+    _set_node_property(new_graph, nodes, "lat", points[:, 1])
+    return new_graph
 
 
-def display(regions: GeoDataFrame, network: Graph, title: str = None, ax=None) -> None:
+def draw_network(
+        network: Graph | SpatialGraph,
+        ax,
+        node_size: float | None = None,
+        node_color="red",
+        edge_color="blue",
+        rasterized: bool = False,
+        decimate: int | None = None
+) -> None:
+    """
+    Draws a network onto a set of axes with a single LineCollection for all the edges and a single scatter for all the nodes, built straight from coordinate arrays. Unlike networkx.draw, no artist is created per node or edge, so this stays fast on state-sized graphs.
+    Inputs:
+    - network (networkx.Graph | SpatialGraph): The graph to draw. Each node must have "lat" and "long" properties
+    - ax (matplotlib.axes.Axes): The axes to draw on
+    - node_size (float): Default None. The marker size of each node. If not provided, 500 divided by the number of nodes is used
+    - node_color: Default "red". The color of the nodes
+    - edge_color: Default "blue". The color of the edges
+    - rasterized (bool): Default False. If true, the nodes and edges are stored as an image rather than as vector paths when the figure is saved, which keeps files of large graphs small and quick to write
+    - decimate (int): Default None. If provided, the extent of the network is divided into a decimate × decimate grid, and only one node per grid cell and one edge per pair of grid cells are drawn. Edges within a single cell are skipped. Around 1000 is indistinguishable from the full graph at typical figure sizes
+    Outputs: None
+    """
+    nodes, longs, lats = _node_coords(network)
+    u, v = _edge_positions(network, nodes)
+
+    node_keep = np.arange(len(nodes))
+    if decimate is not None and len(nodes) > 0:
+        span_x = max(longs.max() - longs.min(), np.finfo(float).tiny)
+        span_y = max(lats.max() - lats.min(), np.finfo(float).tiny)
+        cell_x = np.minimum(((longs - longs.min()) / span_x * decimate).astype(np.int64), decimate - 1)
+        cell_y = np.minimum(((lats - lats.min()) / span_y * decimate).astype(np.int64), decimate - 1)
+        cell = cell_x * decimate + cell_y
+
+        _, node_keep = np.unique(cell, return_index=True)
+
+        low = np.minimum(cell[u], cell[v])
+        high = np.maximum(cell[u], cell[v])
+        _, edge_keep = np.unique(low * decimate**2 + high, return_index=True)
+        edge_keep = edge_keep[low[edge_keep] != high[edge_keep]]
+        u, v = u[edge_keep], v[edge_keep]
+
+    if node_size is None:
+        node_size = 500 / max(len(nodes), 1)
+
+    segments = np.stack([
+        np.stack([longs[u], lats[u]], axis=1),
+        np.stack([longs[v], lats[v]], axis=1)
+    ], axis=1)
+    edges = LineCollection(segments, colors=edge_color, linewidths=1, rasterized=rasterized, zorder=1)
+    # Every edge ends on a node, so the nodes' extent is the data limit of the whole drawing
+    ax.add_collection(edges, autolim=False)
+    ax.scatter(longs[node_keep], lats[node_keep], s=node_size, c=node_color, rasterized=rasterized, zorder=2)
+    ax.autoscale_view()
+
+
+def display(
+        regions: GeoDataFrame,
+        network: Graph | SpatialGraph,
+        title: str = None,
+        ax=None,
+        fast: bool = False,
+        rasterized: bool = False,
+        decimate: int | None = None,
+        savepath: str | None = None,
+        show: bool = True,
+        tile_cache: TileCache | None = None
+) -> None:
     """
     Overlays a collection of regions and a network over a world map, then displays the plot.
     Inputs:
     - regions (geopandas.GeoDataFrame): The collection of regions to be shown on the overlay
-    - network (networkx.Graph): The graph that will be displayed on top of the region plot
+    - network (networkx.Graph | SpatialGraph): The graph that will be displayed on top of the region plot
     - title (str): If provided, the title of the plot that will be displayed above the image.
+    - ax (matplotlib.axes.Axes): If provided, the axes to draw on. Otherwise a new figure is created
+    - fast (bool): Default False. If true, the network is drawn with draw_network instead of networkx.draw. Recommended for graphs with more than a few thousand nodes. A SpatialGraph is always drawn this way
+    - rasterized (bool): Default False. Passed to draw_network when fast is true
+    - decimate (int): Default None. Passed to draw_network when fast is true
+    - savepath (str): If provided, the figure is saved to this path
+    - show (bool): Default True. If false, the plot is not shown, and a figure created by this function is closed once saved. Together with savepath, this allows batch jobs to render figures with a non-interactive backend such as Agg
+    - tile_cache (TileCache): If provided, the basemap tiles are read through this cache instead of being downloaded on every call
     Outpus: None
     Side Effects: A pop-up window will open with the completed plot displayed. Code execution will continue while the pop-up window is open, but the program will not exit until all pop-up windows are closed.
     """
+    created_figure = ax is None
     if ax is None:
         fig, ax=plt.subplots(figsize=(10, 10))
 
     regions.plot(ax=ax, color="lightgray", edgecolor="black", alpha=0.5)
 
     if network is not None:
-        pos={node: (data['long'], data['lat']) for node, data in network.nodes(data=True)}
+        if fast or isinstance(network, SpatialGraph):
+            draw_network(network, ax, rasterized=rasterized, decimate=decimate)
+        else:
+            pos={node: (data['long'], data['lat']) for node, data in network.nodes(data=True)}
 
-        draw(network, pos, ax=ax, node_size=500 / len(network.nodes), edge_color="blue", node_color="red", with_labels=False)
-    ctx.add_basemap(ax, source=ctx.providers.OpenStreetMap.Mapnik, crs=regions.crs)
+            draw(network, pos, ax=ax, node_size=500 / len(network.nodes), edge_color="blue", node_color="red", with_labels=False)
+    if tile_cache is not None:
+        tile_cache.add_basemap(ax, provider=ctx.providers.OpenStreetMap.Mapnik, crs=regions.crs)
+    else:
+        ctx.add_basemap(ax, source=ctx.providers.OpenStreetMap.Mapnik, crs=regions.crs)
 
-    plt.title(title)
-    plt.show()
+    ax.set_title(title)
+    if savepath is not None:
+        ax.figure.savefig(savepath)
+    if show:
+        plt.show()
+    elif created_figure:
+        plt.close(ax.figure)
 
 
-def wasserstein(old_network: Graph, new_networks: list[Graph], ax=None) -> float:
-    old_edge_distances=[]
-    for u, v in old_network.edges:
-        upos=(old_network.nodes[u]["long"], old_network.nodes[u]["lat"])
-        vpos=(old_network.nodes[v]["long"], old_network.nodes[v]["lat"])
+def _edge_lengths(network: Graph | SpatialGraph) -> np.ndarray:
+    """
+    The straight-line length of every edge of a network, in the network's edge order.
+    """
+    nodes, longs, lats = _node_coords(network)
+    u, v = _edge_positions(network, nodes)
+    return np.sqrt((longs[u] - longs[v])**2 + (lats[u] - lats[v])**2)
 
-        old_edge_distances.append(sqrt((upos[0] - vpos[0])**2 + (upos[1]-vpos[1])**2))
-    old_span=max(old_edge_distances) - min(old_edge_distances)
-    old_edge_distances=[(x - min(old_edge_distances)) / old_span for x in old_edge_distances]
+
+def _normalized(distances: np.ndarray) -> np.ndarray:
+    return (distances - distances.min()) / (distances.max() - distances.min())
+
+
+def wasserstein(old_network: Graph | SpatialGraph, new_networks: list[Graph | SpatialGraph], ax=None) -> float:
+    old_edge_distances=_normalized(_edge_lengths(old_network))
 
     sorted_old=np.sort(old_edge_distances)
     cdf1=np.arange(1, len(sorted_old) + 1) / len(sorted_old)
 
     new_cdfs=[]
     for new_network in new_networks:
-        new_edge_distances=[]
-        for u, v in new_network.edges:
-            upos=(new_network.nodes[u]["long"], new_network.nodes[u]["lat"])
-            vpos=(new_network.nodes[v]["long"], new_network.nodes[v]["lat"])
-
-            new_edge_distances.append(sqrt((upos[0] - vpos[0])**2 + (upos[1]-vpos[1])**2))
-        new_span=max(new_edge_distances) - min(new_edge_distances)
-        new_edge_distances=[(x - min(new_edge_distances)) / new_span for x in new_edge_distances]
+        new_edge_distances=_normalized(_edge_lengths(new_network))
 
         sorted_new=np.sort(new_edge_distances)
 
@@ -371,76 +2168,145 @@ def wasserstein(old_network: Graph, new_networks: list[Graph], ax=None) -> float
     return stat.wasserstein_distance(old_edge_distances, new_edge_distances)
 
 
-def kolmogorov_smirnov(old_network: Graph, new_networks: list[Graph]) -> float:
-    old_edge_distances=[]
-    for u, v in old_network.edges:
-        upos=(old_network.nodes[u]["long"], old_network.nodes[u]["lat"])
-        vpos=(old_network.nodes[v]["long"], old_network.nodes[v]["lat"])
+def kolmogorov_smirnov(old_network: Graph | SpatialGraph, new_networks: list[Graph | SpatialGraph]) -> float:
+    old_edge_distances=_normalized(_edge_lengths(old_network))
 
-        old_edge_distances.append(sqrt((upos[0] - vpos[0])**2 + (upos[1]-vpos[1])**2))
-    old_span=max(old_edge_distances) - min(old_edge_distances)
-    old_edge_distances=[(x - min(old_edge_distances)) / old_span for x in old_edge_distances]
+    all_new_edge_distances=np.concatenate([_normalized(_edge_lengths(new_network)) for new_network in new_networks])
 
-    all_new_edge_distances=[]
-    for new_network in new_networks:
-        new_edge_distances=[]
-        for u, v in new_network.edges:
-            upos=(new_network.nodes[u]["long"], new_network.nodes[u]["lat"])
-            vpos=(new_network.nodes[v]["long"], new_network.nodes[v]["lat"])
+    return stat.kstest(old_edge_distances, all_new_edge_distances).statistic
 
-            new_edge_distances.append(sqrt((upos[0] - vpos[0])**2 + (upos[1]-vpos[1])**2))
-        new_span=max(new_edge_distances) - min(new_edge_distances)
-        new_edge_distances=[(x - min(new_edge_distances)) / new_span for x in new_edge_distances]
 
-        all_new_edge_distances.extend(new_edge_distances)
+def absolute_distance(old_network: Graph | SpatialGraph, new_networks: list[Graph | SpatialGraph]) -> list[float]:
+    old_edge_distances=_edge_lengths(old_network)
 
-    return stat.kstest(old_edge_distances, all_new_edge_distances).statistic
+    all_new_edge_distances=[_edge_lengths(new_network) for new_network in new_networks]
 
+    averaged_new_edge_distances = np.mean(all_new_edge_distances, axis=0)
 
-def absolute_distance(old_network: Graph, new_networks: list[Graph]) -> list[float]:
-    old_edge_distances=[]
-    for u, v in old_network.edges:
-        upos=(old_network.nodes[u]["long"], old_network.nodes[u]["lat"])
-        vpos=(old_network.nodes[v]["long"], old_network.nodes[v]["lat"])
+    return np.abs(old_edge_distances - averaged_new_edge_distances).tolist()
 
-        old_edge_distances.append(sqrt((upos[0] - vpos[0])**2 + (upos[1]-vpos[1])**2))
 
-    all_new_edge_distances=[]
-    for new_network in new_networks:
-        new_edge_distances=[]
-        for u, v in new_network.edges:
-            upos=(new_network.nodes[u]["long"], new_network.nodes[u]["lat"])
-            vpos=(new_network.nodes[v]["long"], new_network.nodes[v]["lat"])
+def normal_signed_distance(old_network: Graph | SpatialGraph, new_networks: list[Graph | SpatialGraph]) -> list[float]:
+    old_edge_distances=_edge_lengths(old_network)
 
-            new_edge_distances.append(sqrt((upos[0] - vpos[0])**2 + (upos[1]-vpos[1])**2))
-        all_new_edge_distances.append(new_edge_distances)
+    all_new_edge_distances=[_edge_lengths(new_network) for new_network in new_networks]
 
     averaged_new_edge_distances = np.mean(all_new_edge_distances, axis=0)
 
-    return [abs(x - y) for x, y in zip(old_edge_distances, averaged_new_edge_distances)]
+    return (old_edge_distances - averaged_new_edge_distances).tolist()
 
 
-def normal_signed_distance(old_network: Graph, new_networks: list[Graph]) -> list[float]:
-    old_edge_distances=[]
-    for u, v in old_network.edges:
-        upos=(old_network.nodes[u]["long"], old_network.nodes[u]["lat"])
-        vpos=(old_network.nodes[v]["long"], old_network.nodes[v]["lat"])
+def _segment_starts(groups: np.ndarray, count: int) -> np.ndarray:
+    """
+    The position where each of "count" groups starts in an array sorted by group number. Groups with no element start where the next one does.
+    """
+    return np.searchsorted(groups, np.arange(count))
 
-        old_edge_distances.append(sqrt((upos[0] - vpos[0])**2 + (upos[1]-vpos[1])**2))
 
-    all_new_edge_distances=[]
-    for new_network in new_networks:
-        new_edge_distances=[]
-        for u, v in new_network.edges:
-            upos=(new_network.nodes[u]["long"], new_network.nodes[u]["lat"])
-            vpos=(new_network.nodes[v]["long"], new_network.nodes[v]["lat"])
+def _segmented_normalized(lengths: np.ndarray, groups: np.ndarray, starts: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    # Min-max normalization within each group of a group-sorted array, like _normalized on each group alone
+    nonempty = sizes > 0
+    low = np.full(len(sizes), np.nan)
+    high = np.full(len(sizes), np.nan)
+    low[nonempty] = np.minimum.reduceat(lengths, starts[nonempty])
+    high[nonempty] = np.maximum.reduceat(lengths, starts[nonempty])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (lengths - low[groups]) / (high[groups] - low[groups])
 
-            new_edge_distances.append(sqrt((upos[0] - vpos[0])**2 + (upos[1]-vpos[1])**2))
-        all_new_edge_distances.append(new_edge_distances)
 
-    averaged_new_edge_distances = np.mean(all_new_edge_distances, axis=0)
+def _segmented_sort(values: np.ndarray, groups: np.ndarray) -> np.ndarray:
+    return values[np.lexsort((values, groups))]
 
-    return [x - y for x, y in zip(old_edge_distances, averaged_new_edge_distances)]
+
+def grouped_metrics(
+        old_network: Graph | SpatialGraph,
+        new_networks: list[Graph | SpatialGraph],
+        group: str | np.ndarray,
+        percentiles: tuple[float, ...] = (0, 25, 50, 75, 100)
+) -> pd.DataFrame:
+    """
+    Computes the Wasserstein distance, the Kolmogorov-Smirnov statistic and percentiles of the signed edge length change (see normal_signed_distance) for every group of nodes at once, such as every state or county of a national network. The results for each group are those the metric functions give on the subgraph of that group's nodes, as filter_network_by_region would make it, so only the edges with both ends in the same group count. Instead of one filter-and-measure cycle per group, the edge lengths are computed once, sorted by group and then by value, and every metric is reduced over the segments of each group.
+    Inputs:
+    - old_network (networkx.Graph | SpatialGraph): The original network
+    - new_networks (list[networkx.Graph | SpatialGraph]): The jittered networks, with the same nodes and edges in the same order as old_network
+    - group (str | numpy.ndarray): The node property holding each node's group, or an array of each node's group in node order. Nodes without a group (None or NaN) are left out
+    - percentiles (tuple[float, ...]): Default (0, 25, 50, 75, 100). The percentiles of the signed edge length change to report, computed with the "midpoint" method of numpy.percentile
+    Outputs:
+    - metrics (pandas.DataFrame): Indexed by group, with the number of "edges" in each group, its "wasserstein" and "ks" values, and one "signed_p<percentile>" column per percentile. Groups with no edges get NaN
+    """
+    nodes, _, _ = _node_coords(old_network)
+    if isinstance(group, str):
+        if isinstance(old_network, SpatialGraph):
+            group = old_network.node_attrs.get(group, np.full(len(nodes), None))
+        else:
+            group = [data.get(group) for _, data in old_network.nodes(data=True)]
+    node_group, labels = pd.factorize(pd.Series(group), sort=True)
+    if len(node_group) != len(nodes):
+        raise ValueError(f"Expected {len(nodes)} node groups, got {len(node_group)}")
+
+    u, v = _edge_positions(old_network, nodes)
+    same_group = (node_group[u] == node_group[v]) & (node_group[u] >= 0)
+    edge_group = node_group[u][same_group]
+
+    old_lengths = _edge_lengths(old_network)[same_group]
+    new_lengths = np.array([_edge_lengths(new_network)[same_group] for new_network in new_networks]).reshape(len(new_networks), -1)
+
+    # Every per-group computation below works on edges sorted by group, where each group is one contiguous segment
+    order = np.argsort(edge_group, kind="stable")
+    edge_group = edge_group[order]
+    old_lengths = old_lengths[order]
+    new_lengths = new_lengths[:, order]
+
+    group_count = len(labels)
+    sizes = np.bincount(edge_group, minlength=group_count)
+    starts = _segment_starts(edge_group, group_count)
+    nonempty = sizes > 0
+    metrics = pd.DataFrame({"edges": sizes}, index=labels)
+
+    old_normalized = _segmented_normalized(old_lengths, edge_group, starts, sizes)
+    new_normalized = np.array([_segmented_normalized(lengths, edge_group, starts, sizes) for lengths in new_lengths])
+
+    # Both samples of a group hold the same number of edges, so the Wasserstein distance is the mean gap between their sorted values. Like wasserstein, the last new network is compared
+    wasserstein_values = np.full(group_count, np.nan)
+    if len(new_networks) > 0 and nonempty.any():
+        gaps = np.abs(_segmented_sort(old_normalized, edge_group) - _segmented_sort(new_normalized[-1], edge_group))
+        wasserstein_values[nonempty] = np.add.reduceat(gaps, starts[nonempty]) / sizes[nonempty]
+    metrics["wasserstein"] = wasserstein_values
+
+    # The KS statistic is the largest gap between the two empirical CDFs, read at the last of every run of tied values. Each old value steps the gap up by 1/n and each new value down by 1/(m n)
+    ks_values = np.full(group_count, np.nan)
+    if len(new_networks) > 0 and nonempty.any():
+        values = np.concatenate([old_normalized, new_normalized.ravel()])
+        value_group = np.concatenate([edge_group, np.tile(edge_group, len(new_networks))])
+        steps = np.concatenate([1 / sizes[edge_group], np.tile(-1 / (len(new_networks) * sizes[edge_group]), len(new_networks))])
+        order = np.lexsort((values, value_group))
+        values, value_group, steps = values[order], value_group[order], steps[order]
+
+        cdf_gap = np.cumsum(steps)
+        value_starts = _segment_starts(value_group, group_count)
+        before_group = np.r_[0.0, cdf_gap][value_starts]
+        cdf_gap = np.abs(cdf_gap - before_group[value_group])
+        run_end = np.r_[(values[1:] != values[:-1]) | (value_group[1:] != value_group[:-1]), True]
+        cdf_gap[~run_end] = 0
+        ks_values[nonempty] = np.maximum.reduceat(cdf_gap, value_starts[nonempty])
+    # Groups whose edges all have the same length cannot be normalized, and get NaN as the metric functions give
+    unnormalized = np.isnan(old_normalized) | np.isnan(new_normalized).any(axis=0)
+    invalid = np.bincount(edge_group, weights=unnormalized, minlength=group_count) > 0
+    metrics.loc[invalid, "wasserstein"] = np.nan
+    metrics["ks"] = np.where(invalid, np.nan, ks_values)
+
+    # Percentiles with the "midpoint" method average the two values around (n - 1) * p / 100 in each sorted group
+    signed = _segmented_sort(old_lengths - (new_lengths.mean(axis=0) if len(new_networks) > 0 else np.nan), edge_group)
+    for percentile in percentiles:
+        column = np.full(group_count, np.nan)
+        if nonempty.any():
+            position = (sizes[nonempty] - 1) * percentile / 100
+            below = starts[nonempty] + np.floor(position).astype(np.int64)
+            above = starts[nonempty] + np.ceil(position).astype(np.int64)
+            column[nonempty] = (signed[below] + signed[above]) / 2
+        metrics[f"signed_p{percentile:g}"] = column
+
+    return metrics
 
 
 if __name__ == "__main__":
@@ -0,0 +1,159 @@
+import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+
+def read_edge_list(filename: str, chunksize: int = 5_000_000) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Reads a whitespace-separated edge list, such as the SNAP "edges" files, with one "<node> <node>" pair per line.
+    Inputs:
+    - filename (str): The path to the edge list
+    - chunksize (int): Default 5,000,000. The number of lines parsed at a time
+    Outputs:
+    - u, v (tuple[numpy.ndarray, numpy.ndarray]): The two nodes of each edge
+    """
+    us, vs = [], []
+    for chunk in pd.read_csv(filename, sep=r"\s+", header=None, usecols=[0, 1], names=["u", "v"], dtype=np.int64, chunksize=chunksize):
+        us.append(chunk["u"].to_numpy())
+        vs.append(chunk["v"].to_numpy())
+
+    if len(us) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(us), np.concatenate(vs)
+
+
+def read_checkin_locations(filename: str, chunksize: int = 1_000_000) -> pd.DataFrame:
+    """
+    Computes the mean check-in location of every user in a SNAP check-in file, where each line reads "<user> <time> <latitude> <longitude> <location id>". The file is read in blocks of chunksize lines, and each block is reduced to per-user sums before being merged, so memory depends on the number of users rather than the size of the file. Lines with missing or zero coordinates are skipped.
+    Inputs:
+    - filename (str): The path to the check-in file
+    - chunksize (int): Default 1,000,000. The number of lines parsed at a time
+    Outputs:
+    - locations (pandas.DataFrame): Indexed by user, with the "lat" and "long" of the user's mean location and the number of "checkins" it was computed from
+    """
+    totals = None
+    for chunk in pd.read_csv(
+            filename, sep="\t", header=None, usecols=[0, 2, 3], names=["user", "lat", "long"],
+            chunksize=chunksize, on_bad_lines="skip"
+    ):
+        chunk["lat"] = pd.to_numeric(chunk["lat"], errors="coerce")
+        chunk["long"] = pd.to_numeric(chunk["long"], errors="coerce")
+        chunk = chunk.dropna()
+        chunk = chunk[(chunk["lat"] != 0) & (chunk["long"] != 0)]
+
+        sums = chunk.groupby("user").agg(lat=("lat", "sum"), long=("long", "sum"), checkins=("lat", "size"))
+        totals = sums if totals is None else pd.concat([totals, sums]).groupby(level=0).sum()
+
+    if totals is None:
+        return pd.DataFrame({"lat": [], "long": [], "checkins": []})
+
+    totals["lat"] /= totals["checkins"]
+    totals["long"] /= totals["checkins"]
+    totals.index = totals.index.astype(np.int64)
+    return totals
+
+
+def load_pickle(filename: str):
+    """
+    Unpickles the object stored in a file, such as the networks under experiments/data/networks.
+    """
+    with open(filename, "rb") as f:
+        return pickle.load(f)
+
+
+def read_regions(filename: str, crs: str | None = None, columns: list[str] | None = None) -> gpd.GeoDataFrame:
+    """
+    Reads a region file (shapefile, GeoPackage, GeoJSON...) with geopandas.
+    Inputs:
+    - filename (str): The path to the file
+    - crs (str): Default None. If provided, the CRS the coordinates are declared to be in, for files lacking a .prj. The coordinates are not transformed
+    - columns (list[str]): Default None. If provided, only these columns (and the geometry) are kept
+    Outputs:
+    - regions (geopandas.GeoDataFrame): The regions
+    """
+    regions = gpd.read_file(filename)
+    if columns is not None:
+        regions = regions.get([*columns, "geometry"])
+    if crs is not None:
+        regions.crs = crs
+    return regions
+
+
+class ConcurrentLoader:
+    """
+    Loads several inputs (networks, region files...) at the same time on a thread pool. Unpickling, file reads and GEOS parsing release the GIL for part of their work, so loading everything concurrently takes about as long as the slowest input rather than the sum of all of them. Each input starts loading as soon as it is added, and its time is printed when it finishes. Reading an input with loader[name] waits for that input only, so work can start as soon as the inputs it needs are ready while the others keep loading.
+    Inputs:
+    - max_workers (int): Default None. The number of threads. If not provided, one per input, up to the default of concurrent.futures.ThreadPoolExecutor
+    - verbose (bool): Default True. If true, the time taken by each input is printed when it finishes
+    """
+    def __init__(self, max_workers: int | None = None, verbose: bool = True):
+        self.verbose = verbose
+        self.timings = {}
+        self._futures = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="loader")
+        self._start = time.perf_counter()
+
+    def add(self, name: str, function: Callable, *args, **kwargs) -> "ConcurrentLoader":
+        """
+        Starts loading an input, by calling function(*args, **kwargs) on the pool. Returns the loader, so calls can be chained.
+        """
+        if name in self._futures:
+            raise ValueError(f"An input named {name} was already added")
+        self._futures[name] = self._executor.submit(self._load, name, function, args, kwargs)
+        return self
+
+    def _load(self, name: str, function: Callable, args: tuple, kwargs: dict):
+        start = time.perf_counter()
+        outcome = "Failed to load"
+        try:
+            loaded = function(*args, **kwargs)
+            outcome = "Loaded"
+            return loaded
+        finally:
+            end = time.perf_counter()
+            self.timings[name] = end - start
+            if self.verbose:
+                print(f"{outcome} {name} in {end - start:.2f}s ({end - self._start:.2f}s after the loader started)")
+
+    def __getitem__(self, name: str):
+        """
+        The loaded input, waiting for it if it is not ready yet. Errors raised while loading it are raised here.
+        """
+        if name not in self._futures:
+            raise KeyError(f"No input named {name} was added")
+        return self._futures[name].result()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._futures
+
+    def ready(self, name: str) -> bool:
+        """
+        Whether an input has finished loading (or failed to).
+        """
+        return self._futures[name].done()
+
+    def wait(self) -> dict:
+        """
+        Waits for every input, and returns them all by name.
+        """
+        loaded = {name: self[name] for name in self._futures}
+        if self.verbose:
+            print(f"Loaded {len(loaded)} inputs in {time.perf_counter() - self._start:.2f}s")
+        return loaded
+
+    def close(self) -> None:
+        """
+        Shuts down the pool once every input has loaded. Loaded inputs stay readable.
+        """
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self) -> "ConcurrentLoader":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
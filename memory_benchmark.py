@@ -0,0 +1,196 @@
+import argparse
+import gc
+import json
+import multiprocessing
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+from geopandas import GeoDataFrame
+from shapely import box
+
+import geojitter as gj
+from spatial_graph import SpatialGraph
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where only traced allocations are measured
+    resource = None
+
+STAGES = ["convert", "grid", "filter", "obfuscate", "metrics"]
+GRAPH_TYPES = ["nx", "spatial"]
+
+
+def peak_rss() -> int | None:
+    """
+    The peak resident set size of this process so far, in bytes, or None where it cannot be read.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def synthetic_network(size: int, graph_type: str, seed: int = 0) -> gj.Graph | SpatialGraph:
+    """
+    A network of "size" nodes spread uniformly over a state-sized box, each connected to its nearest neighbors like the rail network.
+    """
+    rng = np.random.default_rng(seed)
+    longs = rng.uniform(-110, -100, size)
+    lats = rng.uniform(35, 45, size)
+    network = gj.nearest_neighbor_graph(longs, lats, as_spatial_graph=True)
+    return network if graph_type == "spatial" else network.to_networkx()
+
+
+def _setup(stage: str, size: int, graph_type: str) -> tuple:
+    network = synthetic_network(size, graph_type)
+    regions = GeoDataFrame(geometry=gj.gen_region_grid_rc(network, 10, 10))
+    jittered = None
+    if stage == "metrics":
+        jittered = gj.obfuscated_network(regions, network, "region", gj.long_lat_converter, gj.rand_point_in_region(seed=0))
+    return network, regions, jittered
+
+
+def _run(stage: str, network, regions: GeoDataFrame, jittered):
+    if stage == "convert":
+        return network.to_networkx() if isinstance(network, SpatialGraph) else SpatialGraph.from_networkx(network)
+    if stage == "grid":
+        return gj.gen_region_grid_rc(network, 10, 10)
+    if stage == "filter":
+        return gj.filter_network_by_region(network, box(-110, 35, -105, 45))
+    if stage == "obfuscate":
+        return gj.obfuscated_network(regions, network, "region", gj.long_lat_converter, gj.rand_point_in_region(seed=0))
+    if stage == "metrics":
+        return (
+            gj.wasserstein(network, [jittered]),
+            gj.kolmogorov_smirnov(network, [jittered]),
+            gj.absolute_distance(network, [jittered])
+        )
+    raise ValueError(f"Unknown stage {stage}")
+
+
+def measure_stage(stage: str, size: int, graph_type: str) -> dict:
+    """
+    Runs one stage on a synthetic network and measures it. Meant to be run in a fresh process, since the peak RSS of a process never goes down.
+    Outputs:
+    - result (dict): The "traced_peak" (bytes allocated through Python and NumPy at the peak of the stage), "rss_before" and "rss_peak" (peak resident set size before and after the stage, including the interpreter, imports and setup), "rss_growth" (how far the stage alone raised the peak resident set size), and "seconds"
+    """
+    network, regions, jittered = _setup(stage, size, graph_type)
+    gc.collect()
+    rss_before = peak_rss()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    output = _run(stage, network, regions, jittered)
+    seconds = time.perf_counter() - start
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del output
+    rss_peak = peak_rss()
+
+    return {
+        "stage": stage,
+        "size": size,
+        "graph": graph_type,
+        "traced_peak": traced_peak,
+        "rss_before": rss_before,
+        "rss_peak": rss_peak,
+        "rss_growth": None if rss_peak is None else rss_peak - rss_before,
+        "seconds": seconds
+    }
+
+
+def run_benchmark(sizes: list[int], graph_types: list[str], stages: list[str]) -> list[dict]:
+    """
+    Measures every stage on synthetic networks of each size and type, each in its own process.
+    Outputs:
+    - results (list[dict]): One result per stage, size and type. See measure_stage
+    """
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for graph_type in graph_types:
+        for size in sizes:
+            for stage in stages:
+                with context.Pool(1) as pool:
+                    result = pool.apply(measure_stage, (stage, size, graph_type))
+                results.append(result)
+
+                rss = "n/a" if result["rss_growth"] is None else f"+{result['rss_growth'] / 2**20:.1f} MiB"
+                print(
+                    f"{graph_type:>7} {stage:>9} {size:>9,} nodes: "
+                    f"traced {result['traced_peak'] / 2**20:8.1f} MiB ({result['traced_peak'] / size:7.1f} B/node), "
+                    f"peak RSS {rss}, {result['seconds']:.2f}s"
+                )
+    return results
+
+
+def budget_key(result: dict) -> str:
+    return f"{result['graph']}/{result['stage']}/{result['size']}"
+
+
+def record_budgets(results: list[dict], path: Path, headroom: float, rss: bool = False) -> None:
+    """
+    Writes the measured peaks, plus some headroom, as the budgets future runs are checked against. Traced allocations are much the same on any machine, so they are what a shared budget file should hold. The growth of the resident set size depends on the platform and allocator, so it is only budgeted if "rss" is true, for budgets kept on one machine.
+    """
+    metrics = ["traced_peak", "rss_growth"] if rss else ["traced_peak"]
+    budgets = {}
+    for result in results:
+        budgets[budget_key(result)] = {
+            metric: int(result[metric] * (1 + headroom))
+            for metric in metrics if result[metric] is not None
+        }
+    path.write_text(json.dumps(budgets, indent=2, sort_keys=True))
+    print("Recorded", len(budgets), "budgets in", path)
+
+
+def check_budgets(results: list[dict], path: Path) -> list[str]:
+    """
+    Compares every result with its recorded budget. Results without a budget are reported but do not fail.
+    Outputs:
+    - failures (list[str]): A description of every budget exceeded
+    """
+    budgets = json.loads(path.read_text())
+    failures = []
+    for result in results:
+        budget = budgets.get(budget_key(result))
+        if budget is None:
+            print("No budget recorded for", budget_key(result))
+            continue
+
+        for metric, limit in budget.items():
+            if result.get(metric) is not None and result[metric] > limit:
+                failures.append(f"{budget_key(result)}: {metric} of {result[metric]:,} bytes exceeds the budget of {limit:,}")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the peak memory of the main stages of GeoJitter on synthetic networks.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000], help="The numbers of nodes to test")
+    parser.add_argument("--graphs", nargs="+", choices=GRAPH_TYPES, default=GRAPH_TYPES, help="The graph types to test")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="The stages to test")
+    parser.add_argument("--budgets", type=Path, default=Path("memory_budgets.json"), help="The file of recorded budgets")
+    parser.add_argument("--record", action="store_true", help="Record the results as the new budgets instead of checking them")
+    parser.add_argument("--record-rss", action="store_true", help="Also record budgets for the RSS growth of each stage, which only hold on this machine")
+    parser.add_argument("--headroom", type=float, default=0.1, help="How far above the measured peaks budgets are recorded, as a percentage above one")
+    parser.add_argument("--output", type=Path, default=None, help="If provided, all results are written to this JSON file")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.sizes, args.graphs, args.stages)
+    if args.output is not None:
+        args.output.write_text(json.dumps(results, indent=2))
+
+    if args.record:
+        record_budgets(results, args.budgets, args.headroom, args.record_rss)
+    elif args.budgets.exists():
+        failures = check_budgets(results, args.budgets)
+        for failure in failures:
+            print("OVER BUDGET", failure)
+        if failures:
+            sys.exit(1)
+        print("All stages are within budget")
+    else:
+        print("No budgets found at", args.budgets, "- run with --record to create them")
@@ -1,9 +1,10 @@
 from dataclasses import dataclass, asdict
 from itertools import pairwise
 from pathlib import Path
-import pickle
 from typing import Hashable
 from datetime import datetime, timedelta
+import os
+import sys
 import threading
 from math import pi, sqrt
 
@@ -11,27 +12,31 @@ import networkx as nx
 import numpy as np
 import geopandas as gp
 import pandas as pd
-import shapely as shp
 import matplotlib.pyplot as plt
 from matplotlib.gridspec import GridSpec
-from matplotlib.ticker import FuncFormatter
+from scipy.stats import t as student_t
 
 import geojitter as gj
-
-with open("./experiments/data/networks/spatial_graph_brightkite", "rb") as f:
-    brightkite: nx.Graph = pickle.load(f)
-with open("./experiments/data/networks/spatial_graph_gowalla", "rb") as f:
-    gowalla: nx.Graph = pickle.load(f)
-
-all_states = gp.read_file(
-    "./data_vault/cb_2023_us_state_20m/cb_2023_us_state_20m.shp").get(['STATEFP', 'NAME', 'geometry'])
-all_states.crs = "EPSG:4326"
-
-counties = gp.read_file(
-    "./data_vault/cb_2023_us_county_20m/cb_2023_us_county_20m.shp")
-counties.crs = "EPSG:4326"
-
-output_path = "./trial_outputs/" + datetime.now().strftime("%d%b%Y - %H%M%S")
+from loaders import ConcurrentLoader, load_pickle, read_regions
+from artifact_cache import ArtifactCache, fingerprint
+
+# Every input loads concurrently. Each one is waited for only where it is first used, so trials start while the other dataset is still loading
+inputs = ConcurrentLoader()
+inputs.add("gw", load_pickle, "./experiments/data/networks/spatial_graph_gowalla")
+inputs.add("bk", load_pickle, "./experiments/data/networks/spatial_graph_brightkite")
+inputs.add(
+    "states", read_regions, "./data_vault/cb_2023_us_state_20m/cb_2023_us_state_20m.shp",
+    crs="EPSG:4326", columns=['STATEFP', 'NAME'])
+inputs.add("counties", read_regions, "./data_vault/cb_2023_us_county_20m/cb_2023_us_county_20m.shp", crs="EPSG:4326")
+
+all_states: gp.GeoDataFrame = inputs["states"]
+
+# Passing the output folder of an earlier run resumes it, skipping every dataset/state pair it already finished
+if len(sys.argv) > 1:
+    output_path = sys.argv[1]
+    print("Resuming run in", output_path)
+else:
+    output_path = "./trial_outputs/" + datetime.now().strftime("%d%b%Y - %H%M%S")
 Path(output_path).mkdir(parents=True, exist_ok=True)
 
 
@@ -45,9 +50,10 @@ class TrialAnalytics:
     state: int
     trial_n: int
     overhead_time: int
-    radii_time: int
-    tile_time: int
-    region_time: int
+    # None once the strategy's metrics have converged and it is no longer run
+    radii_time: int | None
+    tile_time: int | None
+    region_time: int | None
 
 
 @dataclass
@@ -67,40 +73,144 @@ class StateAnalytics:
     quartiles_tile: list[float]
     quartiles_region: list[float]
 
+    trials_rad: int
+    trials_tile: int
+    trials_region: int
 
-all_trial_states = all_states['NAME'].unique()
-iterations_per_state = 1
+    # The unit of the edge lengths behind the quartiles: "m" for projected states, "degree" otherwise
+    length_unit: str
 
-trial_analytics = list()
-state_analytics = list()
+    # Half widths of the confidence intervals of the per-trial metrics when each strategy stopped
+    wass_ci_rad: float
+    wass_ci_tile: float
+    wass_ci_region: float
+    ks_ci_rad: float
+    ks_ci_tile: float
+    ks_ci_region: float
 
 
-def test_states(trial_states: list[str]):
-    for i, dataset in enumerate([gowalla, brightkite]):
-        for j, trial_state in enumerate(trial_states):
-            fig = plt.figure()
-            gs = GridSpec(2, 3, height_ratios=[1, 1])
+@dataclass
+class RunningInterval:
+    """
+    The running mean and variance of a metric over trials (Welford's algorithm), and the Student t confidence interval of its mean.
+    """
+    count: int = 0
+    mean: float = 0.0
+    m2: float = 0.0
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def half_width(self) -> float:
+        if self.count < 2:
+            return float("inf")
+        return student_t.ppf((1 + confidence) / 2, self.count - 1) * sqrt(self.m2 / (self.count - 1) / self.count)
+
+
+def has_converged(intervals: dict[str, RunningInterval]) -> bool:
+    # A strategy stops once every metric's interval is narrower than the tolerance, within the trial budget
+    count = next(iter(intervals.values())).count
+    if count >= max_trials_per_state:
+        return True
+    return count >= min_trials_per_state and all(2 * interval.half_width() <= interval_tolerance for interval in intervals.values())
+
+
+def checkpoint_path(table: str, dataset_name: str, trial_state: str) -> Path:
+    return Path(output_path) / table / f"{dataset_name}-{trial_state}.parquet"
+
+
+def save_checkpoint(table: str, dataset_name: str, trial_state: str, rows: list[dict]) -> None:
+    """
+    Writes the rows for one dataset/state pair to their own Parquet file in the table's folder. The file is written under a temporary name and then renamed, so a crash never leaves a partial file behind.
+    """
+    path = checkpoint_path(table, dataset_name, trial_state)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial = path.with_suffix(".partial")
+    pd.DataFrame(rows).to_parquet(partial)
+    os.replace(partial, path)
+
+
+def is_complete(dataset_name: str, trial_state: str) -> bool:
+    # The state analytics are saved last, so their presence means the pair is finished
+    return checkpoint_path("state_analytics", dataset_name, trial_state).exists()
+
 
-            def region_accessor_tile(node: Hashable) -> shp.Polygon:
-                if "region" not in focused_network_tile.nodes(data=True)[node]:
-                    return tiled_regions[0]
-                else:
-                    region_name = focused_network_tile.nodes(data=True)[
-                        node]["region"]
-                    return tiled_regions[region_name]
+def read_checkpoints(table: str) -> pd.DataFrame:
+    files = sorted((Path(output_path) / table).glob("*.parquet"))
+    if len(files) == 0:
+        return pd.DataFrame()
+    return pd.concat([pd.read_parquet(file) for file in files], ignore_index=True)
 
-            def region_accessor_counties(node: Hashable) -> shp.Polygon:
-                data = focused_network_counties.nodes(data=True)[node]
 
-                if "region" not in data:
-                    for index, region_entry in counties_regions.iterrows():
-                        region = region_entry['geometry']
-                        if region.contains(shp.Point(data["long"], data["lat"])):
-                            return region
+all_trial_states = all_states['NAME'].unique()
+# Each strategy is run on a state until the confidence intervals of its per-trial Wasserstein and KS values are narrower than interval_tolerance,
+# but at least min_trials_per_state and at most max_trials_per_state times, so trials go to the noisy states and strategies
+min_trials_per_state = 3
+max_trials_per_state = 30
+interval_tolerance = 0.01
+confidence = 0.95
+strategy_names = ["rad", "tile", "region"]
+dataset_names = ["gw", "bk"]
+# Every node's jitter is keyed on (seed, node id, trial), so trials are reproducible, including those redone after resuming.
+# Each strategy is offset from the seed so the three jitters of a trial are independent of each other
+seed = 0
+# If true, each state is projected to its own equal-area CRS, so radii, tiles and edge lengths are in meters rather than skewed degrees
+projected = True
+length_unit = "m" if projected else "degree"
+# Each state is tiled into this many rows and columns of tiles
+tile_rows = 10
+tile_cols = 10
+# State subnetworks and their tilings are the same for every trial and every run, so they are cached on disk.
+# Bump the version whenever filtering, projecting or tiling changes, since cached artifacts are only keyed on their inputs
+artifacts = ArtifactCache("./artifact_cache")
+state_tiles_version = 1
+
+
+def check_length_unit() -> None:
+    """
+    Refuses to resume a run whose finished states have edge lengths in another unit, which would mix degrees and meters in one table.
+    """
+    recorded = read_checkpoints("state_analytics")
+    if len(recorded) == 0:
+        return
+    # States finished before the unit was recorded cannot be told apart
+    units = set(recorded["length_unit"].fillna("unknown")) if "length_unit" in recorded else {"unknown"}
+    if units != {length_unit}:
+        raise Exception(
+            f"The run in {output_path} has edge lengths in {', '.join(sorted(units))}, but this run would give them in {length_unit}. "
+            "Set projected to match it, or start a new run"
+        )
+
+
+def state_tiles(dataset: nx.Graph, state_geom, state_crs, rows: int, cols: int) -> tuple[nx.Graph, gj.TileGrid]:
+    """
+    The part of a dataset inside a state, projected to state_crs if one is given, with its nodes tagged by a tiling of rows by cols tiles.
+    """
+    focused_network = gj.filter_network_by_region(dataset, state_geom)
+    if state_crs is not None:
+        focused_network = gj.project_network(focused_network, state_crs)
+    tiles = gj.gen_region_grid_rc(focused_network, rows, cols, as_tile_grid=True)
+    return focused_network, tiles
+
 
-                region_name = focused_network_counties.nodes(data=True)[
-                    node]["region"]
-                return counties_regions.iloc[region_name].loc['geometry']
+def test_states(trial_states: list[str]):
+    for i, dataset_name in enumerate(dataset_names):
+        dataset_key = None
+        for j, trial_state in enumerate(trial_states):
+            if is_complete(dataset_names[i], trial_state):
+                print(trial_state, "was already done. Skipping")
+                continue
+            dataset: nx.Graph = inputs[dataset_name]
+            if dataset_key is None:
+                # Hashing a whole dataset takes a while, so it is done once and the hash stands in for it in cache keys
+                dataset_key = fingerprint(dataset)
+            counties: gp.GeoDataFrame = inputs["counties"]
+
+            fig = plt.figure()
+            gs = GridSpec(2, 3, height_ratios=[1, 1])
 
             state_subdf = all_states.loc[all_states['NAME'] == trial_state, [
                 'STATEFP', 'geometry']]
@@ -110,71 +220,98 @@ def test_states(trial_states: list[str]):
             by_radii = []
             by_tile = []
             by_region = []
+            trial_analytics = []
 
             counties_regions: gp.GeoDataFrame = counties.loc[counties['STATEFP'] == fips]
+            if projected:
+                state_crs = gj.equal_area_crs(state_geom.bounds)
+                counties_regions = counties_regions.to_crs(state_crs)
             avg_area = np.mean(
                 [county.area for county in counties_regions['geometry']])
             trial_radius = sqrt(avg_area / (2*pi))
 
-            for trial in range(iterations_per_state):
-                trial_start = datetime.now()
+            # The state network is loaded once, and its load time counts as the overhead of the first trial
+            load_start = datetime.now()
+            focused_network_tile, tiled_regions = artifacts.get_or_compute(
+                "state-tiles",
+                (
+                    state_tiles_version, dataset_key, state_geom, state_crs if projected else None,
+                    ("grid_rc", tile_rows, tile_cols)
+                ),
+                lambda: state_tiles(dataset, state_geom, state_crs if projected else None, tile_rows, tile_cols)
+            )
+            load_time = (datetime.now() - load_start) / timedelta(microseconds=1)
+
+            def jitter(strategy_name: str, trial: int) -> nx.Graph:
+                if strategy_name == "rad":
+                    return gj.obfuscated_network(
+                        regions=None,
+                        network=focused_network_tile,
+                        # The radius strategy needs no region, so nodes are not located
+                        region_accessor=None,
+                        point_converter=point_converter,
+                        strategy=gj.rand_point_by_radius(trial_radius, seed=seed, realization=trial),
+                        fail_graceful=False
+                    )
+                if strategy_name == "tile":
+                    return gj.obfuscated_network(
+                        regions=tiled_regions,
+                        network=focused_network_tile,
+                        region_accessor="region",
+                        point_converter=point_converter,
+                        strategy=gj.rand_point_in_region(seed=seed + 1, realization=trial),
+                        fail_graceful=False
+                    )
+                return gj.obfuscated_network(
+                    regions=counties_regions,
+                    network=focused_network_counties,
+                    # Nodes are not tagged with their county, so they are located by containment. Nodes in sliver gaps between
+                    # counties or just off the simplified coastline go to the nearest county rather than aborting the sweep
+                    region_accessor=None,
+                    point_converter=point_converter,
+                    strategy=gj.rand_point_in_region(seed=seed + 2, realization=trial),
+                    fail_graceful=False,
+                    nearest_region=True
+                )
 
-                focused_network_tile: nx.Graph = gj.filter_network_by_region(
-                    dataset, state_geom)
-                focused_network_counties: nx.Graph = focused_network_tile.copy()
+            realizations = {"rad": by_radii, "tile": by_tile, "region": by_region}
+            intervals = {name: {"wass": RunningInterval(), "ks": RunningInterval()} for name in strategy_names}
+            active = list(strategy_names)
 
-                tiled_regions: gp.GeoSeries = gj.gen_region_grid_rc(
-                    focused_network_tile, 10, 10)
+            trial = 0
+            while active:
+                trial_start = datetime.now()
+                focused_network_counties: nx.Graph = focused_network_tile.copy()
+                overhead = (datetime.now() - trial_start) / timedelta(microseconds=1) + (load_time if trial == 0 else 0)
 
-                current_time = datetime.now()
-                overhead = (current_time - trial_start) / \
-                    timedelta(microseconds=1)
+                times = {name: None for name in strategy_names}
+                for name in active:
+                    current_time = datetime.now()
+                    new_network = jitter(name, trial)
+                    times[name] = (datetime.now() - current_time) / timedelta(microseconds=1)
+                    realizations[name].append(new_network)
 
-                by_radii.append(gj.obfuscated_network(
-                    regions=None,
-                    network=focused_network_tile,
-                    region_accessor=lambda x: x,
-                    point_converter=point_converter,
-                    strategy=gj.rand_point_by_radius(trial_radius),
-                    fail_graceful=False
-                ))
-                radii_time = (datetime.now() - current_time) / \
-                    timedelta(microseconds=1)
-                current_time = datetime.now()
-
-                by_tile.append(gj.obfuscated_network(
-                    regions=tiled_regions,
-                    network=focused_network_tile,
-                    region_accessor=region_accessor_tile,
-                    point_converter=point_converter,
-                    strategy=gj.rand_point_in_region(),
-                    fail_graceful=False
-                ))
-                tile_time = (datetime.now() - current_time) / \
-                    timedelta(microseconds=1)
-                current_time = datetime.now()
-
-                by_region.append(gj.obfuscated_network(
-                    regions=counties_regions,
-                    network=focused_network_counties,
-                    region_accessor=region_accessor_counties,
-                    point_converter=point_converter,
-                    strategy=gj.rand_point_in_region(),
-                    fail_graceful=False
-                ))
-                region_time = (datetime.now() - current_time) / \
-                    timedelta(microseconds=1)
+                    original = focused_network_counties if name == "region" else focused_network_tile
+                    intervals[name]["wass"].add(gj.wasserstein(original, [new_network]))
+                    intervals[name]["ks"].add(gj.kolmogorov_smirnov(original, [new_network]))
 
                 trial_analytics.append(asdict(TrialAnalytics(
                     dataset=i,
                     state=j,
                     trial_n=trial,
                     overhead_time=overhead,
-                    radii_time=radii_time,
-                    tile_time=tile_time,
-                    region_time=region_time
+                    radii_time=times["rad"],
+                    tile_time=times["tile"],
+                    region_time=times["region"]
                 )))
 
+                trial += 1
+                for name in [name for name in active if has_converged(intervals[name])]:
+                    print(f"{trial_state}: {name} stopped after {trial} trials "
+                          f"(Wasserstein {intervals[name]['wass'].mean:.4f} ± {intervals[name]['wass'].half_width():.4f}, "
+                          f"KS {intervals[name]['ks'].mean:.4f} ± {intervals[name]['ks'].half_width():.4f})")
+                    active.remove(name)
+
             ax1 = fig.add_subplot(gs[0, 0])
             ax2 = fig.add_subplot(gs[0, 1])
             ax3 = fig.add_subplot(gs[0, 2])
@@ -209,7 +346,7 @@ def test_states(trial_states: list[str]):
             box3 = gj.normal_signed_distance(
                 focused_network_counties, by_region)
 
-            state_analytics.append(asdict(StateAnalytics(
+            state_analytics = asdict(StateAnalytics(
                 dataset=i,
                 state=j,
                 wass_rad=wasserstein_rad,
@@ -223,14 +360,24 @@ def test_states(trial_states: list[str]):
                 quartiles_tile=np.percentile(
                     box2, [0, 25, 50, 75, 100], method='midpoint'),
                 quartiles_region=np.percentile(
-                    box3, [0, 25, 50, 75, 100], method='midpoint')
-            )))
+                    box3, [0, 25, 50, 75, 100], method='midpoint'),
+                trials_rad=len(by_radii),
+                trials_tile=len(by_tile),
+                trials_region=len(by_region),
+                length_unit=length_unit,
+                wass_ci_rad=intervals["rad"]["wass"].half_width(),
+                wass_ci_tile=intervals["tile"]["wass"].half_width(),
+                wass_ci_region=intervals["region"]["wass"].half_width(),
+                ks_ci_rad=intervals["rad"]["ks"].half_width(),
+                ks_ci_tile=intervals["tile"]["ks"].half_width(),
+                ks_ci_region=intervals["region"]["ks"].half_width()
+            ))
 
             ax4.boxplot([box1, box2, box3])
-            ax4.set_title("Percentage change to edge length")
+            # normal_signed_distance is the difference of lengths, in the units of the coordinates, not a ratio
+            ax4.set_title("Change to edge length")
+            ax4.set_ylabel("meters" if length_unit == "m" else "degrees")
             ax4.set_xticklabels(["Radius", "Tile", "County"])
-            ax4.yaxis.set_major_formatter(
-                FuncFormatter(lambda x, _: f'{x*100:.0f}%'))
 
             if i == 1:  # Brightkite
                 fig.suptitle(f"Brightkite Results: {trial_state}")
@@ -242,6 +389,9 @@ def test_states(trial_states: list[str]):
                 plt.savefig(f"{output_path}/gw-{trial_state}.png")
             plt.close()
 
+            save_checkpoint("trial_analytics", dataset_names[i], trial_state, trial_analytics)
+            save_checkpoint("state_analytics", dataset_names[i], trial_state, [state_analytics])
+
             print(trial_state, "is done!")
 
 
@@ -255,12 +405,14 @@ def test_states(trial_states: list[str]):
 # for t in threads:
 #     t.join()
 
+check_length_unit()
 test_states(all_trial_states)
+inputs.close()
 
 print("All complete!")
 
 
-trial_analytics_df = pd.DataFrame(trial_analytics)
-state_analytics_df = pd.DataFrame(state_analytics)
+trial_analytics_df = read_checkpoints("trial_analytics")
+state_analytics_df = read_checkpoints("state_analytics")
 trial_analytics_df.to_pickle(f"{output_path}/trial_analytics.pkl")
 state_analytics_df.to_pickle(f"{output_path}/state_analytics.pkl")
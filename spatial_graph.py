@@ -0,0 +1,294 @@
+import numpy as np
+from networkx import Graph
+
+
+def _kind(value_type: type) -> type:
+    # NumPy scalars are grouped with the Python type they stand for, so that e.g. floats and numpy.float64 share a column
+    for kind in (bool, np.bool_):
+        if issubclass(value_type, kind):
+            return bool
+    if issubclass(value_type, (int, np.integer)):
+        return int
+    if issubclass(value_type, (float, np.floating)):
+        return float
+    if issubclass(value_type, (str, np.str_)):
+        return str
+    return value_type
+
+
+def _column(values: list) -> np.ndarray:
+    """
+    Stores a list of property values as an array. Lists mixing types (even ones NumPy would convert between, such as ints and strings, or bools and ints) or holding missing values (None) are stored as object arrays, so every value comes back as it was.
+    """
+    kinds = {_kind(value_type) for value_type in set(map(type, values))}
+    column = None
+    if len(kinds) <= 1 and type(None) not in kinds:
+        try:
+            column = np.asarray(values)
+        except ValueError:
+            pass
+    if column is None or column.ndim != 1:
+        column = np.empty(len(values), dtype=object)
+        column[:] = values
+    return column
+
+
+def _position_dtype(count: int) -> type:
+    return np.int32 if count < 2**31 else np.int64
+
+
+class SpatialGraph:
+    """
+    A compact, read-mostly undirected graph of geolocated nodes, stored as arrays instead of the per-node and per-edge dictionaries of networkx. Coordinates are two float arrays, edges are two arrays of node positions, and any other node or edge properties are stored as one array (column) each, so a graph of a million nodes takes a few tens of megabytes instead of a few gigabytes. The adjacency is built as CSR (compressed sparse row) arrays the first time it is needed. Every public function of geojitter accepts either a SpatialGraph or a networkx.Graph, and returns the same type it was given.
+    Inputs:
+    - nodes (array-like): The id of each node. Integer ids are stored as an int64 array, anything else as an object array
+    - long (array-like): The longitude of each node
+    - lat (array-like): The latitude of each node
+    - edge_u, edge_v (array-like): Default None. The positions in "nodes" (not the ids) of the two ends of each edge. If not provided, the graph has no edges
+    - node_attrs (dict[str, array-like]): Default None. Other node properties, as one array per property name, in node order
+    - edge_attrs (dict[str, array-like]): Default None. Edge properties, as one array per property name, in edge order
+    - dtype: Default numpy.float64. The type of the coordinates. numpy.float32 halves their size, at the cost of about a meter of precision in degrees
+    """
+    __slots__ = ("nodes", "long", "lat", "edge_u", "edge_v", "node_attrs", "edge_attrs", "_indptr", "_indices", "_index")
+
+    def __init__(
+            self,
+            nodes,
+            long,
+            lat,
+            edge_u=None,
+            edge_v=None,
+            node_attrs: dict | None = None,
+            edge_attrs: dict | None = None,
+            dtype=np.float64
+    ):
+        nodes = nodes if isinstance(nodes, np.ndarray) else _column(list(nodes))
+        self.nodes = nodes.astype(np.int64) if nodes.dtype.kind in "iu" else nodes.astype(object)
+
+        self.long = np.asarray(long, dtype=dtype)
+        self.lat = np.asarray(lat, dtype=dtype)
+        if not (len(self.nodes) == len(self.long) == len(self.lat)):
+            raise ValueError(f"Got {len(self.nodes)} nodes, {len(self.long)} longitudes and {len(self.lat)} latitudes")
+
+        position_dtype = _position_dtype(len(self.nodes))
+        self.edge_u = np.asarray(edge_u if edge_u is not None else [], dtype=position_dtype)
+        self.edge_v = np.asarray(edge_v if edge_v is not None else [], dtype=position_dtype)
+        if len(self.edge_u) != len(self.edge_v):
+            raise ValueError(f"Got {len(self.edge_u)} edge starts and {len(self.edge_v)} edge ends")
+
+        self.node_attrs = {name: np.asarray(values) for name, values in (node_attrs or {}).items()}
+        self.edge_attrs = {name: np.asarray(values) for name, values in (edge_attrs or {}).items()}
+        self._indptr = None
+        self._indices = None
+        self._index = None
+
+    @classmethod
+    def from_networkx(
+            cls,
+            network: Graph,
+            dtype=np.float64,
+            node_attributes: list[str] | None = None,
+            edge_attributes: list[str] | None = None
+    ) -> "SpatialGraph":
+        """
+        Converts a networkx graph whose nodes have "long" and "lat" properties. Node and edge order are preserved.
+        Inputs:
+        - network (networkx.Graph): The graph to convert
+        - dtype: Default numpy.float64. See SpatialGraph
+        - node_attributes (list[str]): Default None. The node properties (besides "long" and "lat") to keep. If not provided, every property found on any node is kept, with None where a node lacks it
+        - edge_attributes (list[str]): Default None. Likewise for edge properties
+        Outputs:
+        - graph (SpatialGraph): The converted graph
+        """
+        count = network.number_of_nodes()
+        long = np.fromiter((data["long"] for _, data in network.nodes(data=True)), dtype=dtype, count=count)
+        lat = np.fromiter((data["lat"] for _, data in network.nodes(data=True)), dtype=dtype, count=count)
+
+        nodes = list(network.nodes)
+        position = {node: i for i, node in enumerate(nodes)}
+        position_dtype = _position_dtype(count)
+        edge_u = np.fromiter((position[a] for a, _ in network.edges), dtype=position_dtype, count=network.number_of_edges())
+        edge_v = np.fromiter((position[b] for _, b in network.edges), dtype=position_dtype, count=network.number_of_edges())
+
+        if node_attributes is None:
+            node_attributes = {key for _, data in network.nodes(data=True) for key in data} - {"long", "lat"}
+        if edge_attributes is None:
+            edge_attributes = {key for _, _, data in network.edges(data=True) for key in data}
+
+        node_attrs = {
+            name: _column([data.get(name) for _, data in network.nodes(data=True)])
+            for name in sorted(node_attributes)
+        }
+        edge_attrs = {
+            name: _column([data.get(name) for _, _, data in network.edges(data=True)])
+            for name in sorted(edge_attributes)
+        }
+        return cls(nodes, long, lat, edge_u, edge_v, node_attrs, edge_attrs, dtype)
+
+    def to_networkx(self) -> Graph:
+        """
+        Converts back to a networkx graph, with "long" and "lat" node properties and every column as a property. Missing values (None) are left out.
+        """
+        names = list(self.node_attrs)
+        columns = [self.node_attrs[name].tolist() for name in names]
+
+        def node_data(i: int, long: float, lat: float) -> dict:
+            data = {"long": long, "lat": lat}
+            for name, column in zip(names, columns):
+                if column[i] is not None:
+                    data[name] = column[i]
+            return data
+
+        edge_names = list(self.edge_attrs)
+        edge_columns = [self.edge_attrs[name].tolist() for name in edge_names]
+
+        def edge_data(j: int) -> dict:
+            return {name: column[j] for name, column in zip(edge_names, edge_columns) if column[j] is not None}
+
+        nodes = self.nodes.tolist()
+        network = Graph()
+        network.add_nodes_from(
+            (node, node_data(i, long, lat))
+            for i, (node, long, lat) in enumerate(zip(nodes, self.long.tolist(), self.lat.tolist()))
+        )
+        network.add_edges_from(
+            (nodes[a], nodes[b], edge_data(j))
+            for j, (a, b) in enumerate(zip(self.edge_u.tolist(), self.edge_v.tolist()))
+        )
+        return network
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def __repr__(self) -> str:
+        return f"SpatialGraph with {self.number_of_nodes()} nodes and {self.number_of_edges()} edges"
+
+    def number_of_nodes(self) -> int:
+        return len(self.nodes)
+
+    def number_of_edges(self) -> int:
+        return len(self.edge_u)
+
+    def positions(self, ids) -> np.ndarray:
+        """
+        Finds the position of each of the given node ids. Raises a KeyError for ids not in the graph.
+        """
+        if self._index is None:
+            if self.nodes.dtype == object:
+                self._index = {node: i for i, node in enumerate(self.nodes.tolist())}
+            else:
+                order = np.argsort(self.nodes, kind="stable")
+                self._index = (self.nodes[order], order)
+
+        if isinstance(self._index, dict):
+            try:
+                return np.array([self._index[node] for node in ids], dtype=np.int64)
+            except KeyError as e:
+                raise KeyError(f"Node {e.args[0]} is not in the graph") from None
+
+        ids = np.asarray(ids)
+        sorted_nodes, order = self._index
+        if len(ids) == 0:
+            return np.empty(0, dtype=np.int64)
+        if len(sorted_nodes) == 0:
+            raise KeyError(f"Node {ids[0]} is not in the graph")
+
+        found = np.minimum(np.searchsorted(sorted_nodes, ids), len(sorted_nodes) - 1)
+        missing = sorted_nodes[found] != ids
+        if missing.any():
+            raise KeyError(f"Node {ids[np.argmax(missing)]} is not in the graph")
+        return order[found].astype(np.int64)
+
+    @property
+    def indptr(self) -> np.ndarray:
+        """
+        The CSR row pointers of the adjacency: the neighbors of the node at position i are indices[indptr[i]:indptr[i + 1]].
+        """
+        if self._indptr is None:
+            self._build_adjacency()
+        return self._indptr
+
+    @property
+    def indices(self) -> np.ndarray:
+        """
+        The CSR column indices of the adjacency. See indptr.
+        """
+        if self._indices is None:
+            self._build_adjacency()
+        return self._indices
+
+    def _build_adjacency(self) -> None:
+        # Each edge is listed from both ends, except self-loops, which networkx also lists once
+        loop = self.edge_u == self.edge_v
+        sources = np.concatenate([self.edge_u, self.edge_v[~loop]])
+        targets = np.concatenate([self.edge_v, self.edge_u[~loop]])
+        order = np.argsort(sources, kind="stable")
+        self._indices = targets[order]
+        self._indptr = np.zeros(len(self.nodes) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(self.nodes)), out=self._indptr[1:])
+
+    def neighbors(self, node) -> np.ndarray:
+        """
+        The ids of the neighbors of a node.
+        """
+        i = self.positions([node])[0]
+        return self.nodes[self.indices[self.indptr[i]:self.indptr[i + 1]]]
+
+    def degree(self) -> np.ndarray:
+        """
+        The number of neighbors of every node, in node order. Unlike networkx, a self-loop counts once.
+        """
+        return np.diff(self.indptr)
+
+    def subgraph(self, keep) -> "SpatialGraph":
+        """
+        The subgraph induced by some of the nodes: those nodes, with their properties, and every edge between two of them.
+        Inputs:
+        - keep (numpy.ndarray): Either a boolean mask over the nodes, or the positions of the nodes to keep
+        Outputs:
+        - graph (SpatialGraph): The subgraph, with nodes and edges in their original order
+        """
+        keep = np.asarray(keep)
+        if keep.dtype == bool:
+            keep = np.flatnonzero(keep)
+        keep = np.sort(keep)
+
+        remap = np.full(len(self.nodes), -1, dtype=np.int64)
+        remap[keep] = np.arange(len(keep))
+        u, v = remap[self.edge_u], remap[self.edge_v]
+        edge_keep = (u >= 0) & (v >= 0)
+
+        return SpatialGraph(
+            self.nodes[keep], self.long[keep], self.lat[keep], u[edge_keep], v[edge_keep],
+            {name: column[keep] for name, column in self.node_attrs.items()},
+            {name: column[edge_keep] for name, column in self.edge_attrs.items()},
+            self.long.dtype
+        )
+
+    def with_coords(self, long, lat) -> "SpatialGraph":
+        """
+        A graph with the same nodes, edges and properties, but new coordinates. The arrays describing the structure are shared rather than copied, so this is what obfuscation returns.
+        """
+        graph = SpatialGraph.__new__(SpatialGraph)
+        graph.nodes = self.nodes
+        graph.long = np.asarray(long, dtype=self.long.dtype)
+        graph.lat = np.asarray(lat, dtype=self.lat.dtype)
+        if not (len(graph.long) == len(graph.lat) == len(self.nodes)):
+            raise ValueError(f"Expected {len(self.nodes)} coordinates, got {len(graph.long)} longitudes and {len(graph.lat)} latitudes")
+        graph.edge_u = self.edge_u
+        graph.edge_v = self.edge_v
+        graph.node_attrs = dict(self.node_attrs)
+        graph.edge_attrs = dict(self.edge_attrs)
+        graph._indptr = self._indptr
+        graph._indices = self._indices
+        graph._index = self._index
+        return graph
+
+    @property
+    def nbytes(self) -> int:
+        """
+        The memory held by the graph's arrays, in bytes. Object arrays are counted as their pointers only.
+        """
+        arrays = [self.nodes, self.long, self.lat, self.edge_u, self.edge_v, *self.node_attrs.values(), *self.edge_attrs.values()]
+        arrays += [array for array in (self._indptr, self._indices) if array is not None]
+        return sum(array.nbytes for array in arrays)
@@ -0,0 +1,258 @@
+import hashlib
+import os
+from collections import OrderedDict
+from io import BytesIO
+from math import ceil, log2
+from pathlib import Path
+
+import numpy as np
+import requests
+import mercantile
+import contextily as ctx
+from PIL import Image
+from pyproj import CRS, Transformer
+from xyzservices import TileProvider
+
+WEB_MERCATOR = "EPSG:3857"
+MAX_LATITUDE = 85.0511
+
+
+def evict_to_size(directory: str | Path, max_bytes: int, pattern: str | list[str] = "*") -> int:
+    """
+    Deletes the least recently used files under a directory until their total size is at most max_bytes. Files are ordered by modification time, so readers should touch the files they use.
+    Inputs:
+    - directory (str | pathlib.Path): The directory to clean up. It is searched recursively
+    - max_bytes (int): The largest total size, in bytes, the matching files may have once this returns
+    - pattern (str | list[str]): Default "*". A glob pattern, or a list of them, restricting which files are considered
+    Outputs:
+    - freed (int): The number of bytes deleted
+    """
+    files = []
+    patterns = [pattern] if isinstance(pattern, str) else pattern
+    # A set, so that a file matching several patterns is only counted once
+    for path in {path for pattern in patterns for path in Path(directory).rglob(pattern)}:
+        if path.is_file():
+            stat = path.stat()
+            files.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in files)
+    freed = 0
+    for _, size, path in sorted(files, key=lambda entry: entry[0]):
+        if total - freed <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        freed += size
+
+    return freed
+
+
+class TileCache:
+    """
+    A disk cache of basemap tiles, for drawing maps repeatedly or without a network connection. Tiles are stored as <directory>/<provider>/<z>/<x>/<y>.png, so a cache can be seeded ahead of time on a connected machine and copied to the machines that render.
+    Inputs:
+    - directory (str | pathlib.Path): Where the tiles are stored. Created if it does not exist
+    - max_bytes (int): Default 512 MiB. Once the stored tiles exceed this size, the least recently used ones are deleted
+    - offline (bool): Default False. If true, tiles are never downloaded, and tiles missing from the cache are left blank
+    - url (str): Default None. A URL template such as "http://localhost:8080/{z}/{x}/{y}.png", used instead of the provider's own URL to download tiles. Tiles are still stored under the provider's name, so a local tile server can stand in for the real one
+    - timeout (float): Default 10. The number of seconds to wait for a tile download
+    - max_in_memory (int): Default 16. The largest number of stitched basemaps, and of basemaps warped to another CRS, kept in memory. The least recently used ones are dropped first
+    """
+    def __init__(
+            self,
+            directory: str | Path,
+            max_bytes: int = 512 * 2**20,
+            offline: bool = False,
+            url: str | None = None,
+            timeout: float = 10,
+            max_in_memory: int = 16
+    ):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.url = url
+        self.timeout = timeout
+        self.max_in_memory = max_in_memory
+        self._basemaps = OrderedDict()
+        self._warped = OrderedDict()
+
+    @staticmethod
+    def provider_name(provider: TileProvider | str) -> str:
+        """
+        The name tiles from a provider are stored under. URL templates are named after a hash of the template.
+        """
+        if isinstance(provider, TileProvider):
+            return provider.name
+        return "url-" + hashlib.sha1(provider.encode()).hexdigest()[:12]
+
+    def tile_path(self, provider: TileProvider | str, z: int, x: int, y: int) -> Path:
+        return self.directory / self.provider_name(provider) / str(z) / str(x) / f"{y}.png"
+
+    def _tile_url(self, provider: TileProvider | str, z: int, x: int, y: int) -> str:
+        if self.url is not None:
+            return self.url.format(z=z, x=x, y=y)
+        if isinstance(provider, TileProvider):
+            return provider.build_url(x=x, y=y, z=z)
+        return provider.format(z=z, x=x, y=y)
+
+    def get_tile(self, provider: TileProvider | str, z: int, x: int, y: int) -> bytes | None:
+        """
+        Returns the encoded image of a tile, reading it from the cache or downloading (and storing) it if needed. Returns None if the tile is not cached and cannot be downloaded.
+        """
+        path = self.tile_path(provider, z, x, y)
+        if path.exists():
+            os.utime(path)
+            return path.read_bytes()
+
+        if self.offline:
+            return None
+
+        try:
+            response = requests.get(self._tile_url(provider, z, x, y), headers={"User-Agent": "GeoJitter"}, timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            print(f"Unable to download tile {z}/{x}/{y}: {e}")
+            return None
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(response.content)
+        return response.content
+
+    def seed(self, provider: TileProvider | str, west: float, south: float, east: float, north: float, zooms: list[int]) -> int:
+        """
+        Downloads every tile covering a longitude/latitude box at each of the given zoom levels, so they can be drawn later without a connection.
+        Outputs:
+        - count (int): The number of tiles now available in the cache
+        """
+        count = 0
+        for zoom in zooms:
+            for tile in mercantile.tiles(west, max(south, -MAX_LATITUDE), east, min(north, MAX_LATITUDE), zoom):
+                if self.get_tile(provider, tile.z, tile.x, tile.y) is not None:
+                    count += 1
+        self.evict()
+        return count
+
+    def evict(self) -> int:
+        """
+        Deletes the least recently used tiles and stored basemaps until the cache fits in max_bytes. Returns the number of bytes freed.
+        """
+        return evict_to_size(self.directory, self.max_bytes, ["*.png", "*.npz"])
+
+    def _remember(self, cache: OrderedDict, key, value) -> None:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.max_in_memory:
+            cache.popitem(last=False)
+
+    def basemap_key(self, provider: TileProvider | str, west: float, south: float, east: float, north: float, zoom: int) -> str:
+        """
+        The name a basemap is stored under: the provider, the zoom and the range of tiles covering the box, so that any box covered by the same tiles shares it.
+        """
+        tiles = list(mercantile.tiles(west, max(south, -MAX_LATITUDE), east, min(north, MAX_LATITUDE), zoom))
+        xs = [tile.x for tile in tiles]
+        ys = [tile.y for tile in tiles]
+        return f"{self.provider_name(provider)}-{zoom}-{min(xs)}-{max(xs)}-{min(ys)}-{max(ys)}"
+
+    def basemap(
+            self,
+            provider: TileProvider | str,
+            west: float,
+            south: float,
+            east: float,
+            north: float,
+            zoom: int,
+            reuse: bool = True
+    ) -> tuple[np.ndarray, tuple[float, float, float, float]]:
+        """
+        Stitches the tiles covering a longitude/latitude box into one image in Web Mercator.
+        Inputs:
+        - provider (xyzservices.TileProvider | str): The tile provider, or a URL template
+        - west, south, east, north (float): The box to cover
+        - zoom (int): The zoom level of the tiles
+        - reuse (bool): Default True. If true, the stitched image is kept (in memory and next to the tiles) and returned again for any box covered by the same tiles
+        Outputs:
+        - image (numpy.ndarray): An RGBA image
+        - extent (tuple[float, float, float, float]): The (min x, max x, min y, max y) of the image in Web Mercator
+        """
+        tiles = list(mercantile.tiles(west, max(south, -MAX_LATITUDE), east, min(north, MAX_LATITUDE), zoom))
+        xs = sorted({tile.x for tile in tiles})
+        ys = sorted({tile.y for tile in tiles})
+
+        key = self.basemap_key(provider, west, south, east, north, zoom)
+        stored = self.directory / "basemaps" / f"{key}.npz"
+        if reuse and key in self._basemaps:
+            self._basemaps.move_to_end(key)
+            return self._basemaps[key]
+        if reuse and stored.exists():
+            with np.load(stored) as saved:
+                self._remember(self._basemaps, key, (saved["image"], tuple(saved["extent"])))
+            os.utime(stored)
+            return self._basemaps[key]
+
+        tile_images = {}
+        for tile in tiles:
+            data = self.get_tile(provider, tile.z, tile.x, tile.y)
+            if data is not None:
+                tile_images[tile.x, tile.y] = np.asarray(Image.open(BytesIO(data)).convert("RGBA"))
+
+        size = next(iter(tile_images.values())).shape[0] if tile_images else 256
+        image = np.zeros((len(ys) * size, len(xs) * size, 4), dtype=np.uint8)
+        for (x, y), tile_image in tile_images.items():
+            row = (y - ys[0]) * size
+            col = (x - xs[0]) * size
+            image[row:row + size, col:col + size] = tile_image
+
+        top_left = mercantile.xy_bounds(xs[0], ys[0], zoom)
+        bottom_right = mercantile.xy_bounds(xs[-1], ys[-1], zoom)
+        extent = (top_left.left, bottom_right.right, bottom_right.bottom, top_left.top)
+
+        if reuse:
+            self._remember(self._basemaps, key, (image, extent))
+            stored.parent.mkdir(parents=True, exist_ok=True)
+            np.savez_compressed(stored, image=image, extent=np.array(extent))
+        self.evict()
+        return image, extent
+
+    def add_basemap(
+            self,
+            ax,
+            provider: TileProvider | str = ctx.providers.OpenStreetMap.Mapnik,
+            crs=None,
+            zoom: int | str = "auto",
+            reuse: bool = True
+    ) -> None:
+        """
+        Draws a basemap behind the current extent of a set of axes, like contextily.add_basemap but reading tiles through the cache.
+        Inputs:
+        - ax (matplotlib.axes.Axes): The axes to draw on. Their limits must already cover the area of interest
+        - provider (xyzservices.TileProvider | str): Default OpenStreetMap Mapnik. The tile provider, or a URL template
+        - crs: Default None. The coordinate reference system of the axes. If not provided, Web Mercator is assumed, as contextily does
+        - zoom (int | str): Default "auto". The zoom level of the tiles, or "auto" to choose one from the extent
+        - reuse (bool): Default True. See TileCache.basemap
+        Outputs: None
+        """
+        xmin, xmax, ymin, ymax = ax.axis()
+        crs = CRS.from_user_input(crs if crs is not None else WEB_MERCATOR)
+        to_lon_lat = Transformer.from_crs(crs, "EPSG:4326", always_xy=True)
+        lons, lats = to_lon_lat.transform([xmin, xmax, xmin, xmax], [ymin, ymin, ymax, ymax])
+        west, east, south, north = min(lons), max(lons), min(lats), max(lats)
+
+        if zoom == "auto":
+            # The same rule contextily uses to pick a zoom level
+            zoom = int(min(ceil(log2(720 / (east - west))), ceil(log2(720 / (north - south)))))
+            zoom = max(0, min(zoom, 19))
+
+        image, extent = self.basemap(provider, west, south, east, north, zoom, reuse)
+        if crs != CRS.from_user_input(WEB_MERCATOR):
+            # Warps are kept by the basemap they came from rather than by image, since freshly fetched images are never reused
+            warp_key = (self.basemap_key(provider, west, south, east, north, zoom), crs.to_wkt())
+            if reuse and warp_key in self._warped:
+                self._warped.move_to_end(warp_key)
+                image, extent = self._warped[warp_key]
+            else:
+                image, extent = ctx.warp_tiles(image, extent, t_crs=crs)
+                if reuse:
+                    self._remember(self._warped, warp_key, (image, extent))
+
+        ax.imshow(image, extent=extent, interpolation="bilinear")
+        ax.axis((xmin, xmax, ymin, ymax))